@@ -4,6 +4,8 @@ import logging
 import os
 
 from django.conf import global_settings
+from kombu import Exchange
+from kombu import Queue
 
 
 # EntrezGene wants an email to use it's API.
@@ -72,6 +74,21 @@ ALLOWED_HOSTS = [
     'localhost',
 ]
 
+# Cache shared by all web server processes, e.g. for the counts and
+# pagination bookmarks of variant list queries (see
+# variants.materialized_variant_filter). The table is created by
+# scripts/bootstrap_data.py, or on an existing install with:
+#     ./manage.py createcachetable millstone_cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'millstone_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -301,13 +318,36 @@ CELERY_IMPORTS = (
         'pipeline.variant_calling',
         'pipeline.variant_calling.freebayes',
         'utils.import_util',
+        'variants.materialized_view_manager',
+        'variants.vcf_parser',
         'genome_finish.assembly_runner'
 )
 
+# Chords need the results of their header tasks, and callers of the pipeline
+# wait on the result of its final task. Only the tasks declared with
+# ignore_result=False store their results, since nothing cleans them up.
+CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
+CELERY_IGNORE_RESULT = True
+
 # When True, forces synchronous behavior so that it's not necessary
 # to have a celery server running.
 CELERY_ALWAYS_EAGER = False
 
+# Alignment and variant calling tasks go to their own queues (see
+# pipeline.pipeline_runner) so that workers can be dedicated to them with
+# celery worker -Q. Workers started without -Q consume all queues.
+CELERY_DEFAULT_QUEUE = 'celery'
+CELERY_QUEUES = (
+    Queue('celery', Exchange('celery'), routing_key='celery'),
+    Queue('alignment', Exchange('alignment'), routing_key='alignment'),
+    Queue('variant_calling', Exchange('variant_calling'),
+            routing_key='variant_calling'),
+)
+
+# Only take one task at a time from the queue, so that long pipeline tasks
+# don't hold back tasks queued behind them.
+CELERYD_PREFETCH_MULTIPLIER = 1
+
 
 ###############################################################################
 # External tools
@@ -363,6 +403,62 @@ JBROWSE_MAX_ALIGN_TRACKS = 5
 JBROWSE_MAX_COVERAGE_TRACKS = 10
 
 
+###############################################################################
+# Pipeline Scheduling
+###############################################################################
+
+# Resources reserved on the worker while a pipeline task in each queue runs.
+# Alignment tasks reserve settings.ALIGNMENT_THREADS threads.
+PIPELINE_TASK_RESOURCE_COSTS = {
+    'alignment': {
+        'memory_mb': 4096,
+        'scratch_mb': 10240,
+    },
+    'variant_calling': {
+        'threads': 1,
+        'memory_mb': 2048,
+        'scratch_mb': 1024,
+    },
+}
+
+# Resources of each worker machine. None means detect the number of cores
+# and the physical memory. Scratch space is always the free space in
+# MEDIA_ROOT.
+PIPELINE_WORKER_CAPACITY = {
+    'threads': None,
+    'memory_mb': None,
+}
+
+# File where the workers on a machine record the resources reserved by their
+# running tasks.
+PIPELINE_RESOURCE_LEDGER_PATH = '/tmp/millstone_pipeline_resources.json'
+
+# Seconds to wait before trying again to start a task that didn't fit.
+PIPELINE_ADMISSION_RETRY_SEC = 30
+
+# Seconds to wait before checking again whether the VCFs parsed in the
+# background are loaded, when the pipeline is otherwise complete.
+PIPELINE_COMPLETION_RETRY_SEC = 30
+
+
+###############################################################################
+# Read Alignment
+###############################################################################
+
+# Pipe the output of bwa mem straight through sorting, duplicate removal and
+# MD tag filling, writing only the final BAM to disk.
+ALIGNMENT_STREAMED = True
+
+# Number of threads used by bwa mem and samtools sort for each alignment.
+# Each celery worker may run one alignment per process, so set this in the
+# local settings of each worker to about its number of cores divided by its
+# concurrency.
+ALIGNMENT_THREADS = 1
+
+# Memory per thread used by samtools sort in streamed mode, in bytes.
+ALIGNMENT_SORT_MEMORY_PER_THREAD = 768 * 1024 * 1024
+
+
 ###############################################################################
 # Variant Calling
 ###############################################################################
@@ -395,6 +491,11 @@ FREEBAYES_PARALLEL = True
 # TODO: perhaps this should be determined dynamically based on genome size.
 FREEBAYES_REGION_SIZE = 200000
 
+# Freebayes regions are split further, at the resolution of the bam index, so
+# that none has more than this many times the alignment data of a region of
+# average coverage. Keeps regions with deep coverage from holding up the rest.
+FREEBAYES_REGION_MAX_READ_DATA_FACTOR = 2
+
 # SNPEff can be multithreaded but for simplicity, let's always keep this at 1.
 SNPEFF_THREADS = 1
 
@@ -404,6 +505,76 @@ SNPEFF_BUILD_DEBUG = True
 # Names of SnpEff summary files, which we want to delete after running.
 SNPEFF_SUMMARY_FILES = ['snpEff_genes.txt', 'snpEff_summary.html']
 
+# Load parsed VCF records into the database in batches using COPY, rather than
+# creating the models for each record one at a time.
+VCF_BULK_INGESTION = True
+
+# Number of VCF records per batch when bulk loading.
+VCF_BULK_INGESTION_BATCH_SIZE = 1000
+
+# Parse large tabix-indexed VCFs of the pipeline in parallel, one celery task
+# per region of the genome, in a chord whose callback finishes the parse. The
+# pipeline completes once all of them are loaded. Requires
+# VCF_BULK_INGESTION.
+VCF_PARSE_SHARDED = True
+
+# Size in bases of the regions that VCFs are split into when parsed in
+# parallel.
+VCF_PARSE_SHARD_SIZE = 1000000
+
+###############################################################################
+# Materialized Variant View
+###############################################################################
+
+# Keep the melted variant view in a regular table and only re-compute the rows
+# of Variants that changed, rather than rebuilding the whole view on every
+# invalidation. A full rebuild still happens when the variant key map changes.
+MATERIALIZED_VIEW_INCREMENTAL = True
+
+# When a full rebuild is required while serving a web request, rebuild in a
+# celery task and keep serving the existing, stale view until it is swapped
+# in. The view is still built synchronously if it doesn't exist yet.
+MATERIALIZED_VIEW_BACKGROUND_REFRESH = True
+
+# Keys of the catch-all json columns of the melted variant view that get an
+# expression index, by column. Keys missing from a ReferenceGenome's
+# variant_key_map are skipped.
+MATERIALIZED_VIEW_INDEXED_JSON_KEYS = {
+    'va_data': [
+        'INFO_EFF_GENE',
+        'INFO_EFF_IMPACT',
+        'INFO_EFF_EFFECT',
+    ],
+    'vccd_data': [
+        'INFO_DP',
+        'IS_SV',
+    ],
+    've_data': [
+        'GT_TYPE',
+        'IS_HET',
+        'DP',
+    ],
+    'es_data': [],
+}
+
+# When there is no filter, the total count of rows in the variant list is
+# taken from the planner's estimate if that estimate exceeds this threshold,
+# rather than counting the rows exactly.
+MATERIALIZED_VIEW_ESTIMATED_COUNT_THRESHOLD = 100000
+
+# Seconds to cache counts and pagination bookmarks for queries against the
+# view. Cached values are keyed on the view generation, so they never go stale.
+MATERIALIZED_VIEW_QUERY_CACHE_TIMEOUT = 60 * 60
+
+# Number of filters for which each process caches the ids of the matching
+# Variants, which lets re-sorting and paging skip evaluating the filter over
+# the whole view.
+MATERIALIZED_VIEW_FILTER_CACHE_SIZE = 100
+
+# Filters matching more Variants than this aren't restricted to the cached
+# ids, since scanning the view is cheaper than looking them all up.
+MATERIALIZED_VIEW_FILTER_CACHE_MAX_VARIANTS = 100000
+
 ###############################################################################
 # Callable Loci
 ###############################################################################
@@ -426,6 +597,16 @@ CL__MAX_LOWMAP_FRAC = 0.5
 # Distance between adjacent features, below which to merge them
 CL__MERGE_DIST = 25
 
+# Number of processes computing the per-base coverage arrays of an alignment,
+# used by callable loci and coverage-based deletion detection. As with
+# ALIGNMENT_THREADS, set this in the local settings of each worker to about
+# its number of cores divided by its concurrency.
+COVERAGE_PROCESSES = 1
+
+# With more than one coverage process, chromosomes are split into windows of
+# this many bases, each computed by one process.
+COVERAGE_WINDOW_SIZE = 1000000
+
 ###############################################################################
 # Coverage-based Deletion Detection
 ###############################################################################
@@ -452,6 +633,30 @@ COVDEL_LARGE_DEL_MIN_DEL_LEN = 2000
 # (they should be found by SNV tools like Freebayes instead)
 COVDEL_SMOOTHED_SIZE_CUTOFF = 15
 
+###############################################################################
+# De Novo Assembly
+###############################################################################
+
+# If True, SV-indicating reads are clustered into loci that are each assembled
+# by a velvet run of their own, instead of by one velvet run over all the
+# reads of the sample.
+LOCAL_ASSEMBLY = False
+
+# Number of processes running the velvet runs of the loci of a sample at once.
+# As with COVERAGE_PROCESSES, set this in the local settings of each worker to
+# about its number of cores divided by its concurrency.
+LOCAL_ASSEMBLY_PROCESSES = 1
+
+# Reads anchored closer than this many bases are clustered into a locus.
+LOCAL_ASSEMBLY_MAX_GAP = 1000
+
+# Clusters are split when they reach this many bases.
+LOCAL_ASSEMBLY_MAX_LOCUS_SIZE = 20000
+
+# Number of read pairs needed to join two clusters, e.g. the two sides of a
+# translocation, into one locus, and to assemble a locus at all.
+LOCAL_ASSEMBLY_MIN_READ_PAIRS = 5
+
 ###############################################################################
 # Feature Flags
 ###############################################################################
@@ -0,0 +1,115 @@
+"""
+Benchmark of building the contig placement sequence graph and walking it, on
+synthetic sets of contigs.
+
+Each synthetic contig is a novel sequence insertion: its two ends align to
+the reference on either side of the insertion site, the first end as the
+primary alignment and the second as a supplementary alignment.
+
+Usage:
+    python debug/2026_10_18_benchmark_sequence_graph.py [num_contigs ...]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import networkx as nx
+import pysam
+
+# Setup Django environment.
+sys.path.append(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from genome_finish.graph_contig_placement import add_alignment_to_graph
+from genome_finish.graph_contig_placement import novel_seq_ins_walk
+from genome_finish.graph_contig_placement import SequenceGraphIndex
+from genome_finish.graph_contig_placement import SequenceIntervals
+from genome_finish.graph_contig_placement import translocation_walk
+
+
+REF_NAME = 'ref'
+
+REF_LENGTH = 5000000
+
+CONTIG_FLANK_LENGTH = 300
+
+CONTIG_INSERTION_LENGTH = 1000
+
+DEFAULT_NUM_CONTIGS_LIST = [500, 2000, 8000]
+
+
+def write_synthetic_contig_alignment(bam_path, num_contigs, seed=0):
+    """Writes a bam of num_contigs contigs that each span an insertion at a
+    random position of the reference.
+    """
+    rand = random.Random(seed)
+    header = {
+        'HD': {'VN': '1.0'},
+        'SQ': [{'SN': REF_NAME, 'LN': REF_LENGTH}],
+    }
+    contig_length = 2 * CONTIG_FLANK_LENGTH + CONTIG_INSERTION_LENGTH
+    insertion_end = CONTIG_FLANK_LENGTH + CONTIG_INSERTION_LENGTH
+
+    output_af = pysam.AlignmentFile(bam_path, 'wb', header=header)
+    for contig_idx in range(num_contigs):
+        insertion_pos = rand.randint(
+                CONTIG_FLANK_LENGTH, REF_LENGTH - CONTIG_FLANK_LENGTH)
+
+        for (ref_start, cigar, flag) in [
+                (insertion_pos - CONTIG_FLANK_LENGTH,
+                        [(0, CONTIG_FLANK_LENGTH), (4, contig_length -
+                                CONTIG_FLANK_LENGTH)],
+                        0),
+                (insertion_pos,
+                        [(4, insertion_end), (0, CONTIG_FLANK_LENGTH)],
+                        0x800)]:
+            read = pysam.AlignedSegment()
+            read.query_name = 'contig_%d' % contig_idx
+            read.query_sequence = 'A' * contig_length
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = ref_start
+            read.mapping_quality = 60
+            read.cigartuples = cigar
+            output_af.write(read)
+    output_af.close()
+
+
+def benchmark(num_contigs):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        bam_path = os.path.join(temp_dir, 'contig_alignment.bam')
+        write_synthetic_contig_alignment(bam_path, num_contigs)
+
+        start_time = time.time()
+        G = nx.DiGraph()
+        G.ref_intervals = SequenceIntervals(REF_NAME, REF_LENGTH, tag='ref')
+        add_alignment_to_graph(G, bam_path)
+        build_time = time.time() - start_time
+
+        start_time = time.time()
+        graph_index = SequenceGraphIndex(G)
+        index_time = time.time() - start_time
+
+        start_time = time.time()
+        iv_list = novel_seq_ins_walk(G, graph_index)
+        translocation_walk(G, graph_index)
+        walk_time = time.time() - start_time
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print '%d contigs: %d vertices, %d insertions found' % (
+            num_contigs, len(G), len(iv_list))
+    print '    build graph: %.2fs, index: %.2fs, walks: %.2fs' % (
+            build_time, index_time, walk_time)
+
+
+if __name__ == '__main__':
+    num_contigs_list = [int(arg) for arg in sys.argv[1:]]
+    for num_contigs in num_contigs_list or DEFAULT_NUM_CONTIGS_LIST:
+        benchmark(num_contigs)
@@ -1,43 +1,58 @@
+from multiprocessing import current_process
+from multiprocessing import Pool
 import datetime
+import json
 import os
 import pickle
-import pyinter
 import re
 import shutil
 import subprocess
+import sys
 
 from Bio import SeqIO
+from Bio.Seq import Seq
 from django.conf import settings
+from django.db import transaction
 
+from genome_finish.celery_task_decorator import assembly_step
 from genome_finish.celery_task_decorator import get_failure_report_path
 from genome_finish.celery_task_decorator import set_assembly_status
 from genome_finish.constants import CUSTOM_SV_METHODS
 from genome_finish.graph_contig_placement import graph_contig_placement
 from genome_finish.insertion_placement_read_trkg import make_contig_reads_to_ref_alignments
+from genome_finish.local_assembly import split_reads_into_loci
 from genome_finish.millstone_de_novo_fns import add_paired_mates
 from genome_finish.millstone_de_novo_fns import filter_low_qual_read_pairs
 from genome_finish.millstone_de_novo_fns import filter_out_unpaired_reads
-from genome_finish.millstone_de_novo_fns import get_altalign_reads
 from genome_finish.millstone_de_novo_fns import get_avg_genome_coverage
-from genome_finish.millstone_de_novo_fns import get_clipped_reads_smart
 from genome_finish.millstone_de_novo_fns import get_piled_reads
-from genome_finish.millstone_de_novo_fns import get_unmapped_reads
+from genome_finish.millstone_de_novo_fns import is_unmapped_read
+from genome_finish.millstone_de_novo_fns import make_clipped_read_filter
+from main.model_utils import allocate_model_ids
+from main.model_utils import clean_filesystem_location
+from main.model_utils import copy_model_instances
+from main.model_utils import copy_rows
+from main.model_utils import ensure_unique_uids
 from main.model_utils import get_dataset_with_type
 from main.models import Contig
 from main.models import Dataset
 from main.models import ExperimentSampleToAlignment
 from main.models import VariantCallerCommonData
 from pipeline.read_alignment import get_insert_size_mean_and_stdev
-from pipeline.read_alignment_util import extract_discordant_read_pairs
-from pipeline.read_alignment_util import extract_split_reads
+from pipeline.read_alignment_util import get_split_read_query_name
+from pipeline.read_alignment_util import is_altalign_read
+from pipeline.read_alignment_util import is_discordant_read
 from utils.bam_utils import concatenate_bams
 from utils.bam_utils import index_bam
 from utils.bam_utils import rmdup
 from utils.bam_utils import sort_bam_by_coordinate
 from utils.bam_utils import sort_bam_by_name
+from utils.bam_utils import split_bam_by_read_class
 from utils.data_export_util import export_contig_list_as_vcf
 from utils.data_export_util import export_var_dict_list_as_vcf
+from utils.genbank_util import GenbankFeatureIndex
 from utils.import_util import add_dataset_to_entity
+from utils.import_util import ensure_fasta_index
 from variants.filter_key_map_constants import MAP_KEY__COMMON_DATA
 from variants.vcf_parser import parse_vcf
 
@@ -76,6 +91,14 @@ VELVET_OUTPUT_FILES = {
     'Graph2'
 }
 
+# Multi-fasta of the sequences of all contigs of an assembly, named by Contig
+# uid, written to the assembly dir.
+CONTIG_SEQUENCES_FASTA = 'contig_sequences.fa'
+
+# Loci passed to a child process running the velvet pool, written to the
+# assembly dir.
+VELVET_POOL_LOCI_FILENAME = 'velvet_pool_loci.json'
+
 NUM_CONTIGS_TO_EVALUATE = 1000
 
 STRUCTURAL_VARIANT_VCF_DATASETS = [
@@ -116,42 +139,37 @@ def kmer_coverage(C, L, k):
 
 def generate_contigs(sample_alignment,
         sv_read_classes={}, input_velvet_opts={},
-        overwrite=True):
-    """Generates contigs.
+        overwrite=True, local_assembly=None):
+    """Generates contigs by running the SV read extraction, assembly and
+    contig placement steps of the SV calling pipeline in turn.
+
+    If local_assembly is True, SV-indicating reads are assembled per locus
+    by assemble_loci_with_velvet(). Defaults to settings.LOCAL_ASSEMBLY.
     """
-    # Don't proceed if processing this sample alignment previously failed or
-    # in another async process.
-    sample_alignment = ExperimentSampleToAlignment.objects.get(
-            uid=sample_alignment.uid)
-    if (sample_alignment.data.get('assembly_status') ==
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.FAILED):
-        return
+    sv_indicants_bam = extract_sv_indicating_reads(sample_alignment,
+            sv_read_classes=sv_read_classes, overwrite=overwrite)
+    contig_uid_list = assemble_sv_indicating_reads(sv_indicants_bam,
+            sample_alignment, input_velvet_opts=input_velvet_opts,
+            overwrite=overwrite, local_assembly=local_assembly)
+    place_contigs(contig_uid_list, sample_alignment)
 
-    # Set assembly status for UI
-    # NOTE: Setting this status is playing whack-a-mole against other async sv
-    # detection functions, e.g. detect_deletion.cov_detect_deletion_make_vcf().
-    set_assembly_status(
-            sample_alignment,
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.ASSEMBLING)
 
-    print 'Generating contigs\n'
+@assembly_step(ExperimentSampleToAlignment.ASSEMBLY_STEP.SV_READS)
+def extract_sv_indicating_reads(sample_alignment, sv_read_classes={},
+        overwrite=True):
+    """Isolates the SV-indicating read pairs of the sample alignment for
+    assembly.
+
+    Returns:
+        Path to the name-sorted bam of SV-indicating read pairs.
+    """
+    print 'Extracting SV-indicating reads\n'
 
     # Grab reference genome fasta path and ensure exists.
     reference_genome = sample_alignment.alignment_group.reference_genome
     reference_genome.dataset_set.get_or_create(
             type=Dataset.TYPE.REFERENCE_GENOME_FASTA)[0]
 
-    # Make assembly_dir directory to house genome_finishing files
-    assembly_dir = os.path.join(
-            sample_alignment.get_model_data_dir(),
-            'assembly')
-
-    # Make assembly directory if it does not exist, and remove it if it does
-    if os.path.exists(assembly_dir):
-        shutil.rmtree(assembly_dir)
-    os.mkdir(assembly_dir)
-
-
     # Get a bam of sorted SV indicants with pairs
     sv_indicants_bam = get_sv_indicating_reads(sample_alignment,
             sv_read_classes, overwrite=overwrite)
@@ -187,6 +205,31 @@ def generate_contigs(sample_alignment,
         # add_bam_file_track(reference_genome,
         #         sample_alignment, Dataset.TYPE.BWA_FOR_DE_NOVO_ASSEMBLY)
 
+    return sv_indicants_bam
+
+
+@assembly_step(ExperimentSampleToAlignment.ASSEMBLY_STEP.ASSEMBLY,
+        required_steps=[ExperimentSampleToAlignment.ASSEMBLY_STEP.SV_READS])
+def assemble_sv_indicating_reads(sv_indicants_bam, sample_alignment,
+        input_velvet_opts={}, overwrite=True, local_assembly=None):
+    """Assembles the SV-indicating reads from extract_sv_indicating_reads()
+    into Contigs.
+
+    Returns:
+        List of the uids of the Contigs.
+    """
+    print 'Generating contigs\n'
+
+    # Make assembly_dir directory to house genome_finishing files
+    assembly_dir = os.path.join(
+            sample_alignment.get_model_data_dir(),
+            'assembly')
+
+    # Make assembly directory if it does not exist, and remove it if it does
+    if os.path.exists(assembly_dir):
+        shutil.rmtree(assembly_dir)
+    os.mkdir(assembly_dir)
+
     velvet_opts = dict(DEFAULT_VELVET_OPTS)
 
     # Find insertion metrics
@@ -217,21 +260,27 @@ def generate_contigs(sample_alignment,
                         input_velvet_opts[shallow_key][deep_key])
 
     # Perform velvet assembly and generate contig objects.
-    contig_uid_list = assemble_with_velvet(
-            assembly_dir, velvet_opts, sv_indicants_bam,
-            sample_alignment, overwrite=overwrite)
+    if local_assembly is None:
+        local_assembly = settings.LOCAL_ASSEMBLY
+    if local_assembly:
+        contig_uid_list = assemble_loci_with_velvet(
+                assembly_dir, velvet_opts, sv_indicants_bam,
+                sample_alignment)
+    else:
+        contig_uid_list = assemble_with_velvet(
+                assembly_dir, velvet_opts, sv_indicants_bam,
+                sample_alignment, overwrite=overwrite)
 
-    # Evaluate contigs for mapping.
-    evaluate_contigs(contig_uid_list)
+    return contig_uid_list
 
-    # Update status again if not FAILED.
-    sample_alignment = ExperimentSampleToAlignment.objects.get(
-            uid=sample_alignment.uid)
-    if (sample_alignment.data.get('assembly_status') !=
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.FAILED):
-        set_assembly_status(
-                sample_alignment,
-                ExperimentSampleToAlignment.ASSEMBLY_STATUS.WAITING_TO_PARSE)
+
+@assembly_step(ExperimentSampleToAlignment.ASSEMBLY_STEP.CONTIG_PLACEMENT,
+        required_steps=[ExperimentSampleToAlignment.ASSEMBLY_STEP.ASSEMBLY])
+def place_contigs(contig_uid_list, sample_alignment):
+    """Places the contigs from assemble_sv_indicating_reads() on the
+    reference, making vcfs of the variants they call.
+    """
+    evaluate_contigs(contig_uid_list)
 
 
 def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
@@ -248,19 +297,21 @@ def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
             Dataset.TYPE.BWA_DISCORDANT: 'discordant'
     }
 
-    sv_indicant_class_to_generator = {
-            Dataset.TYPE.BWA_ALTALIGN: get_altalign_reads,
-            Dataset.TYPE.BWA_PILED: get_piled_reads,
-            Dataset.TYPE.BWA_CLIPPED: lambda i, o: get_clipped_reads_smart(
-                    i, o,
+    # Classes that are decided read by read, so that they can all be
+    # isolated in a single pass over the alignment.
+    sv_indicant_class_to_read_class_fn = {
+            Dataset.TYPE.BWA_ALTALIGN: is_altalign_read,
+            Dataset.TYPE.BWA_CLIPPED: make_clipped_read_filter(
                     phred_encoding=sample_alignment.experiment_sample.data.get(
                             'phred_encoding', None)),
-            Dataset.TYPE.BWA_SPLIT: extract_split_reads,
-            Dataset.TYPE.BWA_UNMAPPED: lambda i, o: get_unmapped_reads(
-                    i, o, avg_phred_cutoff=20),
-            Dataset.TYPE.BWA_DISCORDANT: extract_discordant_read_pairs
+            Dataset.TYPE.BWA_SPLIT: get_split_read_query_name,
+            Dataset.TYPE.BWA_UNMAPPED: is_unmapped_read,
+            Dataset.TYPE.BWA_DISCORDANT: is_discordant_read
     }
 
+    # Minimum average phred score of unmapped read pairs.
+    UNMAPPED_AVG_PHRED_CUTOFF = 20
+
     default_sv_indicant_classes = {
             Dataset.TYPE.BWA_ALTALIGN: False,
             Dataset.TYPE.BWA_PILED: False,
@@ -292,41 +343,65 @@ def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
             sample_alignment.get_model_data_dir(),
             'bwa_align')
 
-    # Helper function for getting sv read datasets
-    def _get_or_create_sv_dataset(key):
-        dataset_query = sample_alignment.dataset_set.filter(type=key)
+    # Determine which SV read datasets need to be created.
+    sv_datasets = {}
+    sv_dataset_paths = {}
+    for key in sv_indicant_keys:
+        if not default_sv_indicant_classes[key]:
+            continue
 
-        if dataset_query.exists() and not overwrite or (
-                dataset_query.exists() and
-                key not in sv_indicant_class_to_generator):
-            assert len(dataset_query) == 1
-            return dataset_query[0]
-        elif dataset_query.exists() and overwrite and (
-                key in sv_indicant_class_to_generator):
+        dataset_query = sample_alignment.dataset_set.filter(type=key)
+        if dataset_query.exists():
             assert len(dataset_query) == 1
+            if not overwrite:
+                sv_datasets[key] = dataset_query[0]
+                continue
             dataset_query[0].delete()
 
-        if (overwrite and key in sv_indicant_class_to_generator) or (
-                not dataset_query.exists()):
-            dataset_path = '.'.join([
-                    alignment_file_prefix,
-                    sv_indicant_class_to_filename_suffix[key],
-                    'bam'
-                    ])
-            generator = sv_indicant_class_to_generator[key]
-            generator(alignment_bam, dataset_path)
-
-            return add_dataset_to_entity(
-                    sample_alignment,
-                    key,
-                    key,
-                    filesystem_location=dataset_path)
+        sv_dataset_paths[key] = '.'.join([
+                alignment_file_prefix,
+                sv_indicant_class_to_filename_suffix[key],
+                'bam'
+                ])
+
+    # Unmapped reads are filtered by quality afterwards.
+    if Dataset.TYPE.BWA_UNMAPPED in sv_dataset_paths:
+        unfiltered_unmapped_path = '_unfiltered'.join(os.path.splitext(
+                sv_dataset_paths[Dataset.TYPE.BWA_UNMAPPED]))
+
+    # Isolate the read by read classes in one pass.
+    read_classes = []
+    for key, dataset_path in sv_dataset_paths.iteritems():
+        if key not in sv_indicant_class_to_read_class_fn:
+            continue
+        if key == Dataset.TYPE.BWA_UNMAPPED:
+            dataset_path = unfiltered_unmapped_path
+        read_classes.append(
+                (dataset_path, sv_indicant_class_to_read_class_fn[key]))
+    if read_classes:
+        split_bam_by_read_class(alignment_bam, read_classes)
+
+    if Dataset.TYPE.BWA_UNMAPPED in sv_dataset_paths:
+        filter_low_qual_read_pairs(unfiltered_unmapped_path,
+                sv_dataset_paths[Dataset.TYPE.BWA_UNMAPPED],
+                UNMAPPED_AVG_PHRED_CUTOFF)
+
+    # Piled reads depend on how reads stack up, so need their own pass.
+    if Dataset.TYPE.BWA_PILED in sv_dataset_paths:
+        get_piled_reads(alignment_bam,
+                sv_dataset_paths[Dataset.TYPE.BWA_PILED])
+
+    for key, dataset_path in sv_dataset_paths.iteritems():
+        sv_datasets[key] = add_dataset_to_entity(
+                sample_alignment,
+                key,
+                key,
+                filesystem_location=dataset_path)
 
     # Aggregate SV indicants
     for key in sv_indicant_keys:
         if default_sv_indicant_classes[key]:
-            dataset = _get_or_create_sv_dataset(key)
-            sv_bams_list.append(dataset.get_absolute_location())
+            sv_bams_list.append(sv_datasets[key].get_absolute_location())
 
     # TODO(dbgoodman): Maybe fix.
     # # Make some bam tracks for read classes
@@ -398,24 +473,133 @@ def assemble_with_velvet(assembly_dir, velvet_opts, sv_indicants_bam,
     # which are particularly bad when many unused reads.
     assert not reassemble_contig_from_reads
 
-    timestamp = str(datetime.datetime.now())
-    contig_number_pattern = re.compile('^NODE_(\d+)_')
+    _run_velvet(assembly_dir, velvet_opts, sv_indicants_bam)
 
-    reference_genome = sample_alignment.alignment_group.reference_genome
+    contig_list = _make_velvet_contigs(sample_alignment, [(assembly_dir, {})])
+    contig_uid_list = create_contigs_with_shared_fasta(contig_list,
+            os.path.join(assembly_dir, CONTIG_SEQUENCES_FASTA))
+
+    # once contigs are extracted, remove velvet data
+    _cleanup_velvet_dir(assembly_dir)
 
-    contig_files = []
-    contig_uid_list = []
+    return contig_uid_list
 
-    _run_velvet(assembly_dir, velvet_opts, sv_indicants_bam)
 
-    # Collect resulting contigs fasta
-    contigs_fasta = os.path.join(assembly_dir, 'contigs.fa')
-    contig_files.append(contigs_fasta)
+def assemble_loci_with_velvet(assembly_dir, velvet_opts, sv_indicants_bam,
+        sample_alignment):
+    """Clusters the SV-indicating reads into loci and assembles each locus
+    with a velvet run of its own, rather than one run over all the reads.
 
-    records = list(SeqIO.parse(contigs_fasta, 'fasta'))
+    This bounds the memory of each run by the reads of its locus, and up to
+    settings.LOCAL_ASSEMBLY_PROCESSES runs go at once in a process pool. The
+    contigs of all loci are created together, as for a single assembly.
+    """
+    loci = split_reads_into_loci(sv_indicants_bam, assembly_dir)
+    locus_runs = [(locus.assembly_dir, locus.reads_bam) for locus in loci]
+
+    processes = min(settings.LOCAL_ASSEMBLY_PROCESSES, len(locus_runs))
+    if processes <= 1:
+        for locus_assembly_dir, reads_bam in locus_runs:
+            _run_velvet(locus_assembly_dir, velvet_opts, reads_bam)
+    elif current_process().daemon:
+        _run_velvet_pool_in_subprocess(assembly_dir, velvet_opts, locus_runs,
+                processes)
+    else:
+        _run_velvet_pool(velvet_opts, locus_runs, processes)
+
+    contig_list = _make_velvet_contigs(sample_alignment, [
+            (locus.assembly_dir, {'assembly_locus': locus.regions})
+            for locus in loci])
+    contig_uid_list = create_contigs_with_shared_fasta(contig_list,
+            os.path.join(assembly_dir, CONTIG_SEQUENCES_FASTA))
+
+    for locus in loci:
+        _cleanup_velvet_dir(locus.assembly_dir)
+
+    return contig_uid_list
+
+
+def _run_velvet_pool(velvet_opts, locus_runs, processes):
+    """Runs velvet on each locus in a pool of processes.
+
+    Args:
+        velvet_opts: Velvet options shared by all loci.
+        locus_runs: List of tuples (assembly dir, reads bam), one per locus.
+        processes: Size of the pool.
+    """
+    pool = Pool(processes)
+    try:
+        pool.map(_run_velvet_on_locus, [
+                (locus_assembly_dir, velvet_opts, reads_bam)
+                for locus_assembly_dir, reads_bam in locus_runs])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _run_velvet_on_locus(locus_run):
+    """Runs velvet on the reads of a locus in a process of the pool.
+    """
+    locus_assembly_dir, velvet_opts, reads_bam = locus_run
+    _run_velvet(locus_assembly_dir, velvet_opts, reads_bam)
+
+
+def _run_velvet_pool_in_subprocess(assembly_dir, velvet_opts, locus_runs,
+        processes):
+    """Runs _run_velvet_pool() in a child python process, which unlike a
+    daemonic process, such as a celery worker process, may start the pool.
+    See _main().
+    """
+    loci_path = os.path.join(assembly_dir, VELVET_POOL_LOCI_FILENAME)
+    with open(loci_path, 'w') as fh:
+        json.dump({
+            'velvet_opts': velvet_opts,
+            'locus_runs': locus_runs
+        }, fh)
+
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    try:
+        subprocess.check_call(
+                [sys.executable, '-m', 'genome_finish.assembly',
+                        loci_path, str(processes)],
+                cwd=settings.PWD, env=env)
+    finally:
+        os.remove(loci_path)
+
+
+def _make_velvet_contigs(sample_alignment, assembly_dir_metadata_list):
+    """Makes unsaved Contigs for the contigs velvet assembled in each of
+    the assembly dirs, numbered in order across them.
+
+    Args:
+        sample_alignment: ExperimentSampleToAlignment of the assembled reads.
+        assembly_dir_metadata_list: List of (assembly_dir, metadata) tuples,
+            where metadata is a dictionary added to the metadata of the
+            Contigs from the assembly dir.
+
+    Returns:
+        List of (Contig, SeqRecord) tuples, as taken by
+        create_contigs_with_shared_fasta().
+    """
+    timestamp = str(datetime.datetime.now())
+    contig_number_pattern = re.compile('^NODE_(\d+)_')
+
+    reference_genome = sample_alignment.alignment_group.reference_genome
+
+    # Collect resulting contigs fastas
+    records = []
+    for assembly_dir, metadata in assembly_dir_metadata_list:
+        contigs_fasta = os.path.join(assembly_dir, 'contigs.fa')
+        for seq_record in SeqIO.parse(contigs_fasta, 'fasta'):
+            records.append((assembly_dir, metadata, seq_record))
     digits = len(str(len(records))) + 1
 
-    for (i, seq_record) in enumerate(records, 1):
+    contig_list = []
+    for (i, (assembly_dir, metadata, seq_record)) in enumerate(records, 1):
 
         # Extract contig sequence from the contigs.fa file, number, and
         # name it.
@@ -424,11 +608,7 @@ def assemble_with_velvet(assembly_dir, velvet_opts, sv_indicants_bam,
                     contig_number_pattern.findall(
                             seq_record.description)[0])
         coverage = float(seq_record.description.rsplit('_', 1)[1])
-        seq_record.seq = reduce(
-                lambda x, y: x + y,
-                [seq for seq in seq_record.seq.split('N')])
-        seq_record.id = seq_record.name = seq_record.description = (
-                'NODE_' + str(i))
+        seq_record.seq = Seq(''.join(str(seq_record.seq).split('N')))
         leading_zeros = digits - len(str(i))
         contig_label = '%s_%s' % (
                 sample_alignment.experiment_sample.label,
@@ -436,17 +616,20 @@ def assemble_with_velvet(assembly_dir, velvet_opts, sv_indicants_bam,
 
         # Create model and metadata.
 
-        contig = Contig.objects.create(
+        contig = Contig(
                 label=contig_label,
+                num_bases=len(seq_record),
                 parent_reference_genome=reference_genome,
                 experiment_sample_to_alignment=(
-                        sample_alignment))
-        contig.metadata['coverage'] = coverage
-        contig.metadata['timestamp'] = timestamp
-        contig.metadata['node_number'] = contig_node_number
-        contig.metadata['assembly_dir'] = assembly_dir
-
-        contig.ensure_model_data_dir_exists()
+                        sample_alignment),
+                metadata={
+                    'coverage': coverage,
+                    'timestamp': timestamp,
+                    'node_number': contig_node_number,
+                    'assembly_dir': assembly_dir
+                })
+        contig.metadata.update(metadata)
+        contig_list.append((contig, seq_record))
 
         # NOTE: Unused code.
         # Reassemble the contig from its constituent reads separately,
@@ -470,34 +653,72 @@ def assemble_with_velvet(assembly_dir, velvet_opts, sv_indicants_bam,
         #     if reassembled_seqrecord:
         #         seq_record.seq = reassembled_seqrecord.seq
 
-        # Write the contig fasta and add it as a dataset to the contig object.
-
-        dataset_path = os.path.join(contig.get_model_data_dir(),
-                'fasta.fa')
-
-        with open(dataset_path, 'w') as fh:
-            SeqIO.write([seq_record], fh, 'fasta')
-
-        add_dataset_to_entity(
-                contig,
-                'contig_fasta',
-                Dataset.TYPE.REFERENCE_GENOME_FASTA,
-                filesystem_location=dataset_path)
-
-        contig.save()
-
         # NOTE: Disabled for now. Severe performance issues.
         # Make a bam track on the reference for each contig that shows only the
         # reads that assembled the contig and their mates
         # make_contig_reads_to_ref_alignments(contig.uid)
 
-        # append the uid to the contig_uid_list
-        contig_uid_list.append(contig.uid)
+    return contig_list
 
-    # once contigs are extracted, remove velvet data
-    _cleanup_velvet_dir(assembly_dir)
 
-    return contig_uid_list
+def create_contigs_with_shared_fasta(contig_list, fasta_path):
+    """Saves new Contigs in bulk, with their sequences in one indexed
+    multi-fasta rather than a fasta each.
+
+    Contigs, their fasta Datasets and the links between them are inserted
+    with a single COPY each, which doesn't send the signals of
+    Contig.objects.create() and add_dataset_to_entity(). So num_bases must
+    already be set on the Contigs.
+
+    Args:
+        contig_list: List of (Contig, SeqRecord) tuples, with unsaved Contigs.
+        fasta_path: Path of the multi-fasta to write.
+
+    Returns:
+        List of uids of the created Contigs.
+    """
+    if not contig_list:
+        return []
+
+    contigs = [contig for contig, _ in contig_list]
+    for contig, contig_id in zip(contigs,
+            allocate_model_ids(Contig, len(contigs))):
+        contig.id = contig_id
+    ensure_unique_uids(Contig, contigs)
+
+    # Name the fasta records by Contig uid, so that each Contig can fetch
+    # its sequence using the fasta index.
+    seq_records = []
+    for contig, seq_record in contig_list:
+        seq_record.id = seq_record.name = str(contig.uid)
+        seq_record.description = ''
+        seq_records.append(seq_record)
+    with open(fasta_path, 'w') as fh:
+        SeqIO.write(seq_records, fh, 'fasta')
+    ensure_fasta_index(fasta_path)
+
+    datasets = [Dataset(
+                    label='contig_fasta',
+                    type=Dataset.TYPE.REFERENCE_GENOME_FASTA,
+                    filesystem_location=clean_filesystem_location(
+                            fasta_path),
+                    filesystem_idx_location=clean_filesystem_location(
+                            fasta_path + '.fai'))
+            for contig in contigs]
+    for dataset, dataset_id in zip(datasets,
+            allocate_model_ids(Dataset, len(datasets))):
+        dataset.id = dataset_id
+    ensure_unique_uids(Dataset, datasets)
+
+    copy_model_instances(Contig, contigs)
+    copy_model_instances(Dataset, datasets)
+    copy_rows(Contig.dataset_set.through._meta.db_table,
+            ['contig_id', 'dataset_id'],
+            [(contig.id, dataset.id)
+                    for contig, dataset in zip(contigs, datasets)])
+    transaction.commit_unless_managed()
+
+    return [contig.uid for contig in contigs]
 
 
 def evaluate_contigs(contig_uid_list, skip_extracted_read_alignment=False,
@@ -587,21 +808,15 @@ def evaluate_contigs(contig_uid_list, skip_extracted_read_alignment=False,
                 path)
 
 
+@assembly_step(ExperimentSampleToAlignment.ASSEMBLY_STEP.PARSE_VARIANTS,
+        required_steps=[
+                ExperimentSampleToAlignment.ASSEMBLY_STEP.CONTIG_PLACEMENT,
+                ExperimentSampleToAlignment.ASSEMBLY_STEP.COVERAGE_DELETIONS])
 def parse_variants_from_vcf(sample_alignment,
         vcf_datasets_to_parse=STRUCTURAL_VARIANT_VCF_DATASETS):
-
-    # Do nothing if the assembly for this sample alignment failed.
-    if sample_alignment.data.get('assembly_status') == (
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.FAILED):
-        print ('WARNING: SV assembly failed for Sample Alignment ' +
-                '{label} ({uid}) so variant parsing was skipped.').format(
-                        label=sample_alignment.label,
-                        uid=sample_alignment.uid)
-        return
-
-    set_assembly_status(sample_alignment,
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.PARSING_VARIANTS)
-
+    """Parses the variants from the vcfs of the other steps of the SV calling
+    pipeline. Skipped if any of them failed.
+    """
     variant_list = []
     for dataset_type in vcf_datasets_to_parse:
         dataset_query = sample_alignment.dataset_set.filter(
@@ -626,9 +841,6 @@ def parse_variants_from_vcf(sample_alignment,
                 contig.variant_caller_common_data = vccd
                 contig.save()
 
-    set_assembly_status(sample_alignment,
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.COMPLETED)
-
 
 def clean_up_previous_runs_of_sv_calling_pipeline(sample_alignment):
     """Deletes all model entities from previous runs of our custom SV
@@ -689,6 +901,10 @@ def clean_up_previous_runs_of_sv_calling_pipeline(sample_alignment):
     sample_alignment.dataset_set.filter(
                 type=Dataset.TYPE.MOBILE_ELEMENT_FASTA).delete()
 
+    # Clear the step statuses of the previous run.
+    sample_alignment.update_data(
+            lambda data: data.pop('assembly_steps', None))
+
     set_assembly_status(
             sample_alignment,
             sample_alignment.ASSEMBLY_STATUS.NOT_STARTED,
@@ -822,31 +1038,29 @@ def _extract_node_from_contig_reassembly(contig):
         return records[0]
 
 
-def get_features_at_locations(ref_genome, intervals, chromosome=None):
-    """
-    Use the genbank index dataset and return gene or mobile element names
-    that are within these intervals.
+def get_feature_index(ref_genome):
+    """Returns the GenbankFeatureIndex of the annotated reference genome,
+    creating its index dataset if needed.
     """
-    feature_index_path = get_dataset_with_type(ref_genome,
-            Dataset.TYPE.FEATURE_INDEX).get_absolute_location()
-
-    with open(feature_index_path, 'r') as fh:
-
-        gbk_feature_list = pickle.load(fh)
+    ref_genome.ensure_feature_index()
+    return GenbankFeatureIndex(get_dataset_with_type(ref_genome,
+            Dataset.TYPE.FEATURE_INDEX).get_absolute_location())
 
-        # Dictionary of features to return, for each interval.
-        return_features = {}
 
-        # For each input interval, return a list of feature names that
-        # overlap.
-        for interval in intervals:
-            q_ivl = pyinter.closedopen(*interval)
-            features = [f_ivl for f_ivl in gbk_feature_list if
-                    q_ivl.intersect(f_ivl)]
+def get_features_at_locations(ref_genome, intervals, chromosome=None):
+    """
+    Use the genbank index dataset and return the gene or mobile element
+    features that overlap these intervals.
 
-            return_features[interval] = features
+    Returns:
+        Dictionary from each interval to a list of GenbankFeature.
+    """
+    feature_index = get_feature_index(ref_genome)
 
-        return return_features
+    return dict(
+            (interval, feature_index.get_features_at_interval(
+                    interval, chromosome=chromosome))
+            for interval in intervals)
 
 
 def annotate_contig_junctions(contig_uid_list, ref_genome, dist=0):
@@ -859,57 +1073,48 @@ def annotate_contig_junctions(contig_uid_list, ref_genome, dist=0):
     if not ref_genome.is_annotated():
         return
 
-    # create a list of contig junctions to annotate
-    contig_junctions = []
-    # contig_junctions are tuples that look like:
-    # (contig_object,
-    # 'right_or_left',
-    # junction_idx,
-    # junction interval tuple)
-
-    for contig_uid in contig_uid_list:
-        c = Contig.objects.get(uid=contig_uid)
-        if 'right_junctions' in c.metadata:
-            for i,j in enumerate(c.metadata['right_junctions']):
-                j_ivl = (j[0]-dist,j[0]+min(dist,1))
-                contig_junctions.append((c,'r',i,j_ivl))
-
-        if 'left_junctions' in c.metadata:
-            for i,j in enumerate(c.left_junctions):
-                j_ivl = (j[0]-dist,j[0]+min(dist,1))
-                contig_junctions.append((c,'l',i,j_ivl))
-
-    # extract all junction interval tuples
-    all_j_ivls = [i[3] for i in contig_junctions]
-
-    # get all the features from the intervals
-    j_ivl_to_f_ivl = get_features_at_locations(ref_genome, all_j_ivls)
-
-    # map the features back onto the junctions and save the contig objects.
-    for i, (contig, lr, j_i, j_ivl) in enumerate(contig_junctions):
-
-        if lr == 'l':
-            junction = contig.metadata['left_junctions'][j_i]
-        elif lr == 'r':
-            junction = contig.metadata['right_junctions'][j_i]
-
-        # if there exists a feature inverval that overlaps with
-        # a junction interval:
-        if j_ivl_to_f_ivl[j_ivl]:
-            named_feats = [(feat.type, feat.name) for feat in
-                    j_ivl_to_f_ivl[j_ivl] if hasattr(feat, 'name')]
-
-            if not named_feats:
-                continue
+    feature_index = get_feature_index(ref_genome)
 
-            feat_types, feat_names = zip(*named_feats)
+    for c in Contig.objects.filter(uid__in=contig_uid_list):
+        chromosome = c.metadata.get('chromosome')
+        for junctions_key in ['left_junctions', 'right_junctions']:
+            for junction in c.metadata.get(junctions_key, []):
+                j_ivl = (junction[0] - dist, junction[0] + min(dist, 1))
+                named_feats = [(feat.type, feat.name) for feat in
+                        feature_index.get_features_at_interval(
+                                j_ivl, chromosome=chromosome)
+                        if feat.name is not None]
 
-            # HACK/CRYPTIC FEATURE:
-            # If one (and only one) of the features is 'mobile_element',
-            # then show only that one.
-            if feat_types.count('mobile_element') == 1:
-                feat_names = [feat_names[feat_types.index('mobile_element')]    ]
+                if not named_feats:
+                    continue
+
+                feat_types, feat_names = zip(*named_feats)
+
+                # HACK/CRYPTIC FEATURE:
+                # If one (and only one) of the features is 'mobile_element',
+                # then show only that one.
+                if feat_types.count('mobile_element') == 1:
+                    feat_names = [
+                            feat_names[feat_types.index('mobile_element')]]
+
+                junction[4] += feat_names
+
+        c.save()
+
+
+def _main(argv):
+    """Runs the velvet pool for _run_velvet_pool_in_subprocess().
+
+    Usage:
+        python -m genome_finish.assembly loci_path processes
+    """
+    loci_path, processes = argv[1:]
+    with open(loci_path) as fh:
+        loci = json.load(fh)
+    locus_runs = [(str(locus_assembly_dir), str(reads_bam))
+            for locus_assembly_dir, reads_bam in loci['locus_runs']]
+    _run_velvet_pool(loci['velvet_opts'], locus_runs, int(processes))
 
-            junction[4] += feat_names
 
-        contig.save()
+if __name__ == '__main__':
+    _main(sys.argv)
@@ -5,24 +5,40 @@ low coverage.
 Celery tasks are here. Implementations are in assembly.py.
 """
 
+from celery import chain
 from celery import group
 from celery import task
 
+from genome_finish.assembly import assemble_sv_indicating_reads
 from genome_finish.assembly import clean_up_previous_runs_of_sv_calling_pipeline
+from genome_finish.assembly import extract_sv_indicating_reads
 from genome_finish.assembly import FAILURE_REPORT__CONTIG
 from genome_finish.assembly import FAILURE_REPORT__DETECT_DELETION
 from genome_finish.assembly import FAILURE_REPORT__PARSE_VARIANTS
 from genome_finish.assembly import generate_contigs
 from genome_finish.assembly import parse_variants_from_vcf
+from genome_finish.assembly import place_contigs
+from genome_finish.celery_task_decorator import queue_assembly_steps
 from genome_finish.celery_task_decorator import report_failure_stats
 from genome_finish.celery_task_decorator import set_assembly_status
 from genome_finish.detect_deletion import cov_detect_deletion_make_vcf
+from main.model_utils import get_dataset_with_type
 from main.models import Dataset
 from main.models import ExperimentSampleToAlignment
 from pipeline.read_alignment_util import ensure_bwa_index
 from utils.jbrowse_util import compile_tracklist_json
 from utils.jbrowse_util import prepare_jbrowse_ref_sequence
 
+# Steps run for each sample alignment. Each records its status in the data of
+# the sample alignment as it runs.
+SV_CALLING_STEPS = [
+    ExperimentSampleToAlignment.ASSEMBLY_STEP.SV_READS,
+    ExperimentSampleToAlignment.ASSEMBLY_STEP.ASSEMBLY,
+    ExperimentSampleToAlignment.ASSEMBLY_STEP.CONTIG_PLACEMENT,
+    ExperimentSampleToAlignment.ASSEMBLY_STEP.COVERAGE_DELETIONS,
+    ExperimentSampleToAlignment.ASSEMBLY_STEP.PARSE_VARIANTS
+]
+
 
 def run_de_novo_assembly_pipeline(sample_alignment_list,
         sv_read_classes={}, input_velvet_opts={},
@@ -34,35 +50,20 @@ def run_de_novo_assembly_pipeline(sample_alignment_list,
     detection to call deletions.
     """
     # First, we delete any data from previous runs of this custom SV-calling
-    # pipeline, and update the status of the sample alignments to indicate
-    # that custom SV-calling is taking place.
+    # pipeline, and queue the steps of the pipeline for the sample alignments
+    # to indicate that custom SV-calling is taking place.
 
     for sample_alignment in sample_alignment_list:
-        set_assembly_status(
-                sample_alignment,
-                ExperimentSampleToAlignment.ASSEMBLY_STATUS.CLEARING,
-                force=True)
-        clean_up_previous_runs_of_sv_calling_pipeline(sample_alignment)
-        set_assembly_status(
-                sample_alignment,
-                ExperimentSampleToAlignment.ASSEMBLY_STATUS.QUEUED, force=True)
+        _clear_and_queue_sv_calling_steps(sample_alignment)
 
     # Recompile the tracklist after deleting the indiv_tracks dirs for these
     # deleted contigs.
     ref_genome = sample_alignment_list[0].alignment_group.reference_genome
     compile_tracklist_json(ref_genome)
 
-    # Next, we ensure reference genome fasta is indexed. We do this before
-    # the async tasks.
-    ref_genome_fasta = ref_genome.dataset_set.get(
-            type=Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
-    ensure_bwa_index(ref_genome_fasta)
-    prepare_jbrowse_ref_sequence(ref_genome)
-
-    # We also make sure a fasta with all the mobile elements from the ref genome
-    # is created before running the async tasks.
-    if ref_genome.is_annotated():
-        ref_genome.ensure_mobile_element_multifasta()
+    # Next, we prepare the reference genome data shared by the async tasks
+    # before running them.
+    _prepare_reference_genome(ref_genome)
 
     # Finally we assemble the async tasks that be parallelized.
     async_result = get_sv_caller_async_result(
@@ -76,30 +77,48 @@ def single_sample_alignment_assembly(sample_alignment):
     Run the assembly pipeline without celery on a single sample_alignment.
     Used for testing & debug.
     """
+    _clear_and_queue_sv_calling_steps(sample_alignment)
+
+    ref_genome = sample_alignment.alignment_group.reference_genome
+
+    compile_tracklist_json(ref_genome)
 
+    _prepare_reference_genome(ref_genome)
+
+    generate_contigs(sample_alignment)
+    cov_detect_deletion_make_vcf(sample_alignment)
+    parse_variants_from_vcf(sample_alignment)
+
+
+def _clear_and_queue_sv_calling_steps(sample_alignment):
+    """Deletes the data of previous runs of the pipeline for the sample
+    alignment and queues each of SV_CALLING_STEPS.
+    """
     set_assembly_status(
             sample_alignment,
             ExperimentSampleToAlignment.ASSEMBLY_STATUS.CLEARING,
             force=True)
-
     clean_up_previous_runs_of_sv_calling_pipeline(sample_alignment)
+    queue_assembly_steps(sample_alignment, SV_CALLING_STEPS)
 
-    set_assembly_status(
-            sample_alignment,
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.QUEUED, force=True)
-
-    ref_genome = sample_alignment.alignment_group.reference_genome
 
-    compile_tracklist_json(ref_genome)
+def _prepare_reference_genome(ref_genome):
+    """Ensures the reference genome fasta, and the fasta of its mobile
+    elements if annotated, are indexed for bwa.
 
+    These are shared by the steps of all sample alignments, so are
+    prepared once rather than by steps that may run at the same time.
+    """
     ref_genome_fasta = ref_genome.dataset_set.get(
             type=Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
     ensure_bwa_index(ref_genome_fasta)
     prepare_jbrowse_ref_sequence(ref_genome)
 
-    generate_contigs(sample_alignment)
-    cov_detect_deletion_make_vcf(sample_alignment)
-    parse_variants_from_vcf(sample_alignment)
+    if ref_genome.is_annotated():
+        ref_genome.ensure_mobile_element_multifasta()
+        ensure_bwa_index(get_dataset_with_type(
+                ref_genome,
+                Dataset.TYPE.MOBILE_ELEMENT_FASTA).get_absolute_location())
 
 
 @task
@@ -114,28 +133,40 @@ def _chordfinisher(*args, **kwargs):
 
 
 def get_sv_caller_async_result(sample_alignment_list):
-    """Builds a celery chord that contains tasks for calling SVs for each
-    ExperimentSampleToAlignment in sample_alignment_list in parallel. Each task
-    generates vcfs, named according to the method use to call the contained
-    variants. The callback to the chord is a chain of tasks (applied
-    synchronously) that parse variants from vcfs.
+    """Builds a celery chord that calls SVs for each
+    ExperimentSampleToAlignment in sample_alignment_list in parallel.
+
+    The steps of each sample alignment form a DAG:
+
+        SV_READS -> ASSEMBLY -> CONTIG_PLACEMENT --+
+                                                   +--> PARSE_VARIANTS
+        COVERAGE_DELETIONS ------------------------+
+
+    The assembly chain and the coverage task of every sample alignment are
+    in the header of the chord, so all of them run as soon as a worker is
+    free. Each generates vcfs, named according to the method used to call
+    the contained variants. The callback to the chord parses the variants
+    from the vcfs of one sample alignment after another, as variants of an
+    alignment group can't be parsed concurrently.
 
     Returns an AsyncResult object.
     """
-    generate_contigs_tasks = []
-    cov_detect_deletion_tasks = []
+    sv_calling_tasks = []
     for sample_alignment in sorted(sample_alignment_list,
             key=lambda x: x.experiment_sample.label):
 
-        # These tasks are based on de novo assembly.
-        generate_contigs_tasks.append(
-                generate_contigs_async.si(sample_alignment))
+        # These tasks are based on de novo assembly. The result of each is
+        # passed on to the next.
+        sv_calling_tasks.append(chain(
+                extract_sv_indicating_reads_async.si(sample_alignment),
+                assemble_sv_indicating_reads_async.s(sample_alignment),
+                place_contigs_async.s(sample_alignment)))
 
         # These tasks use coverage to call large deletions.
-        cov_detect_deletion_tasks.append(
+        sv_calling_tasks.append(
                 cov_detect_deletion_make_vcf_async.si(sample_alignment))
 
-    variant_finding = group(generate_contigs_tasks + cov_detect_deletion_tasks)
+    variant_finding = group(sv_calling_tasks)
 
     sv_task_chain = (variant_finding |
             _chordfinisher.si() |
@@ -146,15 +177,29 @@ def get_sv_caller_async_result(sample_alignment_list):
 
 @task(ignore_result=False)
 @report_failure_stats(FAILURE_REPORT__CONTIG)
-def generate_contigs_async(sample_alignment,
-        sv_read_classes={}, input_velvet_opts={},
-        overwrite=True):
+def extract_sv_indicating_reads_async(sample_alignment):
+    """
+    Async wrapper for the SV read extraction step.
+    """
+    return extract_sv_indicating_reads(sample_alignment)
+
+
+@task(ignore_result=False)
+@report_failure_stats(FAILURE_REPORT__CONTIG)
+def assemble_sv_indicating_reads_async(sv_indicants_bam, sample_alignment):
+    """
+    Async wrapper for the assembly step.
+    """
+    return assemble_sv_indicating_reads(sv_indicants_bam, sample_alignment)
+
+
+@task(ignore_result=False)
+@report_failure_stats(FAILURE_REPORT__CONTIG)
+def place_contigs_async(contig_uid_list, sample_alignment):
     """
-    Async wrapper for contigs function.
+    Async wrapper for the contig placement step.
     """
-    generate_contigs(sample_alignment,
-            sv_read_classes={}, input_velvet_opts={},
-            overwrite=True)
+    place_contigs(contig_uid_list, sample_alignment)
 
 
 @task(ignore_result=False)
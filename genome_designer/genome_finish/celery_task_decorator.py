@@ -4,21 +4,135 @@ import traceback
 
 from main.models import ExperimentSampleToAlignment
 
+ASSEMBLY_STEP = ExperimentSampleToAlignment.ASSEMBLY_STEP
+ASSEMBLY_STEP_STATUS = ExperimentSampleToAlignment.ASSEMBLY_STEP_STATUS
+ASSEMBLY_STATUS = ExperimentSampleToAlignment.ASSEMBLY_STATUS
+
+# Statuses shown in the UI for running steps, in order of precedence when
+# several steps of a sample alignment are running at once.
+RUNNING_ASSEMBLY_STEP_TO_ASSEMBLY_STATUS = [
+    (ASSEMBLY_STEP.PARSE_VARIANTS, ASSEMBLY_STATUS.PARSING_VARIANTS),
+    (ASSEMBLY_STEP.SV_READS, ASSEMBLY_STATUS.ASSEMBLING),
+    (ASSEMBLY_STEP.ASSEMBLY, ASSEMBLY_STATUS.ASSEMBLING),
+    (ASSEMBLY_STEP.CONTIG_PLACEMENT, ASSEMBLY_STATUS.BUILDING_SEQUENCE_GRAPH),
+    (ASSEMBLY_STEP.COVERAGE_DELETIONS, ASSEMBLY_STATUS.ANALYZING_COVERAGE)
+]
+
 
 def set_assembly_status(sample_alignment, status, force=False):
     """Sets assembly status field.
     """
-    sample_alignment = ExperimentSampleToAlignment.objects.get(
-            uid=sample_alignment.uid)
+    def _set_status(data):
+        # Make sure assembly status is not FAILED
+        if not force:
+            assert data.get('assembly_status') != ASSEMBLY_STATUS.FAILED
+
+        # Set assembly status for UI
+        data['assembly_status'] = status
+
+    sample_alignment.update_data(_set_status)
+
+
+def get_assembly_status_from_steps(assembly_steps):
+    """Returns the ASSEMBLY_STATUS summarizing the dict from step to
+    ASSEMBLY_STEP_STATUS of a sample alignment.
+    """
+    step_statuses = assembly_steps.values()
+    if ASSEMBLY_STEP_STATUS.FAILED in step_statuses:
+        return ASSEMBLY_STATUS.FAILED
+    if all([status == ASSEMBLY_STEP_STATUS.COMPLETED
+            for status in step_statuses]):
+        return ASSEMBLY_STATUS.COMPLETED
+
+    for step, assembly_status in RUNNING_ASSEMBLY_STEP_TO_ASSEMBLY_STATUS:
+        if assembly_steps.get(step) == ASSEMBLY_STEP_STATUS.RUNNING:
+            return assembly_status
+
+    if all([status == ASSEMBLY_STEP_STATUS.COMPLETED
+            for step, status in assembly_steps.iteritems()
+            if step != ASSEMBLY_STEP.PARSE_VARIANTS]):
+        return ASSEMBLY_STATUS.WAITING_TO_PARSE
+    return ASSEMBLY_STATUS.QUEUED
+
+
+def queue_assembly_steps(sample_alignment, steps):
+    """Starts a new record of the status of each of the steps of the SV
+    calling pipeline that will run for the sample alignment.
+    """
+    def _queue_steps(data):
+        data['assembly_steps'] = dict(
+                (step, ASSEMBLY_STEP_STATUS.QUEUED) for step in steps)
+        data['assembly_status'] = get_assembly_status_from_steps(
+                data['assembly_steps'])
+
+    sample_alignment.update_data(_queue_steps)
+
+
+def set_assembly_step_status(sample_alignment, step, status,
+        required_steps=[]):
+    """Sets the status of a step of the SV calling pipeline, along with the
+    assembly status summarizing the steps.
+
+    The status is only set if all of required_steps that are recorded for
+    the sample alignment have completed.
+
+    Returns:
+        True if the status was set.
+    """
+    def _set_step_status(data):
+        assembly_steps = data.setdefault('assembly_steps', {})
+        if any([assembly_steps.get(
+                        required_step, ASSEMBLY_STEP_STATUS.COMPLETED) !=
+                ASSEMBLY_STEP_STATUS.COMPLETED
+                for required_step in required_steps]):
+            return
+        assembly_steps[step] = status
+        data['assembly_status'] = get_assembly_status_from_steps(
+                assembly_steps)
+        is_set.append(True)
 
-    # Make sure assembly status is not FAILED
-    if not force:
-        assert sample_alignment.data.get('assembly_status') != (
-                ExperimentSampleToAlignment.ASSEMBLY_STATUS.FAILED)
+    is_set = []
+    sample_alignment.update_data(_set_step_status)
+    return bool(is_set)
 
-    # Set assembly status for UI
-    sample_alignment.data['assembly_status'] = status
-    sample_alignment.save()
+
+def assembly_step(step, required_steps=[]):
+    """Decorator that records the status of a step of the SV calling pipeline
+    for the ExperimentSampleToAlignment argument of the decorated function.
+
+    The decorated function is skipped, returning None, if any of
+    required_steps did not complete, e.g. because it failed.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sample_alignment_args = [arg for arg in args if
+                    isinstance(arg, ExperimentSampleToAlignment)]
+            assert len(sample_alignment_args) == 1
+            sample_alignment = sample_alignment_args[0]
+
+            if not set_assembly_step_status(sample_alignment, step,
+                    ASSEMBLY_STEP_STATUS.RUNNING,
+                    required_steps=required_steps):
+                print ('WARNING: Skipping step {step} for Sample Alignment ' +
+                        '{uid} as a step it requires did not complete.'
+                        ).format(step=step, uid=sample_alignment.uid)
+                return
+
+            try:
+                result = func(*args, **kwargs)
+            except:
+                set_assembly_step_status(sample_alignment, step,
+                        ASSEMBLY_STEP_STATUS.FAILED)
+                raise
+
+            set_assembly_step_status(sample_alignment, step,
+                    ASSEMBLY_STEP_STATUS.COMPLETED)
+            return result
+
+        return wrapper
+    return decorator
 
 
 def get_failure_report_path(sample_alignment, report_filename):
@@ -51,7 +165,7 @@ def report_failure_stats(file_name):
                 # Set assembly status to FAILED
                 set_assembly_status(
                         sample_alignment,
-                        ExperimentSampleToAlignment.ASSEMBLY_STATUS.FAILED,
+                        ASSEMBLY_STATUS.FAILED,
                         force=True)
 
                 # Write exception with traceback to file
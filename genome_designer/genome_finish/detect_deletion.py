@@ -2,21 +2,22 @@ import os
 
 from Bio import SeqIO
 import numpy as np
-import pysam
 
 from django.conf import settings
 
-from genome_finish.celery_task_decorator import set_assembly_status
+from genome_finish.celery_task_decorator import assembly_step
 from genome_finish.constants import CUSTOM_SV_METHOD__COVERAGE
 from genome_finish.graph_contig_placement import get_fasta
-from genome_finish.millstone_de_novo_fns import get_altalign_reads
 from main.models import Dataset
 from main.models import ExperimentSampleToAlignment
-from utils.bam_utils import index_bam
+from pipeline.coverage import COVERAGE__ALTALIGNS
+from pipeline.coverage import COVERAGE__DEPTHS
+from pipeline.coverage import get_coverage_arrays
 from utils.data_export_util import export_var_dict_list_as_vcf
 from utils.import_util import add_dataset_to_entity
 
 
+@assembly_step(ExperimentSampleToAlignment.ASSEMBLY_STEP.COVERAGE_DELETIONS)
 def cov_detect_deletion_make_vcf(sample_alignment):
     """Uses coverage data to call large deletions and
     creates a VCF_COV_DETECT_DELETIONS dataset for the sample alignment
@@ -24,21 +25,6 @@ def cov_detect_deletion_make_vcf(sample_alignment):
     Args:
         sample_alignment: ExperimentSampleToAlignment instance
     """
-    # Don't proceed if processing this sample alignment previously failed or
-    # in another async process.
-    sample_alignment = ExperimentSampleToAlignment.objects.get(
-            uid=sample_alignment.uid)
-    if (sample_alignment.data.get('assembly_status') ==
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.FAILED):
-        return
-
-    # Set assembly status for UI
-    # NOTE: Setting this status is playing whack-a-mole against other async sv
-    # detection functions, e.g. assembly.generate_contigs().
-    set_assembly_status(
-                sample_alignment,
-                ExperimentSampleToAlignment.ASSEMBLY_STATUS.ANALYZING_COVERAGE)
-
     print "Generating coverage data\n"
     chrom_regions = get_deleted_regions(sample_alignment)
     var_dict_list = make_var_dict_list(
@@ -64,15 +50,6 @@ def cov_detect_deletion_make_vcf(sample_alignment):
 
         new_dataset.save()
 
-    # Update status again if not FAILED.
-    sample_alignment = ExperimentSampleToAlignment.objects.get(
-            uid=sample_alignment.uid)
-    if (sample_alignment.data.get('assembly_status') !=
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.FAILED):
-        set_assembly_status(
-                sample_alignment,
-                ExperimentSampleToAlignment.ASSEMBLY_STATUS.WAITING_TO_PARSE)
-
 
 def make_var_dict_list(chrom_regions, ref_fasta):
 
@@ -101,12 +78,12 @@ def get_deleted_regions(
         sample_alignment,
         cov_cutoff=settings.COVDEL_CUTOFF):
 
-    chrom_to_cov_list = per_base_cov_stats_opt(sample_alignment)
+    coverage_arrays = get_coverage_arrays(sample_alignment)
 
     chrom_regions = {}
-    for chrom, cov_dict in chrom_to_cov_list.items():
-        depths = cov_dict['depths']
-        altaligns = cov_dict['altaligns']
+    for chrom, cov_dict in coverage_arrays.items():
+        depths = cov_dict[COVERAGE__DEPTHS]
+        altaligns = cov_dict[COVERAGE__ALTALIGNS]
         unique = depths - altaligns
 
         # Use COVDEL_CUTOFF_PCT of mean unique coverage, or COVDEL_CUTOFF,
@@ -215,90 +192,3 @@ def smoothed_deletions(unique_arr, low_cov_regions):
             i += 1
 
     return regions
-
-
-def make_altalign_dataset(sample_alignment):
-
-    sample_alignment_bam = sample_alignment.dataset_set.get(
-                type=Dataset.TYPE.BWA_ALIGN).get_absolute_location()
-    alignment_file_prefix = os.path.join(
-        sample_alignment.get_model_data_dir(),
-        'bwa_align')
-    altalign_bam = '.'.join([
-                alignment_file_prefix,
-                'altalign',
-                'bam'
-                ])
-    get_altalign_reads(sample_alignment_bam, altalign_bam)
-
-    return add_dataset_to_entity(
-                sample_alignment,
-                Dataset.TYPE.BWA_ALTALIGN,
-                Dataset.TYPE.BWA_ALTALIGN,
-                filesystem_location=altalign_bam)
-
-
-def per_base_cov_stats_opt(sample_alignment):
-
-    sample_alignment_bam = sample_alignment.dataset_set.get(
-            type=Dataset.TYPE.BWA_ALIGN).get_absolute_location()
-    bamfile = pysam.AlignmentFile(sample_alignment_bam, 'rb')
-
-    chrom_list = bamfile.references
-    chrom_lens = bamfile.lengths
-    c_starts = [0] * len(chrom_list)
-    c_ends = chrom_lens
-
-    chrom_to_cov_list = {}
-
-    for chrom, c_start, c_end in zip(chrom_list, c_starts, c_ends):
-
-        depth_arr = np.zeros(c_end)
-        for pileup_col in bamfile.pileup(chrom,
-                start=c_start, end=c_end, truncate=True):
-
-            # number of segments aligned to this position
-            depth = pileup_col.nsegments
-            depth_arr[pileup_col.reference_pos] = depth
-
-        chrom_to_cov_list[chrom] = {
-                'depths': depth_arr
-        }
-
-
-    # Do altaligns
-    altalign_dataset_query = sample_alignment.dataset_set.filter(
-            type=Dataset.TYPE.BWA_ALTALIGN)
-
-    if altalign_dataset_query.count():
-        assert altalign_dataset_query.count() == 1
-        altalign_dataset = altalign_dataset_query[0]
-    else:
-        print "Writing bam dataset of alternative alignment reads\n"
-        altalign_dataset = make_altalign_dataset(sample_alignment)
-
-    altalign_bam_path = altalign_dataset.get_absolute_location()
-    index_bam(altalign_bam_path)
-
-    bamfile = pysam.AlignmentFile(
-            altalign_dataset.get_absolute_location(), 'rb')
-
-    chrom_list = bamfile.references
-    chrom_lens = bamfile.lengths
-    c_starts = [0] * len(chrom_list)
-    c_ends = chrom_lens
-
-
-    for chrom, c_start, c_end in zip(chrom_list, c_starts, c_ends):
-        depth_arr = np.zeros(c_end)
-
-        for pileup_col in bamfile.pileup(chrom,
-                start=c_start, end=c_end, truncate=True):
-
-            # number of segments aligned to this position
-            depth = pileup_col.nsegments
-            depth_arr[pileup_col.reference_pos] = depth
-
-        chrom_to_cov_list[chrom]['altaligns'] = depth_arr
-
-    return chrom_to_cov_list
@@ -1,7 +1,10 @@
+from bisect import bisect_left
 from collections import namedtuple, OrderedDict
+import itertools
 import os
 import subprocess
 import shutil
+import threading
 
 from Bio import SeqIO
 from django.conf import settings
@@ -13,7 +16,6 @@ from genome_finish.millstone_de_novo_fns import get_coverage_stats
 from genome_finish.insertion_placement_read_trkg import simple_align_with_bwa_mem
 from main.models import Contig
 from main.models import Dataset
-from main.models import ExperimentSampleToAlignment
 from main.model_utils import get_dataset_with_type
 from pipeline.read_alignment_util import ensure_bwa_index
 from utils.import_util import add_dataset_to_entity
@@ -116,10 +118,6 @@ def graph_contig_placement(contig_uid_list, skip_extracted_read_alignment,
     contig_list.sort(key=_length_weighted_coverage, reverse=True)
 
     sample_alignment = contig_list[0].experiment_sample_to_alignment
-    sample_alignment.data['assembly_status'] = (
-            ExperimentSampleToAlignment.ASSEMBLY_STATUS.BUILDING_SEQUENCE_GRAPH
-    )
-    sample_alignment.save()
 
     ref_genome = sample_alignment.alignment_group.reference_genome
 
@@ -139,23 +137,20 @@ def graph_contig_placement(contig_uid_list, skip_extracted_read_alignment,
     contigs_as_ordered_dict = OrderedDict(
             [(c.uid, c) for c in contig_list])
 
-    # Concatenate contig fastas for alignment
+    # Concatenate contig fastas for alignment, and create a dictionary to
+    # translate the contig fasta record names to contig uids
     contig_concat = os.path.join(contig_alignment_dir, 'contig_concat.fa')
+    contig_qname_to_uid = {}
     with open(contig_concat, 'w') as output_fh:
         for contig_uid, c in contigs_as_ordered_dict.iteritems():
-            contig_fasta_file = get_fasta(c)
-            with open(contig_fasta_file) as read_fh:
-                output_fh.write(read_fh.read())
-
-    # Create dictionaries to translate contig uid to its fasta descriptor line
-    contig_qname_to_uid = {}
-    for contig_uid, c in contigs_as_ordered_dict.items():
-        contig_fasta_file = get_fasta(c)
-        with open(contig_fasta_file, 'r') as fh:
-            descriptor = fh.next()
-            contig_qname_to_uid[descriptor.strip('>\n')] = contig_uid
-
-    # Get extracted mobile elements in addition to contigs
+            contig_seqrecord = c.get_fasta_seqrecord()
+            SeqIO.write([contig_seqrecord], output_fh, 'fasta')
+            contig_qname_to_uid[contig_seqrecord.id] = contig_uid
+
+    # Get extracted mobile elements in addition to contigs. The contigs are
+    # aligned to them in a thread, alongside the alignment to the reference.
+    me_alignment_thread = None
+    me_alignment_errors = []
     if ref_genome.is_annotated():
         me_fa_dataset = get_dataset_with_type(
                 ref_genome,
@@ -167,21 +162,36 @@ def graph_contig_placement(contig_uid_list, skip_extracted_read_alignment,
 
         if not os.path.exists(contig_alignment_to_me_bam):
             ensure_bwa_index(me_concat_fasta)
-            simple_align_with_bwa_mem(
-                    contig_concat,
-                    me_concat_fasta,
-                    contig_alignment_to_me_bam,
-                    ['-T', '15'])
+
+            def _align_contigs_to_me():
+                try:
+                    simple_align_with_bwa_mem(
+                            contig_concat,
+                            me_concat_fasta,
+                            contig_alignment_to_me_bam,
+                            ['-T', '15'])
+                except Exception as exc:
+                    me_alignment_errors.append(exc)
+
+            me_alignment_thread = threading.Thread(
+                    target=_align_contigs_to_me)
+            me_alignment_thread.start()
 
     # Align concatenated contig fastas to reference
     contig_alignment_bam = os.path.join(
             contig_alignment_dir, 'contig_alignment.bam')
     print 'Aligning contigs to reference'
-    simple_align_with_bwa_mem(
-            contig_concat,
-            get_fasta(ref_genome),
-            contig_alignment_bam,
-            ['-T', '15'])
+    try:
+        simple_align_with_bwa_mem(
+                contig_concat,
+                get_fasta(ref_genome),
+                contig_alignment_bam,
+                ['-T', '15'])
+    finally:
+        if me_alignment_thread is not None:
+            me_alignment_thread.join()
+    if me_alignment_errors:
+        raise me_alignment_errors[0]
 
     # Create graph
     G = nx.DiGraph()
@@ -210,8 +220,11 @@ def graph_contig_placement(contig_uid_list, skip_extracted_read_alignment,
 
     detect_strand_chromosome_junctions(contig_qname_to_uid, contig_alignment_bam)
 
+    # The walks share one index of the neighbors of each vertex.
+    graph_index = SequenceGraphIndex(G)
+
     placeable_contig_uid_list = []
-    iv_list = novel_seq_ins_walk(G)
+    iv_list = novel_seq_ins_walk(G, graph_index)
     if use_alignment_reads:
         coverage_stats = get_coverage_stats(sample_alignment)
         sample_alignment_bam = sample_alignment.dataset_set.get(
@@ -247,7 +260,7 @@ def graph_contig_placement(contig_uid_list, skip_extracted_read_alignment,
     # Perform translocation walk
     if ref_genome.num_chromosomes == 1:
 
-        trans_iv_pairs = translocation_walk(G)
+        trans_iv_pairs = translocation_walk(G, graph_index)
         var_dict_list = [parse_path_into_ref_alt(iv_pair, contig_qname_to_uid,
                 sample_alignment)
                 for iv_pair in trans_iv_pairs]
@@ -256,7 +269,7 @@ def graph_contig_placement(contig_uid_list, skip_extracted_read_alignment,
                 if any([var_d['ref_seq'], var_d['alt_seq']])]
 
         if ref_genome.is_annotated():
-            me_trans_iv_pairs = me_translocation_walk(G)
+            me_trans_iv_pairs = me_translocation_walk(G, graph_index)
 
             me_var_dict_list = [parse_path_into_ref_alt(
                     iv_pair, contig_qname_to_uid,
@@ -537,27 +550,72 @@ def set_contig_placement_params(contig, insertion_vertices):
     contig.save()
 
 
-def novel_seq_ins_walk(G):
-    """Walk the graph and return InsertionVertices objects corresponding to
-    ref - contig - contig - ref paths that represent novel sequence insertions
-    """
+class SequenceGraphIndex(object):
+    """Neighbors of the vertices of sequence graph G, partitioned by the kind
+    of sequence they are on.
 
-    ref_seq_uid = G.ref_intervals.vertices[0].seq_uid
-    contig_seq_uid_set = set(ci.seq_uid for ci in
-            G.contig_intervals_list.values())
+    The graph walks look up the reference, mobile element and contig
+    neighbors of vertices many times, so they are sorted out once here rather
+    than by filtering all neighbors by seq_uid on each lookup. The order of
+    G.neighbors() is kept within each kind.
+    """
 
-    def ref_neighbors(vert):
-        return [v for v in G.neighbors(vert) if v.seq_uid == ref_seq_uid]
+    def __init__(self, G):
+        self.ref_seq_uid = G.ref_intervals.seq_uid
+        self.contig_seq_uid_set = set(ci.seq_uid for ci in
+                G.contig_intervals_list.values())
+        self.me_seq_uid_set = set(si.seq_uid for si in
+                getattr(G, 'me_interval_dict', {}).values())
+
+        self._ref_neighbors = {}
+        self._ref_or_me_neighbors = {}
+        self._contig_neighbors = {}
+        for vert in G:
+            ref_neighbors = []
+            ref_or_me_neighbors = []
+            contig_neighbors = []
+            for v in G.neighbors(vert):
+                if v.seq_uid == self.ref_seq_uid:
+                    ref_neighbors.append(v)
+                    ref_or_me_neighbors.append(v)
+                elif v.seq_uid in self.me_seq_uid_set:
+                    ref_or_me_neighbors.append(v)
+                elif v.seq_uid in self.contig_seq_uid_set:
+                    contig_neighbors.append(v)
+            self._ref_neighbors[vert] = ref_neighbors
+            self._ref_or_me_neighbors[vert] = ref_or_me_neighbors
+            self._contig_neighbors[vert] = contig_neighbors
+
+    def ref_neighbors(self, vert, include_me=False):
+        """Returns the neighbors of vert on the reference, and also those on
+        mobile elements if include_me is True.
+        """
+        if include_me:
+            return self._ref_or_me_neighbors.get(vert, [])
+        return self._ref_neighbors.get(vert, [])
+
+    def contig_neighbors(self, vert):
+        return self._contig_neighbors.get(vert, [])
+
+
+def novel_seq_ins_walk(G, graph_index=None):
+    """Walk the graph and return InsertionVertices objects corresponding to
+    ref - contig - contig - ref paths that represent novel sequence insertions
 
-    def contig_neighbors(vert):
-        return [v for v in G.neighbors(vert) if
-                v.seq_uid in contig_seq_uid_set]
+    Args:
+        G: networkx.DiGraph representation of sequence graph
+        graph_index: Optional SequenceGraphIndex of G, to share between walks.
+    """
+    if graph_index is None:
+        graph_index = SequenceGraphIndex(G)
+    ref_neighbors = graph_index.ref_neighbors
+    contig_neighbors = graph_index.contig_neighbors
 
     iv_list = []
     for exit_ref in G.ref_intervals.vertices:
         for enter_contig in contig_neighbors(exit_ref):
             queue = [enter_contig]
-            visited = []
+            visited = set()
             while queue:
                 exit_contig = queue.pop()
                 for enter_ref in ref_neighbors(exit_contig):
@@ -569,7 +627,7 @@ def novel_seq_ins_walk(G):
                                 exit_ref, enter_contig, exit_contig,
                                 enter_ref))
                         break
-                visited.append(exit_contig)
+                visited.add(exit_contig)
 
                 extend_items = []
                 for n in contig_neighbors(exit_contig):
@@ -581,13 +639,14 @@ def novel_seq_ins_walk(G):
     return iv_list
 
 
-def me_translocation_walk(G):
+def me_translocation_walk(G, graph_index=None):
     """Walk the graph and return InsertionVertices tuples corresponding to
     ref - contig - contig - ME - ME - contig - contig - ref paths that
     represent mobile element insertions
 
     Args:
         G: networkx.DiGraph representation of sequence graph
+        graph_index: Optional SequenceGraphIndex of G, to share between walks.
 
     Returns:
         filtered: (InsertionVertices, InsertionVertices) tuples corresponding
@@ -596,37 +655,26 @@ def me_translocation_walk(G):
 
     assert hasattr(G, 'me_interval_dict')
 
-    ref_seq_uid_set = set([G.ref_intervals.seq_uid])
-
-    me_seq_uid_set = set(si.seq_uid for si in G.me_interval_dict.values())
-    ref_seq_uid_set = ref_seq_uid_set | me_seq_uid_set
-
-    contig_seq_uid_set = set(ci.seq_uid for ci in
-            G.contig_intervals_list.values())
+    if graph_index is None:
+        graph_index = SequenceGraphIndex(G)
+    me_seq_uid_set = graph_index.me_seq_uid_set
+    contig_neighbors = graph_index.contig_neighbors
 
     def ref_neighbors(vert):
-        if vert not in G:
-            return []
-        return [v for v in G.neighbors(vert) if v.seq_uid in ref_seq_uid_set]
-
-    def contig_neighbors(vert):
-        if vert not in G:
-            return []
-        return [v for v in G.neighbors(vert) if v.seq_uid in
-                contig_seq_uid_set]
+        return graph_index.ref_neighbors(vert, include_me=True)
 
     forward_edges = []
     back_edges = []
 
     # get a list of vertices across all mobile elements
-    me_vertices = reduce(lambda x, y: x + y,
-            [si.vertices for si in G.me_interval_dict.values()])
+    me_vertices = list(itertools.chain.from_iterable(
+            si.vertices for si in G.me_interval_dict.values()))
 
     dset = set()
     for exit_ref in G.ref_intervals.vertices + me_vertices:
         for enter_contig in contig_neighbors(exit_ref):
             queue = set([enter_contig])
-            visited = []
+            visited = set()
             while queue:
                 exit_contig = queue.pop()
                 for enter_ref in ref_neighbors(exit_contig):
@@ -641,7 +689,7 @@ def me_translocation_walk(G):
                     else:
                         back_edges.append(iv)
 
-                visited.append(exit_contig)
+                visited.add(exit_contig)
                 queue.update([n for n in contig_neighbors(exit_contig)
                         if n not in visited])
 
@@ -780,13 +828,14 @@ def match_region_filter(G, me_iv_pairs):
     return filtered.values()
 
 
-def translocation_walk(G):
+def translocation_walk(G, graph_index=None):
     """Walk the graph and return InsertionVertices tuples corresponding to
     ref - contig - contig - ref - ref - contig - contig - ref paths that
     represent translocations within the reference
 
     Args:
         G: networkx.DiGraph representation of sequence graph
+        graph_index: Optional SequenceGraphIndex of G, to share between walks.
 
     Returns:
         filtered: (InsertionVertices, InsertionVertices) tuples corresponding
@@ -795,19 +844,10 @@ def translocation_walk(G):
 
     ref_seq_uid_set = set([G.ref_intervals.seq_uid])
 
-    contig_seq_uid_set = set(ci.seq_uid for ci in
-            G.contig_intervals_list.values())
-
-    def ref_neighbors(vert):
-        if vert not in G:
-            return []
-        return [v for v in G.neighbors(vert) if v.seq_uid in ref_seq_uid_set]
-
-    def contig_neighbors(vert):
-        if vert not in G:
-            return []
-        return [v for v in G.neighbors(vert) if v.seq_uid in
-                contig_seq_uid_set]
+    if graph_index is None:
+        graph_index = SequenceGraphIndex(G)
+    ref_neighbors = graph_index.ref_neighbors
+    contig_neighbors = graph_index.contig_neighbors
 
     forward_edges = []
     back_edges = []
@@ -816,7 +856,7 @@ def translocation_walk(G):
     for exit_ref in G.ref_intervals.vertices:
         for enter_contig in contig_neighbors(exit_ref):
             queue = set([enter_contig])
-            visited = []
+            visited = set()
             while queue:
                 exit_contig = queue.pop()
                 for enter_ref in ref_neighbors(exit_contig):
@@ -831,7 +871,7 @@ def translocation_walk(G):
                     else:
                         back_edges.append(iv)
 
-                visited.append(exit_contig)
+                visited.add(exit_contig)
                 queue.update([n for n in contig_neighbors(exit_contig)
                         if n not in visited])
 
@@ -909,6 +949,11 @@ class SequenceVertex(object):
 
 
 class SequenceIntervals:
+    """The vertices along a sequence, sorted by position.
+
+    The positions of the vertices are kept in a parallel sorted list, so that
+    vertices are found by bisection.
+    """
 
     def __init__(self, seq_uid, length, tag=None):
         self.seq_uid = seq_uid
@@ -916,17 +961,21 @@ class SequenceIntervals:
         self.length = length
         self.vertices = [SequenceVertex(seq_uid, 0, self),
                          SequenceVertex(seq_uid, length, self)]
+        self.positions = [0, length]
 
     def insert_vertex(self, pos):
-        for i, vertex in enumerate(self.vertices):
-            if vertex.pos < pos:
-                continue
-            elif vertex.pos == pos:
-                return vertex
-            elif vertex.pos > pos:
-                new_vertex = SequenceVertex(self.seq_uid, pos, self)
-                self.vertices.insert(i, new_vertex)
-                return new_vertex
+        """Returns the vertex at pos, creating it if there isn't one yet.
+        Returns None if pos is past the end of the sequence.
+        """
+        i = bisect_left(self.positions, pos)
+        if i == len(self.positions):
+            return None
+        if self.positions[i] == pos:
+            return self.vertices[i]
+        new_vertex = SequenceVertex(self.seq_uid, pos, self)
+        self.vertices.insert(i, new_vertex)
+        self.positions.insert(i, pos)
+        return new_vertex
 
     def blank_copy(self):
         return SequenceIntervals(self.seq_uid, self.length, self.tag)
@@ -1039,9 +1088,7 @@ def parse_path_into_ref_alt(path_list, contig_qname_to_uid,
         contig_qname = enter_vert.seq_uid
         contig_uid = contig_qname_to_uid[contig_qname]
         contig = Contig.objects.get(uid=contig_uid)
-        contig_fasta = get_fasta(contig)
-        with open(contig_fasta) as fh:
-            contig_seqrecord = SeqIO.parse(fh, 'fasta').next()
+        contig_seqrecord = contig.get_fasta_seqrecord()
 
         # Determine whether contig is reverse complement relative to reference
         is_reverse = contig.metadata.get('is_reverse', False)
@@ -76,6 +76,7 @@ def extract_contig_reads(contig, read_category='all'):
            assembly_dir]
     cmd = ' '.join(cmd)
 
+    contig.ensure_model_data_dir_exists()
     contig_reads_fasta = os.path.join(
             contig.get_model_data_dir(),
             'extracted_reads.fa')
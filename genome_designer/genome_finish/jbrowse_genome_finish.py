@@ -20,6 +20,8 @@ from utils.jbrowse_util import write_tracklist_json
 def maybe_create_reads_to_contig_bam(contig):
     if not contig.dataset_set.filter(
             type=Dataset.TYPE.BWA_ALIGN).exists():
+        # JBrowse and bwa take a fasta of only the contig.
+        contig.ensure_fasta_file()
         prepare_jbrowse_ref_sequence(contig)
         align_contig_reads_to_contig(contig)
 
@@ -93,8 +95,7 @@ def align_contig_reads_to_contig(contig):
                         out_fh.write(in_fh.next())
 
     # Align fastqs to contig fasta
-    contig_fasta = contig.dataset_set.get(
-            type=Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
+    contig_fasta = contig.ensure_fasta_file()
     contig_reads_to_contig_bam = os.path.join(
             contig.get_model_data_dir(),
             'reads_to_contig.bam')
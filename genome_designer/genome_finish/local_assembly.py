@@ -0,0 +1,174 @@
+"""
+Clustering of SV-indicating reads into loci that are assembled separately.
+
+Read pairs are anchored at the positions where their reads, or the mates of
+their unmapped reads, align. Anchors close to each other on a chromosome are
+clustered, and clusters that enough read pairs join, such as the two sides of
+a translocation, make up one locus. Each locus gets a bam of its read pairs,
+for an assembly of its own.
+"""
+
+from collections import defaultdict
+from collections import namedtuple
+import os
+
+from django.conf import settings
+import pysam
+
+# Number of locus bams written in each pass over the SV-indicating reads, to
+# stay clear of the limit on open files.
+LOCUS_BAMS_PER_PASS = 200
+
+AssemblyLocus = namedtuple('AssemblyLocus',
+        ['assembly_dir', 'reads_bam', 'regions'])
+
+
+def split_reads_into_loci(sv_indicants_bam, output_dir, max_gap=None,
+        max_locus_size=None, min_read_pairs=None):
+    """Clusters the read pairs of the name-sorted bam into loci and writes
+    a bam of the read pairs of each locus.
+
+    Read pairs with no aligned read, and so no anchor, are left out.
+
+    Args:
+        sv_indicants_bam: Name-sorted bam of SV-indicating read pairs.
+        output_dir: Directory in which a directory is made for each locus.
+        max_gap: Anchors closer than this are clustered. Defaults to
+            settings.LOCAL_ASSEMBLY_MAX_GAP.
+        max_locus_size: Clusters are split at this length. Defaults to
+            settings.LOCAL_ASSEMBLY_MAX_LOCUS_SIZE.
+        min_read_pairs: Read pairs needed to join two clusters, and to
+            assemble a locus. Defaults to
+            settings.LOCAL_ASSEMBLY_MIN_READ_PAIRS.
+
+    Returns:
+        List of AssemblyLocus, with regions as a list of
+        (chromosome, start, end) tuples spanned by the anchors of the locus.
+    """
+    if max_gap is None:
+        max_gap = settings.LOCAL_ASSEMBLY_MAX_GAP
+    if max_locus_size is None:
+        max_locus_size = settings.LOCAL_ASSEMBLY_MAX_LOCUS_SIZE
+    if min_read_pairs is None:
+        min_read_pairs = settings.LOCAL_ASSEMBLY_MIN_READ_PAIRS
+
+    bamfile = pysam.AlignmentFile(sv_indicants_bam, 'rb')
+    anchors = []
+    for pair_idx, reads in enumerate(_iter_read_pairs(bamfile)):
+        for (reference_id, pos) in _get_anchors(reads):
+            anchors.append((reference_id, pos, pair_idx))
+    references = bamfile.references
+    bamfile.close()
+
+    # Cluster the anchors of each chromosome by position.
+    anchors.sort()
+    cluster_regions = []
+    pair_clusters = defaultdict(set)
+    for (reference_id, pos, pair_idx) in anchors:
+        if (not cluster_regions or
+                cluster_regions[-1][0] != reference_id or
+                pos - cluster_regions[-1][2] > max_gap or
+                pos - cluster_regions[-1][1] > max_locus_size):
+            cluster_regions.append([reference_id, pos, pos])
+        cluster_regions[-1][2] = pos
+        pair_clusters[pair_idx].add(len(cluster_regions) - 1)
+
+    # Join clusters linked by enough read pairs into loci.
+    link_counts = defaultdict(int)
+    for clusters in pair_clusters.itervalues():
+        clusters = sorted(clusters)
+        for i, cluster in enumerate(clusters):
+            for other_cluster in clusters[i + 1:]:
+                link_counts[(cluster, other_cluster)] += 1
+    cluster_to_locus = range(len(cluster_regions))
+
+    def _find_locus(cluster):
+        while cluster_to_locus[cluster] != cluster:
+            cluster_to_locus[cluster] = cluster_to_locus[
+                    cluster_to_locus[cluster]]
+            cluster = cluster_to_locus[cluster]
+        return cluster
+
+    for (cluster, other_cluster), count in link_counts.iteritems():
+        if count >= min_read_pairs:
+            cluster_to_locus[_find_locus(other_cluster)] = _find_locus(cluster)
+
+    pair_loci = {}
+    locus_pair_counts = defaultdict(int)
+    for pair_idx, clusters in pair_clusters.iteritems():
+        loci = set([_find_locus(cluster) for cluster in clusters])
+        pair_loci[pair_idx] = loci
+        for locus in loci:
+            locus_pair_counts[locus] += 1
+
+    locus_regions = defaultdict(list)
+    for cluster, (reference_id, start, end) in enumerate(cluster_regions):
+        locus_regions[_find_locus(cluster)].append(
+                (references[reference_id], start, end))
+
+    assembly_loci = {}
+    for locus in sorted(locus_pair_counts):
+        if locus_pair_counts[locus] < min_read_pairs:
+            continue
+        locus_dir = os.path.join(output_dir,
+                'locus_%d' % len(assembly_loci))
+        os.mkdir(locus_dir)
+        assembly_loci[locus] = AssemblyLocus(
+                assembly_dir=locus_dir,
+                reads_bam=os.path.join(locus_dir, 'reads.bam'),
+                regions=locus_regions[locus])
+
+    _write_locus_bams(sv_indicants_bam, pair_loci, assembly_loci)
+
+    return [assembly_loci[locus] for locus in sorted(assembly_loci)]
+
+
+def _write_locus_bams(sv_indicants_bam, pair_loci, assembly_loci):
+    """Writes the read pairs of each locus to its bam, keeping them in the
+    name-sorted order that velvet expects of paired reads.
+    """
+    loci = sorted(assembly_loci)
+    for batch_start in range(0, len(loci), LOCUS_BAMS_PER_PASS):
+        bamfile = pysam.AlignmentFile(sv_indicants_bam, 'rb')
+        locus_bamfiles = dict(
+                (locus, pysam.AlignmentFile(
+                        assembly_loci[locus].reads_bam, 'wb',
+                        template=bamfile))
+                for locus in loci[batch_start:
+                        batch_start + LOCUS_BAMS_PER_PASS])
+
+        for pair_idx, reads in enumerate(_iter_read_pairs(bamfile)):
+            for locus in pair_loci.get(pair_idx, []):
+                if locus in locus_bamfiles:
+                    for read in reads:
+                        locus_bamfiles[locus].write(read)
+
+        for locus_bamfile in locus_bamfiles.itervalues():
+            locus_bamfile.close()
+        bamfile.close()
+
+
+def _iter_read_pairs(bamfile):
+    """Yields lists of the consecutive reads sharing a query name.
+    """
+    reads = []
+    for read in bamfile:
+        if reads and read.query_name != reads[0].query_name:
+            yield reads
+            reads = []
+        reads.append(read)
+    if reads:
+        yield reads
+
+
+def _get_anchors(reads):
+    """Returns the set of (reference_id, position) where the reads of a pair
+    align, using the mate position for unmapped reads.
+    """
+    anchors = set()
+    for read in reads:
+        if not read.is_unmapped:
+            anchors.add((read.reference_id, read.reference_start))
+        elif not read.mate_is_unmapped:
+            anchors.add((read.next_reference_id, read.next_reference_start))
+    return anchors
@@ -7,10 +7,13 @@ import pysam
 
 from genome_finish import __path__ as gf_path_list
 from genome_finish.insertion_placement_read_trkg import extract_left_and_right_clipped_read_dicts
-from main.models import Dataset
 from main.models import Variant
 from main.models import VariantSet
+from pipeline.coverage import COVERAGE__DEPTHS
+from pipeline.coverage import get_coverage_arrays
+from pipeline.read_alignment_util import is_altalign_read
 from utils.bam_utils import clipping_stats
+from utils.bam_utils import filter_bam_file
 from variants.variant_sets import update_variant_in_set_memberships
 
 GENOME_FINISH_PATH = gf_path_list[0]
@@ -19,18 +22,7 @@ VELVETG_BINARY = settings.TOOLS_DIR + '/velvet/velvetg'
 
 
 def get_altalign_reads(input_bam_path, output_bam_path, xs_threshold=None):
-    input_af = pysam.AlignmentFile(input_bam_path, 'rb')
-    output_af = pysam.AlignmentFile(output_bam_path, 'wb',
-                template=input_af)
-
-    for read in input_af:
-        if read.has_tag('XS') and read.has_tag('AS'):
-            if read.get_tag('AS') <= read.get_tag('XS'):
-                output_af.write(read)
-
-    output_af.close()
-    input_af.close()
-
+    filter_bam_file(input_bam_path, is_altalign_read, output_bam_path)
 
 
 def get_piled_reads(input_bam_path, output_bam_path,
@@ -73,7 +65,16 @@ def get_clipped_reads_smart(input_bam_path, output_bam_path,
     """Gets reads not overlapping their adaptor with a terminal
     segment of clipping with average phred scores above the cutoff
     """
+    filter_bam_file(input_bam_path,
+            make_clipped_read_filter(clipping_threshold, phred_encoding),
+            output_bam_path)
+
 
+def make_clipped_read_filter(clipping_threshold=8, phred_encoding=None):
+    """Returns a function that tells whether a read has a terminal segment
+    of more than clipping_threshold clipped bases with average phred score
+    above the cutoff. See get_clipped_reads_smart().
+    """
     phred_encoding_to_shift = {
         'Illumina 1.5': 31,
         'Sanger / Illumina 1.9': 0
@@ -89,17 +90,13 @@ def get_clipped_reads_smart(input_bam_path, output_bam_path,
     HARD_CLIP = 5
     CLIP = [SOFT_CLIP, HARD_CLIP]
 
-    input_af = pysam.AlignmentFile(input_bam_path, 'rb')
-    output_af = pysam.AlignmentFile(output_bam_path, 'wb',
-                template=input_af)
-
-    for read in input_af:
+    def is_clipped_read(read):
         # If no cigartuples, i.e. unmapped, continue
         if read.cigartuples is None:
-            continue
+            return False
 
         if read.is_secondary or read.is_supplementary:
-            continue
+            return False
 
         # TODO: Account for template length
         # adapter_overlap = max(read.template_length - query_alignment_length, 0)
@@ -110,21 +107,18 @@ def get_clipped_reads_smart(input_bam_path, output_bam_path,
         right_clipping = (read.cigartuples[-1][1]
                 if read.cigartuples[-1][0] in CLIP else 0)
 
-        # Write reads to file if clipped bases have average phred score
-        # above cutoff
+        # Keep reads if clipped bases have average phred score above cutoff
         if left_clipping > clipping_threshold:
             clipped_phred_scores = read.query_qualities[:left_clipping]
             if np.mean(clipped_phred_scores) > CLIPPED_AVG_PHRED_CUTOFF:
-                output_af.write(read)
-                continue
+                return True
         if right_clipping > clipping_threshold:
             clipped_phred_scores = read.query_qualities[-right_clipping:]
             if np.mean(clipped_phred_scores) > CLIPPED_AVG_PHRED_CUTOFF:
-                output_af.write(read)
-                continue
+                return True
+        return False
 
-    output_af.close()
-    input_af.close()
+    return is_clipped_read
 
 
 def get_unmapped_reads(bam_filename, output_filename, avg_phred_cutoff=None):
@@ -148,6 +142,10 @@ def get_unmapped_reads(bam_filename, output_filename, avg_phred_cutoff=None):
                 avg_phred_cutoff)
 
 
+def is_unmapped_read(read):
+    return read.is_unmapped
+
+
 def add_paired_mates(input_bam_path, source_bam_filename, output_bam_path):
 
     bam_file = pysam.AlignmentFile(input_bam_path)
@@ -289,25 +287,16 @@ def get_coverage_stats(sample_alignment):
     if maybe_chrom_cov_dict is not None:
         return maybe_chrom_cov_dict
 
-    bam_path = sample_alignment.dataset_set.get(type=Dataset.TYPE.BWA_ALIGN).get_absolute_location()
-    alignment_af = pysam.AlignmentFile(bam_path)
-    chrom_list = alignment_af.references
-    chrom_lens = alignment_af.lengths
-
-    c_starts = [0]*len(chrom_list)
-    c_ends = chrom_lens
+    coverage_arrays = get_coverage_arrays(sample_alignment)
+    chrom_list = coverage_arrays.keys()
+    chrom_lens = []
 
+    # Stats are over the covered positions.
     chrom_cov_lists = []
-    for chrom, c_start, c_end in zip(chrom_list, c_starts, c_ends):
-
-        chrom_cov_lists.append([])
-        cov_list = chrom_cov_lists[-1]
-        for pileup_col in alignment_af.pileup(chrom,
-                start=c_start, end=c_end, truncate=True):
-
-            depth = pileup_col.nsegments
-            cov_list.append(depth)
-    alignment_af.close()
+    for chrom in chrom_list:
+        depths = coverage_arrays[chrom][COVERAGE__DEPTHS]
+        chrom_lens.append(len(depths))
+        chrom_cov_lists.append(depths[depths > 0])
 
     sub_dict_tup_list = zip(
             chrom_lens,
@@ -320,8 +309,10 @@ def get_coverage_stats(sample_alignment):
 
     chrom_cov_dict = dict(zip(chrom_list, sub_dict_list))
 
-    sample_alignment.data['chrom_cov_dict'] = chrom_cov_dict
-    sample_alignment.save()
+    # Other steps of the SV calling pipeline may update the data of the
+    # sample alignment at the same time.
+    sample_alignment.update_data(
+            lambda data: data.update({'chrom_cov_dict': chrom_cov_dict}))
     return chrom_cov_dict
 
 
@@ -0,0 +1,62 @@
+"""
+Tests for celery_task_decorator.py.
+"""
+
+from django.test import TestCase
+
+from genome_finish.celery_task_decorator import get_assembly_status_from_steps
+from main.models import ExperimentSampleToAlignment
+
+ASSEMBLY_STEP = ExperimentSampleToAlignment.ASSEMBLY_STEP
+ASSEMBLY_STEP_STATUS = ExperimentSampleToAlignment.ASSEMBLY_STEP_STATUS
+ASSEMBLY_STATUS = ExperimentSampleToAlignment.ASSEMBLY_STATUS
+
+
+class TestGetAssemblyStatusFromSteps(TestCase):
+
+    def setUp(self):
+        self.assembly_steps = dict(
+                (step, ASSEMBLY_STEP_STATUS.QUEUED) for step in [
+                        ASSEMBLY_STEP.SV_READS,
+                        ASSEMBLY_STEP.ASSEMBLY,
+                        ASSEMBLY_STEP.CONTIG_PLACEMENT,
+                        ASSEMBLY_STEP.COVERAGE_DELETIONS,
+                        ASSEMBLY_STEP.PARSE_VARIANTS])
+
+    def _set_steps(self, status, steps):
+        for step in steps:
+            self.assembly_steps[step] = status
+
+    def test_get_assembly_status_from_steps(self):
+        self.assertEqual(ASSEMBLY_STATUS.QUEUED,
+                get_assembly_status_from_steps(self.assembly_steps))
+
+        # Assembly is shown while coverage deletions are detected alongside.
+        self._set_steps(ASSEMBLY_STEP_STATUS.RUNNING,
+                [ASSEMBLY_STEP.ASSEMBLY, ASSEMBLY_STEP.COVERAGE_DELETIONS])
+        self.assertEqual(ASSEMBLY_STATUS.ASSEMBLING,
+                get_assembly_status_from_steps(self.assembly_steps))
+
+        self._set_steps(ASSEMBLY_STEP_STATUS.COMPLETED,
+                [ASSEMBLY_STEP.SV_READS, ASSEMBLY_STEP.ASSEMBLY])
+        self.assertEqual(ASSEMBLY_STATUS.ANALYZING_COVERAGE,
+                get_assembly_status_from_steps(self.assembly_steps))
+
+        self._set_steps(ASSEMBLY_STEP_STATUS.COMPLETED,
+                [ASSEMBLY_STEP.CONTIG_PLACEMENT,
+                        ASSEMBLY_STEP.COVERAGE_DELETIONS])
+        self.assertEqual(ASSEMBLY_STATUS.WAITING_TO_PARSE,
+                get_assembly_status_from_steps(self.assembly_steps))
+
+        self._set_steps(ASSEMBLY_STEP_STATUS.COMPLETED,
+                [ASSEMBLY_STEP.PARSE_VARIANTS])
+        self.assertEqual(ASSEMBLY_STATUS.COMPLETED,
+                get_assembly_status_from_steps(self.assembly_steps))
+
+    def test_failed_step(self):
+        self._set_steps(ASSEMBLY_STEP_STATUS.FAILED,
+                [ASSEMBLY_STEP.COVERAGE_DELETIONS])
+        self._set_steps(ASSEMBLY_STEP_STATUS.RUNNING,
+                [ASSEMBLY_STEP.ASSEMBLY])
+        self.assertEqual(ASSEMBLY_STATUS.FAILED,
+                get_assembly_status_from_steps(self.assembly_steps))
@@ -4,11 +4,13 @@ Tests for genome finishing features
 import os
 import re
 
+from Bio import SeqIO
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TestCase
 
 from genome_finish.assembly import clean_up_previous_runs_of_sv_calling_pipeline
+from genome_finish.assembly import create_contigs_with_shared_fasta
 from genome_finish.assembly import evaluate_contigs
 from genome_finish.assembly import generate_contigs
 from genome_finish.assembly import parse_variants_from_vcf
@@ -384,6 +386,40 @@ class TestGraphWalk(TestCase):
                     len(incorrect_variants) /
                     len(variant_set.variants.all())))
 
+    def test_create_contigs_with_shared_fasta(self):
+        test_dir = os.path.join(GF_TEST_DIR, 'random_seq_data', 'deletion')
+        seq_records = [SeqIO.read(os.path.join(test_dir, filename), 'fasta')
+                for filename in sorted(os.listdir(test_dir))
+                if re.match(r'contig_\d+\.fa', filename)]
+        expected_seqs = [str(seq_record.seq) for seq_record in seq_records]
+
+        dummy_models = self._make_dummy_models()
+        sample_alignment = dummy_models['sample_alignment']
+        contig_list = [(Contig(
+                        parent_reference_genome=self.reference_genome,
+                        experiment_sample_to_alignment=sample_alignment,
+                        label='test_contig_%d' % i,
+                        num_bases=len(seq_record)),
+                    seq_record)
+                for i, seq_record in enumerate(seq_records)]
+
+        contig_uid_list = create_contigs_with_shared_fasta(contig_list,
+                os.path.join(sample_alignment.get_model_data_dir(),
+                        'contig_sequences.fa'))
+
+        contigs = [Contig.objects.get(uid=uid) for uid in contig_uid_list]
+        self.assertEqual(expected_seqs,
+                [str(c.get_fasta_seqrecord().seq) for c in contigs])
+        self.assertEqual([len(seq) for seq in expected_seqs],
+                [c.num_bases for c in contigs])
+
+        # A fasta of only the contig is written for tools that need one.
+        contig_fasta = contigs[0].ensure_fasta_file()
+        self.assertEqual(expected_seqs[0],
+                str(SeqIO.read(contig_fasta, 'fasta').seq))
+        self.assertEqual(expected_seqs[0],
+                str(contigs[0].get_fasta_seqrecord().seq))
+
     def test_deletion(self):
         test_dir = os.path.join(GF_TEST_DIR, 'random_seq_data',
                 'deletion')
@@ -0,0 +1,75 @@
+"""
+Tests for graph_contig_placement.py.
+"""
+
+import networkx as nx
+from django.test import TestCase
+
+from genome_finish.graph_contig_placement import novel_seq_ins_walk
+from genome_finish.graph_contig_placement import SequenceGraphIndex
+from genome_finish.graph_contig_placement import SequenceIntervals
+
+
+class TestSequenceIntervals(TestCase):
+
+    def test_insert_vertex(self):
+        intervals = SequenceIntervals('seq', 1000)
+        for pos in [500, 20, 900, 500, 0, 1000]:
+            intervals.insert_vertex(pos)
+
+        self.assertEqual([0, 20, 500, 900, 1000],
+                [v.pos for v in intervals.vertices])
+        self.assertEqual([0, 20, 500, 900, 1000], intervals.positions)
+
+        # Existing vertices are returned rather than duplicated.
+        self.assertTrue(intervals.insert_vertex(500) is intervals.vertices[2])
+
+        # No vertices past the end of the sequence.
+        self.assertEqual(None, intervals.insert_vertex(1001))
+
+
+class TestSequenceGraphIndex(TestCase):
+
+    def setUp(self):
+        """Graph of a contig spanning a 100 base insertion at position 500 of
+        the reference.
+        """
+        G = nx.DiGraph()
+        G.ref_intervals = SequenceIntervals('ref', 1000, tag='ref')
+        contig_intervals = SequenceIntervals('contig', 300)
+        G.contig_intervals_list = {'contig': contig_intervals}
+
+        exit_ref = G.ref_intervals.insert_vertex(500)
+        enter_contig = contig_intervals.insert_vertex(100)
+        exit_contig = contig_intervals.insert_vertex(200)
+        enter_ref = G.ref_intervals.insert_vertex(500)
+        G.add_edge(exit_ref, enter_contig)
+        G.add_edge(exit_contig, enter_ref)
+
+        for intervals in [G.ref_intervals, contig_intervals]:
+            for u, v in zip(intervals.vertices, intervals.vertices[1:]):
+                G.add_edge(u, v)
+                if intervals is contig_intervals:
+                    G.add_edge(v, u)
+
+        self.G = G
+        self.exit_ref = exit_ref
+        self.enter_contig = enter_contig
+        self.exit_contig = exit_contig
+
+    def test_neighbors(self):
+        graph_index = SequenceGraphIndex(self.G)
+
+        self.assertEqual([self.enter_contig],
+                graph_index.contig_neighbors(self.exit_ref))
+        self.assertEqual([self.exit_ref],
+                graph_index.ref_neighbors(self.exit_contig))
+        self.assertEqual([], graph_index.ref_neighbors(self.enter_contig))
+
+    def test_novel_seq_ins_walk(self):
+        iv_list = novel_seq_ins_walk(self.G, SequenceGraphIndex(self.G))
+        self.assertEqual(1, len(iv_list))
+        self.assertEqual(
+                (self.exit_ref, self.enter_contig, self.exit_contig,
+                        self.exit_ref),
+                tuple(iv_list[0]))
@@ -0,0 +1,91 @@
+"""
+Tests for local_assembly.py.
+"""
+
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+import pysam
+
+from genome_finish.local_assembly import split_reads_into_loci
+
+READ_LENGTH = 100
+
+
+class TestSplitReadsIntoLoci(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bam_path = os.path.join(self.temp_dir, 'sv_indicants.bam')
+
+        # Read pairs as (query_name, (chrom, pos) of each read), with None for
+        # unmapped reads. Names sort in the order of the pairs.
+        pairs = []
+
+        # A cluster of read pairs on chr1, including pairs with an unmapped
+        # read anchored by its mate.
+        for i in range(6):
+            pairs.append((('chr1', 10000 + 50 * i), ('chr1', 10300)))
+        pairs.append((('chr1', 10100), None))
+
+        # A translocation joining clusters on chr1 and chr2.
+        for i in range(6):
+            pairs.append((('chr1', 50000 + 20 * i), ('chr2', 20000 + 20 * i)))
+
+        # Too few read pairs to assemble.
+        for i in range(2):
+            pairs.append((('chr1', 80000), ('chr1', 80200)))
+
+        # No anchor.
+        pairs.append((None, None))
+
+        header = {
+            'HD': {'VN': '1.0', 'SO': 'queryname'},
+            'SQ': [{'SN': 'chr1', 'LN': 100000}, {'SN': 'chr2', 'LN': 100000}]
+        }
+        chrom_ids = {'chr1': 0, 'chr2': 1}
+        bamfile = pysam.AlignmentFile(self.bam_path, 'wb', header=header)
+        for pair_idx, pair in enumerate(pairs):
+            for read_idx, (position, mate_position) in enumerate(
+                    [pair, tuple(reversed(pair))]):
+                read = pysam.AlignedSegment()
+                read.query_name = 'pair_%03d' % pair_idx
+                read.query_sequence = 'A' * READ_LENGTH
+                read.flag = 0x1 | (0x40 if read_idx == 0 else 0x80)
+                if position is None:
+                    read.flag |= 0x4
+                    position = mate_position
+                if mate_position is None:
+                    read.flag |= 0x8
+                    mate_position = position
+                if position is not None:
+                    read.reference_id = chrom_ids[position[0]]
+                    read.reference_start = position[1]
+                    read.next_reference_id = chrom_ids[mate_position[0]]
+                    read.next_reference_start = mate_position[1]
+                if not read.is_unmapped:
+                    read.mapping_quality = 60
+                    read.cigartuples = [(0, READ_LENGTH)]
+                bamfile.write(read)
+        bamfile.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_split_reads_into_loci(self):
+        loci = split_reads_into_loci(self.bam_path, self.temp_dir,
+                max_gap=1000, max_locus_size=20000, min_read_pairs=5)
+        self.assertEqual(2, len(loci))
+
+        self.assertEqual([('chr1', 10000, 10300)], loci[0].regions)
+        self.assertEqual([('chr1', 50000, 50100), ('chr2', 20000, 20100)],
+                loci[1].regions)
+
+        for locus, expected_pairs in zip(loci, [7, 6]):
+            bamfile = pysam.AlignmentFile(locus.reads_bam, 'rb')
+            query_names = [read.query_name for read in bamfile]
+            bamfile.close()
+            self.assertEqual(2 * expected_pairs, len(query_names))
+            self.assertEqual(sorted(query_names), query_names)
@@ -90,6 +90,18 @@ class TestParallelAssembly(TestCase):
         # Run pipeline and wait on result
         run_de_novo_assembly_pipeline(sample_align_list)
 
+        # Every step of the pipeline completed for each sample alignment.
+        for sample_align in sample_align_list:
+            sample_align = ExperimentSampleToAlignment.objects.get(
+                    uid=sample_align.uid)
+            self.assertEqual(
+                    ExperimentSampleToAlignment.ASSEMBLY_STATUS.COMPLETED,
+                    sample_align.data['assembly_status'])
+            self.assertEqual(
+                    set([ExperimentSampleToAlignment.ASSEMBLY_STEP_STATUS.
+                            COMPLETED]),
+                    set(sample_align.data['assembly_steps'].values()))
+
         return alignment_group
 
     def _run_genome_finish_test(self, variant_set, target_fasta,
@@ -1,27 +1,130 @@
 """Functions that enforce consistency.
 """
 
+from django.db import connection
+from django.db import transaction
 
-def ensure_variant_set_consistency(variant_set):
+
+# Table of the VariantToVariantSet.sample_variant_set_association relation.
+SAMPLE_ASSOCIATION_TABLE_NAME = (
+        'main_varianttovariantset_sample_variant_set_association')
+
+def ensure_variant_set_consistency(variant_set, variant_ids=None):
     """For all Variants in a VariantSet, makes an association to samples
-    having GT_TYPE = 2.
+    having GT_TYPE = 2, and removes the association to samples that have
+    VariantEvidence for the Variant, but not with GT_TYPE = 2.
+
+    Args:
+        variant_set: The VariantSet.
+        variant_ids: Optional list of Variant ids. If provided, only these
+            Variants are checked.
     """
-    for variant in variant_set.variants.all():
-        vtvs = variant.varianttovariantset_set.get(variant_set=variant_set)
-        for vccd in variant.variantcallercommondata_set.all():
-            for ve in vccd.variantevidence_set.all():
-                if 'GT_TYPE' in ve.data and ve.data['GT_TYPE'] == 2:
-                    vtvs.sample_variant_set_association.add(
-                            ve.experiment_sample)
-                else:
-                    vtvs.sample_variant_set_association.remove(
-                            ve.experiment_sample)
-
-
-def ensure_all_ref_genome_variant_set_consistency(reference_genome):
-    """Ensures VariantSet consistency for all VariantSets belonging to a
+    condition = 'vtvs.variant_set_id = %s'
+    args = [variant_set.id]
+    if variant_ids is not None:
+        condition += ' AND vtvs.variant_id = ANY(%s)'
+        args.append(list(variant_ids))
+    _update_sample_variant_set_associations(condition, args)
+
+    if variant_ids is None:
+        cursor = connection.cursor()
+        cursor.execute(
+                'UPDATE main_variantset '
+                'SET is_sample_association_consistent = true '
+                'WHERE id = %s',
+                (variant_set.id,))
+    transaction.commit_unless_managed()
+
+
+def ensure_all_ref_genome_variant_set_consistency(reference_genome,
+        variant_ids=None):
+    """Ensures VariantSet consistency for the VariantSets belonging to a
     ReferenceGenome.
+
+    Only the VariantSets marked as not consistent are checked in full. This
+    is done with one statement for adding associations and one for removing
+    them, rather than per VariantSet.
+
+    Args:
+        reference_genome: The ReferenceGenome.
+        variant_ids: Optional list of Variant ids. If provided, these
+            Variants are checked in all VariantSets.
     """
-    for vs in reference_genome.variantset_set.all():
-        ensure_variant_set_consistency(vs)
-    reference_genome.invalidate_materialized_view()
+    # Clear the flags first so that VariantSets changed while this runs are
+    # checked again next time.
+    cursor = connection.cursor()
+    cursor.execute(
+            'UPDATE main_variantset '
+            'SET is_sample_association_consistent = true '
+            'WHERE reference_genome_id = %s '
+            'AND NOT is_sample_association_consistent '
+            'RETURNING id',
+            (reference_genome.id,))
+    dirty_variant_set_ids = [row[0] for row in cursor.fetchall()]
+
+    if variant_ids is None:
+        variant_ids = []
+    else:
+        variant_ids = list(variant_ids)
+
+    if dirty_variant_set_ids or variant_ids:
+        _update_sample_variant_set_associations(
+                'vtvs.variant_set_id = ANY(%s) OR ('
+                    'vtvs.variant_id = ANY(%s) AND '
+                    'vtvs.variant_set_id IN ('
+                        'SELECT id FROM main_variantset '
+                        'WHERE reference_genome_id = %s))',
+                [dirty_variant_set_ids, variant_ids, reference_genome.id])
+    transaction.commit_unless_managed()
+
+
+def _update_sample_variant_set_associations(vtvs_condition, args):
+    """Updates the sample associations of the VariantToVariantSet objects
+    matching the condition.
+
+    Args:
+        vtvs_condition: SQL condition on main_varianttovariantset, aliased as
+            vtvs.
+        args: List of arguments for the condition.
+    """
+    cursor = connection.cursor()
+
+    # Samples with GT_TYPE = 2 for any call of the Variant.
+    cursor.execute(
+            'INSERT INTO ' + SAMPLE_ASSOCIATION_TABLE_NAME + ' '
+                    '(varianttovariantset_id, experimentsample_id) '
+                'SELECT DISTINCT vtvs.id, ve.experiment_sample_id '
+                'FROM main_varianttovariantset AS vtvs '
+                'INNER JOIN main_variantcallercommondata AS vccd ON ('
+                    'vccd.variant_id = vtvs.variant_id) '
+                'INNER JOIN main_variantevidence AS ve ON ('
+                    've.variant_caller_common_data_id = vccd.id) '
+                'WHERE (' + vtvs_condition + ') '
+                "AND ve.data->>'GT_TYPE' = '2' "
+                'AND NOT EXISTS ('
+                    'SELECT 1 '
+                    'FROM ' + SAMPLE_ASSOCIATION_TABLE_NAME + ' AS association '
+                    'WHERE association.varianttovariantset_id = vtvs.id '
+                    'AND association.experimentsample_id = '
+                        've.experiment_sample_id)',
+            args)
+
+    # Samples with VariantEvidence for the Variant, none with GT_TYPE = 2.
+    evidence_exists_sql = (
+            'EXISTS ('
+                'SELECT 1 '
+                'FROM main_variantcallercommondata AS vccd '
+                'INNER JOIN main_variantevidence AS ve ON ('
+                    've.variant_caller_common_data_id = vccd.id) '
+                'WHERE vccd.variant_id = vtvs.variant_id '
+                'AND ve.experiment_sample_id = association.experimentsample_id'
+                '%s)')
+    cursor.execute(
+            'DELETE FROM ' + SAMPLE_ASSOCIATION_TABLE_NAME + ' AS association '
+            'USING main_varianttovariantset AS vtvs '
+            'WHERE association.varianttovariantset_id = vtvs.id '
+            'AND (' + vtvs_condition + ') '
+            'AND ' + evidence_exists_sql % '' + ' '
+            'AND NOT ' + evidence_exists_sql % (
+                    " AND ve.data->>'GT_TYPE' = '2'"),
+            args)
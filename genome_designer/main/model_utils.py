@@ -2,13 +2,17 @@
 Utility objects and functions for interacting with models.
 """
 
+from cStringIO import StringIO
 import hashlib
+import json
 from uuid import uuid4
 
 from django.conf import settings
+from django.db import connection
 from django.db import IntegrityError
 from django.db import models
 from django.db import transaction
+from psycopg2.extras import Json as psycopg2_Json
 
 import os
 import re
@@ -138,6 +142,122 @@ class UniqueUidModelMixin(models.Model):
     objects = SafeCreateModelManager()
 
 
+###############################################################################
+# Bulk creation
+###############################################################################
+
+def allocate_model_ids(model, count):
+    """Reserves ids from the id sequence of the model's table.
+
+    This allows creating related objects in bulk without a round trip per
+    object to find out the ids of the objects they point to.
+
+    Returns:
+        List of count ids.
+    """
+    if count == 0:
+        return []
+    cursor = connection.cursor()
+    cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)",
+            (model._meta.db_table, count))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def ensure_unique_uids(model, instances):
+    """Regenerates the uids of instances that clash with each other or with
+    existing rows of the model's table.
+
+    Objects created in bulk don't go through SafeCreateModelManager, so a
+    single uid clash would otherwise fail the whole batch.
+    """
+    cursor = connection.cursor()
+    to_check = list(instances)
+    for attempt in range(SafeCreateModelManager.MAX_UID_CLASHES):
+        if not to_check:
+            return
+        cursor.execute('SELECT uid FROM %s WHERE uid = ANY(%%s)' % (
+                model._meta.db_table,),
+                ([obj.uid for obj in to_check],))
+        existing_uids = set([row[0] for row in cursor.fetchall()])
+        clashing = []
+        seen_uids = set()
+        for obj in instances:
+            if obj.uid in existing_uids or obj.uid in seen_uids:
+                obj.uid = short_uuid()
+                clashing.append(obj)
+            seen_uids.add(obj.uid)
+        to_check = clashing
+    if to_check:
+        raise IntegrityError('Unable to resolve uid clashes for %s.' % (
+                model.__name__,))
+
+
+def copy_model_instances(model, instances):
+    """Inserts the instances into the model's table using Postgres COPY.
+
+    Values are converted the same way the ORM converts them on save, so this
+    behaves like calling save() on each instance, except that no signals are
+    sent. Instances must have their ids set, e.g. using allocate_model_ids().
+    """
+    if not instances:
+        return
+    fields = [field for field in model._meta.local_fields
+            if field.column is not None]
+
+    buf = StringIO()
+    for obj in instances:
+        assert obj.id is not None, "Use allocate_model_ids()."
+        buf.write('\t'.join([
+                _to_copy_text(field.get_db_prep_save(
+                        field.pre_save(obj, True), connection=connection))
+                for field in fields]))
+        buf.write('\n')
+    buf.seek(0)
+
+    cursor = connection.cursor()
+    cursor.copy_from(buf, model._meta.db_table,
+            columns=[field.column for field in fields])
+
+
+def copy_rows(table_name, columns, rows):
+    """Inserts the rows, given as tuples of values, into the table using
+    Postgres COPY.
+    """
+    if not rows:
+        return
+    buf = StringIO()
+    for row in rows:
+        buf.write('\t'.join([_to_copy_text(value) for value in row]))
+        buf.write('\n')
+    buf.seek(0)
+
+    cursor = connection.cursor()
+    cursor.copy_from(buf, table_name, columns=columns)
+
+
+def _to_copy_text(value):
+    """Formats a value for the Postgres COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, psycopg2_Json):
+        value = json.dumps(value.adapted)
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return (value.replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
 ###############################################################################
 # Misc helpers
 ###############################################################################
@@ -37,16 +37,23 @@ import re
 import shutil
 import subprocess
 
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 from custom_fields import PostgresJsonField
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.db import transaction
+from django.db.models import F
 from django.db.models import Model
+import pysam
 
 from genome_finish.contig_display_utils import create_contig_junction_links
 from model_utils import assert_unique_types
+from model_utils import clean_filesystem_location
 from model_utils import ensure_exists_0775_dir
 from model_utils import get_dataset_with_type
 from model_utils import get_long_alt_path
@@ -56,6 +63,8 @@ from model_utils import JSONDataSubfieldsMixin
 from model_utils import UniqueUidModelMixin
 from model_utils import VisibleFieldMixin
 from utils import uppercase_underscore
+from utils.genbank_util import FEATURE_INDEX_FILENAME
+from utils.genbank_util import generate_gbk_feature_index
 from utils.genbank_util import generate_genbank_mobile_element_multifasta
 from variants.filter_key_map_constants import MAP_KEY__ALTERNATE
 from variants.filter_key_map_constants import MAP_KEY__COMMON_DATA
@@ -118,6 +127,7 @@ class Dataset(UniqueUidModelMixin):
         BWA_SV_INDICANTS = 'BWA Structural Variant Indicating Reads'
         BWA_FOR_DE_NOVO_ASSEMBLY = 'BWA for De Novo Assembly'
         BWA_ALIGN_ERROR = 'BWA Alignment Error'
+        BWA_COVERAGE_ARRAYS = 'BWA Per Base Coverage Arrays'
         VCF_FREEBAYES = 'Freebayes VCF'
         VCF_PINDEL = 'Pindel VCF'
         VCF_DELLY = 'Delly VCF'
@@ -160,6 +170,7 @@ class Dataset(UniqueUidModelMixin):
         TYPE.BWA_PILED : 'experimentsampletoalignment_set',
         TYPE.BWA_SV_INDICANTS : 'experimentsampletoalignment_set',
         TYPE.BWA_ALIGN_ERROR : 'alignmentgroup_set',
+        TYPE.BWA_COVERAGE_ARRAYS : 'experimentsampletoalignment_set',
         TYPE.VCF_FREEBAYES : 'alignmentgroup_set',
         TYPE.VCF_PINDEL : 'alignmentgroup_set',
         TYPE.VCF_LUMPY : 'alignmentgroup_set',
@@ -542,6 +553,17 @@ class ReferenceGenome(UniqueUidModelMixin):
     # materialized view.
     is_materialized_variant_view_valid = models.BooleanField(default=False)
 
+    # Incremented whenever the contents of the materialized view change, so
+    # that results derived from the view (e.g. counts, pagination bookmarks)
+    # can be cached against it.
+    materialized_variant_view_generation = models.IntegerField(default=0)
+
+    # Incremented whenever the materialized view is marked out of date, so
+    # that a rebuild only marks the view valid if it wasn't invalidated again
+    # while being built.
+    materialized_variant_view_invalidation_count = models.IntegerField(
+            default=0)
+
     def __unicode__(self):
         return self.label
 
@@ -705,6 +727,41 @@ class ReferenceGenome(UniqueUidModelMixin):
         self.dataset_set.add(me_fa_dataset)
         self.save()
 
+    def ensure_feature_index(self):
+        """
+        If this genome is annotated, then ensure the index of its genbank
+        features used to look up features by position exists. If it does
+        not exist, or is in the old pickled format, it will be created.
+        """
+        if not self.is_annotated():
+            raise AttributeError
+
+        feature_index_path = os.path.join(
+                self.get_snpeff_genbank_parent_dir(),
+                FEATURE_INDEX_FILENAME)
+
+        feature_index_dataset = self.dataset_set.filter(
+                type=Dataset.TYPE.FEATURE_INDEX)
+        if feature_index_dataset.exists():
+            existing_path = feature_index_dataset[0].get_absolute_location()
+            if (os.path.basename(existing_path) == FEATURE_INDEX_FILENAME and
+                    os.path.exists(existing_path)):
+                return
+            else:
+                [d.delete() for d in feature_index_dataset]
+
+        generate_gbk_feature_index(
+                self.get_snpeff_genbank_file_path(),
+                feature_index_path)
+
+        feature_index_dataset = Dataset.objects.create(
+                label=Dataset.TYPE.FEATURE_INDEX,
+                type=Dataset.TYPE.FEATURE_INDEX,
+                filesystem_location=feature_index_path)
+
+        self.dataset_set.add(feature_index_dataset)
+        self.save()
+
     def get_variant_caller_common_map(self):
         return self.variant_key_map[MAP_KEY__COMMON_DATA]
 
@@ -737,9 +794,34 @@ class ReferenceGenome(UniqueUidModelMixin):
             {'field': 'num_bases', 'verbose': 'Total Size'}
         ]
 
-    def invalidate_materialized_view(self):
+    def invalidate_materialized_view(self, variant_ids=None):
+        """Marks the materialized view as out of date.
+
+        Args:
+            variant_ids: Optional list of ids of the Variants that changed.
+                If provided and settings.MATERIALIZED_VIEW_INCREMENTAL is
+                True, only the rows for these Variants are re-computed the
+                next time the view is used. Otherwise the whole view is
+                rebuilt.
+        """
+        if variant_ids is not None and settings.MATERIALIZED_VIEW_INCREMENTAL:
+            mvm = MeltedVariantMaterializedViewManager(self)
+            mvm.mark_variants_dirty(variant_ids)
+            return
+
+        # The view is rebuilt from scratch, so remember which VariantSets need
+        # their sample associations checked.
+        variant_sets = self.variantset_set.filter(
+                is_sample_association_consistent=True)
+        if variant_ids is not None:
+            variant_sets = variant_sets.filter(variants__id__in=variant_ids)
+        variant_sets.update(is_sample_association_consistent=False)
+
+        ReferenceGenome.objects.filter(id=self.id).update(
+                is_materialized_variant_view_valid=False,
+                materialized_variant_view_invalidation_count=F(
+                        'materialized_variant_view_invalidation_count') + 1)
         self.is_materialized_variant_view_valid = False
-        self.save(update_fields=['is_materialized_variant_view_valid'])
 
     def drop_materialized_view(self):
         """Deletes associated materialized view.
@@ -797,6 +879,50 @@ class Contig(UniqueUidModelMixin, JSONDataSubfieldsMixin):
         # Check whether the data dir exists, and create it if not.
         return ensure_exists_0775_dir(self.get_model_data_dir())
 
+    def get_fasta_seqrecord(self):
+        """Returns the SeqRecord of the contig sequence.
+
+        Contigs of an assembly share one multi-fasta, indexed with samtools
+        faidx, in which the record of each Contig is named by its uid. Older
+        Contigs have a fasta of their own, without an index.
+        """
+        fasta_dataset = get_dataset_with_type(self,
+                Dataset.TYPE.REFERENCE_GENOME_FASTA)
+        fasta_path = fasta_dataset.get_absolute_location()
+        if not fasta_dataset.filesystem_idx_location:
+            with open(fasta_path) as fh:
+                return SeqIO.read(fh, 'fasta')
+
+        fasta_file = pysam.FastaFile(fasta_path)
+        try:
+            seq = fasta_file.fetch(str(self.uid))
+        finally:
+            fasta_file.close()
+        return SeqRecord(Seq(seq), id=str(self.uid), name=str(self.uid),
+                description='')
+
+    def ensure_fasta_file(self):
+        """Returns the path to a fasta of only this contig, for tools that
+        take the contig as a reference, writing it from the shared
+        multi-fasta of the assembly if needed.
+        """
+        fasta_dataset = get_dataset_with_type(self,
+                Dataset.TYPE.REFERENCE_GENOME_FASTA)
+        if not fasta_dataset.filesystem_idx_location:
+            return fasta_dataset.get_absolute_location()
+
+        seq_record = self.get_fasta_seqrecord()
+        self.ensure_model_data_dir_exists()
+        fasta_path = os.path.join(self.get_model_data_dir(), 'fasta.fa')
+        with open(fasta_path, 'w') as fh:
+            SeqIO.write([seq_record], fh, 'fasta')
+
+        fasta_dataset.filesystem_location = clean_filesystem_location(
+                fasta_path)
+        fasta_dataset.filesystem_idx_location = ''
+        fasta_dataset.save()
+        return fasta_path
+
     def get_jbrowse_directory_path(self):
         """Returns the full path to the root of JBrowse data for this
         Contig.
@@ -1160,6 +1286,16 @@ class AlignmentGroup(UniqueUidModelMixin):
         STATUS.VARIANT_CALLING
     ]
 
+    # Number of sample alignments of the running pipeline that haven't
+    # finished yet, plus one while the pipeline is being started. Whoever
+    # brings it to zero starts variant calling. See pipeline.pipeline_runner.
+    pending_alignment_count = models.IntegerField(default=0)
+
+    # Number of VCFs of the running pipeline that are still being parsed in
+    # the background, one celery task per region. The pipeline doesn't
+    # complete until it is zero. See variants.vcf_parser.
+    pending_vcf_parse_count = models.IntegerField(default=0)
+
     def __unicode__(self):
         return self.label
 
@@ -1307,6 +1443,26 @@ class ExperimentSampleToAlignment(UniqueUidModelMixin, JSONDataSubfieldsMixin):
         COMPLETED = 'COMPLETED'
         FAILED = 'FAILED'
 
+    class ASSEMBLY_STEP:
+        """
+        The steps of the custom SV calling pipeline, each of which records its
+        own status in data['assembly_steps'].
+        """
+        SV_READS = 'SV_READS'
+        ASSEMBLY = 'ASSEMBLY'
+        CONTIG_PLACEMENT = 'CONTIG_PLACEMENT'
+        COVERAGE_DELETIONS = 'COVERAGE_DELETIONS'
+        PARSE_VARIANTS = 'PARSE_VARIANTS'
+
+    class ASSEMBLY_STEP_STATUS:
+        """
+        The status of a step of the custom SV calling pipeline.
+        """
+        QUEUED = 'QUEUED'
+        RUNNING = 'RUNNING'
+        COMPLETED = 'COMPLETED'
+        FAILED = 'FAILED'
+
     @property
     def status(self):
         """The status of a running alignment job.
@@ -1382,6 +1538,18 @@ class ExperimentSampleToAlignment(UniqueUidModelMixin, JSONDataSubfieldsMixin):
         if os.path.exists(data_dir):
             shutil.rmtree(data_dir)
 
+    def update_data(self, update_fn):
+        """Applies update_fn to the data dict of this sample alignment, with
+        its row locked so that updates from tasks running concurrently for
+        this sample alignment are not lost.
+        """
+        with transaction.commit_on_success():
+            locked = ExperimentSampleToAlignment.objects.select_for_update(
+                    ).get(id=self.id)
+            update_fn(locked.data)
+            locked.save()
+        self.data = locked.data
+
     def __getattr__(self, name):
         """HACK: Override if assembly_status not started.
         """
@@ -1693,13 +1861,16 @@ class VariantEvidence(
         # call super's __init__ without the alt_value field if present
         super(VariantEvidence, self).__init__(*args, **kwargs)
 
-    def create_variant_alternate_association(self):
+    def get_called_alt_values(self):
+        """Returns the normalized values of the alternate alleles called for
+        this ExperimentSample, according to GT_BASES and GT_NUMS.
+        """
         gt_bases = self.data['GT_BASES']
         gt_nums = self.data['GT_NUMS']
 
-        # If this variant evidence is a non-call, no need to add alt alleles.
+        # If this variant evidence is a non-call, no alt alleles.
         if gt_bases is None:
-            return
+            return []
 
         assert ('|' not in gt_bases), (
                 'GT bases string is phased;' +
@@ -1709,17 +1880,21 @@ class VariantEvidence(
         gt_bases_split = gt_bases.split('/')
         gt_nums_split = gt_nums.split('/')
 
+        alt_values = []
         for i in range(len(gt_bases_split)):
             gt_base = str(gt_bases_split[i])
             gt_num = int(gt_nums_split[i])
             if gt_num == 0:
                 # This refers to ref allele, thus no alt to create.
                 continue
+            alt_values.append(get_normalized_alt_representation(gt_base))
+        return alt_values
+
+    def create_variant_alternate_association(self):
+        for normalized_alt_value in self.get_called_alt_values():
             try:
                 variant = self.variant_caller_common_data.variant
 
-                normalized_alt_value = get_normalized_alt_representation(gt_base)
-
                 self.variantalternate_set.add(
                         VariantAlternate.objects.get(
                             variant=variant,
@@ -1808,6 +1983,11 @@ class VariantSet(UniqueUidModelMixin):
     dataset_set = models.ManyToManyField('Dataset', blank=True, null=True,
         verbose_name="Datasets")
 
+    # Whether the sample associations of the VariantToVariantSet objects agree
+    # with the VariantEvidence of their Variants. Cleared when Variants of
+    # the set change, so that main.consistency can skip unchanged sets.
+    is_sample_association_consistent = models.BooleanField(default=False)
+
     def __unicode__(self):
         return self.label
 
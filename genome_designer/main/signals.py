@@ -92,7 +92,8 @@ def post_contig_delete(sender, instance, **kwargs):
 
     # If this is last VariantCallerCommonData for Variant, delete the whole
     # Variant.
-    vccd.variant.reference_genome.invalidate_materialized_view()
+    vccd.variant.reference_genome.invalidate_materialized_view(
+            variant_ids=[vccd.variant_id])
     if vccd.variant.variantcallercommondata_set.count() == 1:
         vccd.variant.delete()
     else:
@@ -259,13 +260,15 @@ pre_delete.connect(pre_alignment_group_delete, sender=AlignmentGroup,
 
 
 def post_vtvs_save(sender, instance, created, **kwargs):
-    instance.variant.reference_genome.invalidate_materialized_view()
+    instance.variant.reference_genome.invalidate_materialized_view(
+            variant_ids=[instance.variant_id])
 post_save.connect(post_vtvs_save, sender=VariantToVariantSet,
         dispatch_uid='vtvs_save')
 
 
 def post_vtvs_delete(sender, instance, **kwargs):
-    instance.variant.reference_genome.invalidate_materialized_view()
+    instance.variant.reference_genome.invalidate_materialized_view(
+            variant_ids=[instance.variant_id])
 pre_delete.connect(post_vtvs_delete, sender=VariantToVariantSet,
         dispatch_uid='vtvs_delete')
 
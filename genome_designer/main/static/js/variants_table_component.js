@@ -94,8 +94,12 @@ gd.VariantsTableComponent = Backbone.View.extend({
 
     // Write in number of seconds since last load.
     if (this.datatableComponent.timeForLastResult > 0) {
-      $('#gd-snp-filter-time').text(
-          '(query time: ' + this.datatableComponent.timeForLastResult +' sec)');
+      var timeText = '(query time: ' +
+          this.datatableComponent.timeForLastResult +' sec)';
+      if (this.isViewRefreshing) {
+        timeText += ' (variant data is refreshing, results may be out of date)';
+      }
+      $('#gd-snp-filter-time').text(timeText);
     }
 
     // Handle click on href for a long alt value.
@@ -233,6 +237,9 @@ gd.VariantsTableComponent = Backbone.View.extend({
 
     var timeForLastResult = Number(response.time_for_last_result);
 
+    // Whether the results come from a stale view being rebuilt on the server.
+    this.isViewRefreshing = Boolean(response.is_view_refreshing);
+
     // Parse VariantSet data.
     this.variantSetList = JSON.parse(response.variant_set_list_json).obj_list;
 
@@ -2,9 +2,11 @@
 from django.test import TestCase
 
 
+from main.consistency import ensure_all_ref_genome_variant_set_consistency
 from main.consistency import ensure_variant_set_consistency
 from main.models import AlignmentGroup
 from main.models import ExperimentSample
+from main.models import ReferenceGenome
 from main.models import Variant
 from main.models import VariantAlternate
 from main.models import VariantCallerCommonData
@@ -21,8 +23,7 @@ VARIANTSET_1_LABEL = 'New Set A'
 
 class TestEnsureVariantSetConsistency(TestCase):
 
-    def test_simple(self):
-
+    def setUp(self):
         common_entities = create_common_entities()
         project = common_entities['project']
         self.ref_genome_1 = common_entities['reference_genome']
@@ -41,40 +42,32 @@ class TestEnsureVariantSetConsistency(TestCase):
             reference_genome=self.ref_genome_1,
             aligner=AlignmentGroup.ALIGNER.BWA)
 
-        var_set_1 = VariantSet.objects.create(
+        self.var_set_1 = VariantSet.objects.create(
                 reference_genome=self.ref_genome_1,
                 label=VARIANTSET_1_LABEL)
 
-        variant = Variant.objects.create(
+        self.variant = Variant.objects.create(
                 type=Variant.TYPE.TRANSITION,
                 reference_genome=self.ref_genome_1,
                 chromosome=self.chromosome,
                 position=100,
                 ref_value='A')
-        variant.variantalternate_set.add(
+        self.variant.variantalternate_set.add(
                 VariantAlternate.objects.create(
-                        variant=variant,
+                        variant=self.variant,
                         alt_value='G'))
 
-        vtvs = VariantToVariantSet.objects.create(
-                    variant=variant,
-                    variant_set=var_set_1)
+        self.vtvs = VariantToVariantSet.objects.create(
+                    variant=self.variant,
+                    variant_set=self.var_set_1)
 
-        vccd = VariantCallerCommonData.objects.create(
-                variant=variant,
+        self.vccd = VariantCallerCommonData.objects.create(
+                variant=self.variant,
                 source_dataset_id=1,
                 alignment_group=alignment_group,
                 data={})
 
-        # Add a VariantEvidence with no GT_TYPE.
-        VariantEvidence.objects.create(
-                experiment_sample=self.sample_1,
-                variant_caller_common_data=vccd,
-                data={})
-        self.assertEqual(0, vtvs.sample_variant_set_association.count())
-
-        # Now add a VariantEvidence that has GT_TYPE=2 and run
-        # ensure_variant_set_consistency().
+    def _add_homozygous_evidence(self, sample):
         raw_sample_data_dict = {
                 'CALLED': True,
                 'GT_TYPE': 2,
@@ -82,8 +75,61 @@ class TestEnsureVariantSetConsistency(TestCase):
                 'GT_NUMS': '1/1'
         }
         VariantEvidence.objects.create(
-                experiment_sample=self.sample_2,
-                variant_caller_common_data=vccd,
+                experiment_sample=sample,
+                variant_caller_common_data=self.vccd,
                 data=raw_sample_data_dict)
+
+    def test_simple(self):
+        vtvs = self.vtvs
+        var_set_1 = self.var_set_1
+
+        # Add a VariantEvidence with no GT_TYPE.
+        VariantEvidence.objects.create(
+                experiment_sample=self.sample_1,
+                variant_caller_common_data=self.vccd,
+                data={})
+        self.assertEqual(0, vtvs.sample_variant_set_association.count())
+
+        # Now add a VariantEvidence that has GT_TYPE=2 and run
+        # ensure_variant_set_consistency().
+        self._add_homozygous_evidence(self.sample_2)
         ensure_variant_set_consistency(var_set_1)
         self.assertEqual(1, vtvs.sample_variant_set_association.count())
+
+        # The association is removed if the sample is no longer GT_TYPE = 2.
+        VariantEvidence.objects.filter(experiment_sample=self.sample_2).update(
+                data={'GT_TYPE': 1})
+        ensure_variant_set_consistency(var_set_1)
+        self.assertEqual(0, vtvs.sample_variant_set_association.count())
+
+    def test_ref_genome_skips_consistent_sets(self):
+        """Only VariantSets whose Variants changed since the last check are
+        checked in full.
+        """
+        self._add_homozygous_evidence(self.sample_2)
+        ensure_all_ref_genome_variant_set_consistency(self.ref_genome_1)
+        self.assertEqual(1, self.vtvs.sample_variant_set_association.count())
+        self.assertTrue(VariantSet.objects.get(
+                id=self.var_set_1.id).is_sample_association_consistent)
+
+        # Changing the association behind the back of the ReferenceGenome
+        # isn't noticed.
+        self.vtvs.sample_variant_set_association.clear()
+        ensure_all_ref_genome_variant_set_consistency(self.ref_genome_1)
+        self.assertEqual(0, self.vtvs.sample_variant_set_association.count())
+
+        # Invalidating the Variant marks the set for checking again.
+        ref_genome = ReferenceGenome.objects.get(id=self.ref_genome_1.id)
+        with self.settings(MATERIALIZED_VIEW_INCREMENTAL=False):
+            ref_genome.invalidate_materialized_view(
+                    variant_ids=[self.variant.id])
+        self.assertFalse(VariantSet.objects.get(
+                id=self.var_set_1.id).is_sample_association_consistent)
+        ensure_all_ref_genome_variant_set_consistency(self.ref_genome_1)
+        self.assertEqual(1, self.vtvs.sample_variant_set_association.count())
+
+        # Passing the Variant checks it regardless.
+        self.vtvs.sample_variant_set_association.clear()
+        ensure_all_ref_genome_variant_set_consistency(self.ref_genome_1,
+                variant_ids=[self.variant.id])
+        self.assertEqual(1, self.vtvs.sample_variant_set_association.count())
@@ -363,8 +363,7 @@ def contigs_download(request):
     contig = get_object_or_404(
             Contig, uid=request.GET['contig_uid'])
 
-    file_path = contig.dataset_set.get(
-            type=Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
+    file_path = contig.ensure_fasta_file()
     file_name = '.'.join([contig.label, 'fa'])
 
     wrapper = FileWrapper(file(file_path))
@@ -711,6 +710,7 @@ VARIANT_LIST_RESPONSE_KEY__TIME = 'time_for_last_result'
 VARIANT_LIST_RESPONSE_KEY__SET_LIST = 'variant_set_list_json'
 VARIANT_LIST_RESPONSE_KEY__KEY_MAP = 'variant_key_filter_map_json'
 VARIANT_LIST_RESPONSE_KEY__ERROR = 'error'
+VARIANT_LIST_RESPONSE_KEY__IS_VIEW_REFRESHING = 'is_view_refreshing'
 
 
 # Uncomment this and @profile statement to profile. This is the entry point
@@ -824,7 +824,9 @@ def get_variant_list(request):
             VARIANT_LIST_RESPONSE_KEY__SET_LIST: adapt_model_to_frontend(VariantSet,
                     obj_list=variant_set_list),
             VARIANT_LIST_RESPONSE_KEY__KEY_MAP: json.dumps(
-                    variant_key_map_with_active_fields_marked)
+                    variant_key_map_with_active_fields_marked),
+            VARIANT_LIST_RESPONSE_KEY__IS_VIEW_REFRESHING:
+                    lookup_variant_result.is_view_refreshing
         }
     # Toggle which of the following exceptions is commented for debugging.
     # except FakeException as e:
@@ -1187,8 +1189,16 @@ def is_materialized_view_valid(request):
     reference_genome = get_object_or_404(ReferenceGenome,
                 project__owner=request.user.get_profile(),
                 uid=ref_genome_uid)
+    is_valid = reference_genome.is_materialized_variant_view_valid
+
+    # An existing stale view is served while it is rebuilt in the background,
+    # so the client doesn't need to wait for a refresh.
+    if not is_valid and settings.MATERIALIZED_VIEW_BACKGROUND_REFRESH:
+        mvm = MeltedVariantMaterializedViewManager(reference_genome)
+        is_valid = mvm.check_table_exists()
+
     response_data = json.dumps({
-        'isValid': reference_genome.is_materialized_variant_view_valid
+        'isValid': is_valid
     })
     return HttpResponse(response_data, content_type='application/json')
 
@@ -4,6 +4,12 @@ import sys
 from collections import defaultdict
 
 from django.conf import settings
+import numpy as np
+
+from pipeline.coverage import COVERAGE__ALTALIGNS
+from pipeline.coverage import COVERAGE__DEPTHS
+from pipeline.coverage import COVERAGE__LOW_MAPQ
+from pipeline.coverage import compute_chromosome_coverage_arrays
 
 MIN_MAPQ = settings.CL__MIN_MAPQ
 MAX_DEPTH = settings.CL__MAX_DEPTH
@@ -12,12 +18,40 @@ MIN_LOWMAPQ_DEPTH = settings.CL__MIN_LOWMAPQ_DEPTH
 MAX_LOWMAP_FRAC = settings.CL__MAX_LOWMAP_FRAC
 MERGE_DIST = settings.CL__MERGE_DIST
 
+# Classes of positions, by the reads covering them.
+POSITION_CLASS__NO_COVERAGE = 0
+POSITION_CLASS__LOW_COVERAGE = 1
+POSITION_CLASS__POOR_MAP_QUALITY = 2
+POSITION_CLASS__NONUNIQUE_ALIGNMENTS = 3
+POSITION_CLASS__CALLABLE = 4
+# Coverage too low to judge mapping, so the current flag continues.
+POSITION_CLASS__UNDECIDED = 5
+
+POSITION_CLASS_TO_FLAG = {
+    POSITION_CLASS__LOW_COVERAGE: 'LOW_COVERAGE',
+    POSITION_CLASS__POOR_MAP_QUALITY: 'POOR_MAP_QUALITY',
+    POSITION_CLASS__NONUNIQUE_ALIGNMENTS: 'NONUNIQUE_ALIGNMENTS',
+}
+
 def get_callable_loci(
         bam_filename,
         bed_output,
         chrom=None,
         start=None,
-        end=None):
+        end=None,
+        coverage_arrays=None):
+    """Writes a bed of the regions of the bam that are flagged as having no
+    coverage, low coverage, poor mapping quality or nonunique alignments.
+
+    Args:
+        bam_filename: Path of the indexed bam.
+        bed_output: Path of the bed to write.
+        chrom: Optional chromosome to restrict to, with optional start and
+            end positions.
+        coverage_arrays: Optional coverage arrays of the bam, as returned by
+            pipeline.coverage.get_coverage_arrays(). If not provided, they are
+            computed from the bam.
+    """
 
     # all bed lines, grouped by flag
     bed_lines = defaultdict(list)
@@ -61,7 +95,7 @@ def get_callable_loci(
         else:
             c_starts = [start]
         if not end:
-            c_ends = chrom_dict[chrom]
+            c_ends = [chrom_dict[chrom]]
         else:
             c_ends = [end]
     else:
@@ -70,6 +104,23 @@ def get_callable_loci(
 
     for chrom, c_start, c_end in zip(chrom_list, c_starts, c_ends):
 
+        # Classify every position, then walk through runs of positions with
+        # the same class rather than through every position.
+        if coverage_arrays is not None:
+            chrom_coverage_arrays = dict(
+                    (key, array[c_start:c_end])
+                    for key, array in coverage_arrays[chrom].iteritems())
+        else:
+            chrom_coverage_arrays = compute_chromosome_coverage_arrays(
+                    bamfile, chrom, c_start, c_end)
+        position_classes = _get_position_classes(chrom_coverage_arrays)
+        if not len(position_classes):
+            continue
+
+        run_starts = np.concatenate((
+                [0], np.flatnonzero(np.diff(position_classes)) + 1))
+        run_ends = np.concatenate((run_starts[1:], [len(position_classes)]))
+
         # holds the name of the bed flag we are currently walking through,
         # if there is one, else None.
         curr_flag = None
@@ -80,74 +131,42 @@ def get_callable_loci(
         # holds the start of the current bed record.
         bed_start = c_start
 
-        for pileup_col in bamfile.pileup(chrom,
-                start=c_start, end=c_end, truncate=True):
-
-            # number of segments aligned to this position
-            depth = pileup_col.nsegments
-            # number of poorly mapped segments
-            badmapq = 0
-            # number of segments who also map somewhere else
-            altaligns = 0
+        for run_start, run_end in zip(run_starts, run_ends):
+            position_class = position_classes[run_start]
+            if position_class == POSITION_CLASS__NO_COVERAGE:
+                continue
 
-            # fill in badmapq & altaligns
-            for p in pileup_col.pileups:
-                a = p.alignment
-                tag_as = a.get_tag('AS')
-                tag_xs = a.get_tag('XS')
-                badmapq += a.mapping_quality < MIN_MAPQ
-                altaligns += tag_as <= tag_xs
+            # Only the first position of a run can change the flag.
+            pos = c_start + int(run_start)
 
             # NO_COVERAGE
-            # if we've previously skipped from next_pos to the current pileup_col.pos,
+            # if we've previously skipped from next_pos to the current pos,
             # then end previous flag at next_pos-1 and fill in a NO_COVERAGE bed flag
-            # from next_pos to the current pileup_col.pos.
-            if next_pos != pileup_col.pos:
+            # from next_pos to the current pos.
+            if next_pos != pos:
                 if curr_flag != 'NO_COVERAGE':
                     _save_bed_line(chrom, bed_start, next_pos-1, curr_flag)
-                _save_bed_line(chrom, next_pos, pileup_col.pos-1, 'NO_COVERAGE')
+                _save_bed_line(chrom, next_pos, pos-1, 'NO_COVERAGE')
                 curr_flag = None
 
-            # LOW_COVERAGE
-            # if we're starting a new LOW_COVERAGE, then write the last flag
+            # LOW_COVERAGE, POOR_MAP_QUALITY or NONUNIQUE_ALIGNMENTS
+            # if we're starting a new flag, then write the last flag
             # and start a new one here by setting bed_start and curr_flag
-            if depth < MIN_DEPTH:
-                if curr_flag != 'LOW_COVERAGE':
-                    _save_bed_line(
-                            chrom, bed_start, pileup_col.pos-1, curr_flag)
-                    bed_start = pileup_col.pos
-                    curr_flag = 'LOW_COVERAGE'
-
-            # GOOD COVERAGE - either POOR_MAPQ, NONUNIQUE, or no flag
-            elif depth >= MIN_LOWMAPQ_DEPTH:
-                # POOR_MAPQ
-                # if we're starting a new POOR_MAPQ, then write the last flag
-                # and start a new one here by setting bed_start and curr_flag
-                if badmapq >= MAX_LOWMAP_FRAC*depth:
-                    if curr_flag != 'POOR_MAP_QUALITY':
-                        _save_bed_line(
-                                chrom, bed_start, pileup_col.pos-1, curr_flag)
-                        bed_start = pileup_col.pos
-                        curr_flag = 'POOR_MAP_QUALITY'
-
-                # NONUNIQUE
-                # if we're starting a new NONUNIQUE, then write the last flag
-                # and start a new one here by setting bed_start and curr_flag
-                elif altaligns >= MAX_LOWMAP_FRAC*depth:
-                    if curr_flag != 'NONUNIQUE_ALIGNMENTS':
-                        _save_bed_line(
-                                chrom, bed_start, pileup_col.pos-1, curr_flag)
-                        bed_start = pileup_col.pos
-                        curr_flag = 'NONUNIQUE_ALIGNMENTS'
-
-                # NO FLAG
-                # If depth > MIN_LOWMAPQ_DEPTH and alignments are sufficiently
-                # unique, then end the current flag
-                elif curr_flag:
-                    _save_bed_line(chrom, bed_start, pileup_col.pos, curr_flag)
-                    curr_flag = None
-
-            next_pos = pileup_col.pos +1
+            if position_class in POSITION_CLASS_TO_FLAG:
+                flag = POSITION_CLASS_TO_FLAG[position_class]
+                if curr_flag != flag:
+                    _save_bed_line(chrom, bed_start, pos-1, curr_flag)
+                    bed_start = pos
+                    curr_flag = flag
+
+            # NO FLAG
+            # If depth > MIN_LOWMAPQ_DEPTH and alignments are sufficiently
+            # unique, then end the current flag
+            elif position_class == POSITION_CLASS__CALLABLE and curr_flag:
+                _save_bed_line(chrom, bed_start, pos, curr_flag)
+                curr_flag = None
+
+            next_pos = c_start + int(run_end)
 
         # END LAST FLAG
         _save_bed_line(chrom, bed_start, c_end, curr_flag)
@@ -167,6 +186,32 @@ def get_callable_loci(
                     line['end'],
                     line['name'])
 
+
+def _get_position_classes(chrom_coverage_arrays):
+    """Returns an array with the POSITION_CLASS__* of each position of the
+    coverage arrays.
+    """
+    depth = chrom_coverage_arrays[COVERAGE__DEPTHS]
+    badmapq = chrom_coverage_arrays[COVERAGE__LOW_MAPQ]
+    altaligns = chrom_coverage_arrays[COVERAGE__ALTALIGNS]
+    num_positions = len(depth)
+
+    position_classes = np.empty(num_positions, dtype=np.int8)
+    position_classes.fill(POSITION_CLASS__UNDECIDED)
+
+    is_high_depth = (depth >= MIN_DEPTH) & (depth >= MIN_LOWMAPQ_DEPTH)
+    is_poor_mapq = is_high_depth & (badmapq >= MAX_LOWMAP_FRAC * depth)
+    is_nonunique = (is_high_depth & ~is_poor_mapq &
+            (altaligns >= MAX_LOWMAP_FRAC * depth))
+
+    position_classes[depth < MIN_DEPTH] = POSITION_CLASS__LOW_COVERAGE
+    position_classes[is_high_depth] = POSITION_CLASS__CALLABLE
+    position_classes[is_poor_mapq] = POSITION_CLASS__POOR_MAP_QUALITY
+    position_classes[is_nonunique] = POSITION_CLASS__NONUNIQUE_ALIGNMENTS
+    position_classes[depth == 0] = POSITION_CLASS__NO_COVERAGE
+    return position_classes
+
+
 if __name__ == '__main__':
     args = sys.argv[1:]
 
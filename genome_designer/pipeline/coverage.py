@@ -0,0 +1,345 @@
+"""
+Per-base coverage of alignments.
+
+The coverage arrays of an ExperimentSampleToAlignment are computed in a single
+pass over its reads and saved as a BWA_COVERAGE_ARRAYS Dataset, so that
+callable loci, coverage stats and deletion detection share them rather than
+each making their own pileup.
+"""
+
+from multiprocessing import current_process
+from multiprocessing import Pool
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.db import connection
+import numpy as np
+import pysam
+
+from main.model_utils import get_dataset_with_type
+from main.models import Dataset
+from pipeline.read_alignment_util import is_altalign_read
+from utils.import_util import add_dataset_to_entity
+
+# Keys of the coverage arrays of a chromosome.
+COVERAGE__DEPTHS = 'depths'
+COVERAGE__LOW_MAPQ = 'low_mapq'
+COVERAGE__ALTALIGNS = 'altaligns'
+
+COVERAGE_KEYS = [COVERAGE__DEPTHS, COVERAGE__LOW_MAPQ, COVERAGE__ALTALIGNS]
+
+# Reads left out of the coverage, as in pileups: unmapped, secondary,
+# qc failed and duplicate reads.
+SKIPPED_READ_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+COVERAGE_ARRAYS_FILENAME = 'bwa_align.coverage.npz'
+
+# Windows passed to a child process running the coverage pool.
+COVERAGE_WINDOWS_FILENAME = 'windows.json'
+
+# First key of the Postgresql advisory lock held while the coverage arrays of
+# a sample alignment are computed. The second key is the
+# ExperimentSampleToAlignment id.
+COVERAGE_ARRAYS_ADVISORY_LOCK_NAMESPACE = 7303
+
+
+def get_coverage_arrays(sample_alignment, bam_path=None, overwrite=False):
+    """Returns the coverage arrays of the sample alignment, computing them
+    and saving them as a Dataset if that hasn't happened yet.
+
+    Tasks running concurrently for the sample alignment, e.g. the steps of
+    the SV calling pipeline, are serialized with an advisory lock, so that
+    the arrays are computed and saved once.
+
+    Args:
+        sample_alignment: ExperimentSampleToAlignment.
+        bam_path: Optional path of the alignment bam. Defaults to the
+            BWA_ALIGN Dataset of the sample alignment.
+        overwrite: If True, the arrays are computed again, e.g. because the
+            alignment changed.
+
+    Returns:
+        Dictionary from chromosome name to a dictionary from COVERAGE__* key
+        to an array with the value at each position of the chromosome.
+    """
+    lock_key = (COVERAGE_ARRAYS_ADVISORY_LOCK_NAMESPACE, sample_alignment.id)
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_advisory_lock(%s, %s)', lock_key)
+    try:
+        return _get_coverage_arrays(sample_alignment, bam_path, overwrite)
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(%s, %s)', lock_key)
+
+
+def _get_coverage_arrays(sample_alignment, bam_path, overwrite):
+    """Implements get_coverage_arrays() while holding the lock.
+    """
+    coverage_dataset = get_dataset_with_type(sample_alignment,
+            Dataset.TYPE.BWA_COVERAGE_ARRAYS)
+    if coverage_dataset is not None:
+        coverage_path = coverage_dataset.get_absolute_location()
+        if not overwrite and os.path.exists(coverage_path):
+            return load_coverage_arrays(coverage_path)
+        coverage_dataset.delete()
+
+    if bam_path is None:
+        bam_path = get_dataset_with_type(sample_alignment,
+                Dataset.TYPE.BWA_ALIGN).get_absolute_location()
+
+    coverage_arrays = compute_coverage_arrays(bam_path)
+
+    coverage_path = os.path.join(sample_alignment.get_model_data_dir(),
+            COVERAGE_ARRAYS_FILENAME)
+    save_coverage_arrays(coverage_arrays, coverage_path)
+    add_dataset_to_entity(
+            sample_alignment,
+            Dataset.TYPE.BWA_COVERAGE_ARRAYS,
+            Dataset.TYPE.BWA_COVERAGE_ARRAYS,
+            filesystem_location=coverage_path)
+
+    return coverage_arrays
+
+
+def compute_coverage_arrays(bam_path, processes=None):
+    """Returns the coverage arrays of all chromosomes of the bam, in the
+    format returned by get_coverage_arrays().
+
+    Args:
+        bam_path: Path of the indexed bam.
+        processes: Number of processes to use. Defaults to
+            settings.COVERAGE_PROCESSES. With more than one, chromosomes are
+            split into windows of settings.COVERAGE_WINDOW_SIZE bases which
+            are computed in a process pool. A daemonic process, such as a
+            celery worker process, can't start a pool of its own, so there
+            the pool is started by a child python process.
+    """
+    if processes is None:
+        processes = settings.COVERAGE_PROCESSES
+
+    bamfile = pysam.AlignmentFile(bam_path, 'rb')
+    chrom_lens = zip(bamfile.references, bamfile.lengths)
+
+    if processes <= 1:
+        coverage_arrays = {}
+        for chrom, chrom_len in chrom_lens:
+            coverage_arrays[chrom] = compute_chromosome_coverage_arrays(
+                    bamfile, chrom, 0, chrom_len)
+        bamfile.close()
+        return coverage_arrays
+
+    bamfile.close()
+    return _compute_coverage_arrays_in_pool(bam_path, chrom_lens, processes)
+
+
+def _compute_coverage_arrays_in_pool(bam_path, chrom_lens, processes):
+    """Computes the coverage arrays of windows of the chromosomes in a pool
+    of processes.
+
+    The workers write their windows straight into memory-mapped arrays with
+    the chromosomes laid end to end, so that only the window coordinates are
+    passed between processes.
+    """
+    chrom_offsets = {}
+    total_len = 0
+    windows = []
+    for chrom, chrom_len in chrom_lens:
+        chrom_offsets[chrom] = total_len
+        for window_start in range(0, chrom_len, settings.COVERAGE_WINDOW_SIZE):
+            window_end = min(
+                    window_start + settings.COVERAGE_WINDOW_SIZE, chrom_len)
+            windows.append((chrom, total_len, window_start, window_end))
+        total_len += chrom_len
+
+    memmap_dir = tempfile.mkdtemp(dir=settings.TEMP_FILE_ROOT)
+    try:
+        memmap_paths = _get_memmap_paths(memmap_dir)
+        for memmap_path in memmap_paths.values():
+            np.memmap(memmap_path, dtype=np.int32, mode='w+',
+                    shape=(max(total_len, 1),)).flush()
+
+        if current_process().daemon:
+            _run_coverage_pool_in_subprocess(
+                    bam_path, memmap_dir, windows, processes)
+        else:
+            _run_coverage_pool(bam_path, memmap_paths, windows, processes)
+
+        coverage_arrays = dict((chrom, {}) for chrom, _ in chrom_lens)
+        for key, memmap_path in memmap_paths.iteritems():
+            memmap = np.memmap(memmap_path, dtype=np.int32, mode='r')
+            for chrom, chrom_len in chrom_lens:
+                offset = chrom_offsets[chrom]
+                coverage_arrays[chrom][key] = np.array(
+                        memmap[offset:offset + chrom_len])
+            del memmap
+    finally:
+        shutil.rmtree(memmap_dir)
+
+    return coverage_arrays
+
+
+def _get_memmap_paths(memmap_dir):
+    """Returns a dictionary from COVERAGE__* key to the path of its
+    memory-mapped array in memmap_dir.
+    """
+    return dict(
+            (key, os.path.join(memmap_dir, key + '.dat'))
+            for key in COVERAGE_KEYS)
+
+
+def _run_coverage_pool(bam_path, memmap_paths, windows, processes):
+    """Computes the windows in a pool of processes, writing them to the
+    memory-mapped arrays.
+    """
+    pool = Pool(processes, _init_coverage_worker,
+            (bam_path, memmap_paths))
+    try:
+        pool.map(_compute_window_coverage_arrays, windows)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _run_coverage_pool_in_subprocess(bam_path, memmap_dir, windows,
+        processes):
+    """Runs _run_coverage_pool() in a child python process, which unlike a
+    daemonic process may start the pool. See _main().
+    """
+    windows_path = os.path.join(memmap_dir, COVERAGE_WINDOWS_FILENAME)
+    with open(windows_path, 'w') as fh:
+        json.dump(windows, fh)
+
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    subprocess.check_call(
+            [sys.executable, '-m', 'pipeline.coverage',
+                    bam_path, memmap_dir, str(processes)],
+            cwd=settings.PWD, env=env)
+
+
+# State of each process of the coverage pool, set by _init_coverage_worker().
+_worker_bamfile = None
+_worker_memmaps = None
+
+
+def _init_coverage_worker(bam_path, memmap_paths):
+    """Opens the bam and the memory-mapped arrays once per pool process.
+    """
+    global _worker_bamfile
+    global _worker_memmaps
+    _worker_bamfile = pysam.AlignmentFile(bam_path, 'rb')
+    _worker_memmaps = dict(
+            (key, np.memmap(memmap_path, dtype=np.int32, mode='r+'))
+            for key, memmap_path in memmap_paths.iteritems())
+
+
+def _compute_window_coverage_arrays(window):
+    """Computes the coverage arrays of a window of a chromosome and writes
+    them to the memory-mapped arrays of the process.
+
+    Args:
+        window: Tuple (chrom, chrom_offset, window_start, window_end), where
+            chrom_offset is where the chromosome starts in the arrays.
+    """
+    (chrom, chrom_offset, window_start, window_end) = window
+    window_arrays = compute_chromosome_coverage_arrays(
+            _worker_bamfile, chrom, window_start, window_end)
+    for key, array in window_arrays.iteritems():
+        memmap = _worker_memmaps[key]
+        memmap[chrom_offset + window_start:chrom_offset + window_end] = array
+        memmap.flush()
+
+
+def compute_chromosome_coverage_arrays(bamfile, chrom, c_start, c_end):
+    """Returns a dictionary from COVERAGE__* key to an array with the value
+    at each position in [c_start, c_end) of the chromosome.
+
+    Reads are gone through once, adding their spans to difference arrays of
+    depth, depth of reads with mapping quality below CL__MIN_MAPQ, and depth
+    of reads with an alternative alignment as good as their alignment.
+    """
+    num_positions = c_end - c_start
+
+    read_starts = []
+    read_ends = []
+    is_low_mapq = []
+    is_altalign = []
+    for read in bamfile.fetch(chrom, c_start, c_end):
+        if read.flag & SKIPPED_READ_FLAGS:
+            continue
+        read_starts.append(max(read.reference_start, c_start) - c_start)
+        read_ends.append(min(read.reference_end, c_end) - c_start)
+        is_low_mapq.append(read.mapping_quality < settings.CL__MIN_MAPQ)
+        is_altalign.append(is_altalign_read(read))
+
+    read_starts = np.array(read_starts, dtype=np.int64)
+    read_ends = np.array(read_ends, dtype=np.int64)
+
+    def _depths(read_mask):
+        if not read_mask.any():
+            return np.zeros(num_positions, dtype=np.int32)
+        starts = read_starts[read_mask]
+        ends = read_ends[read_mask]
+        return np.cumsum(
+                np.bincount(starts, minlength=num_positions + 1) -
+                np.bincount(ends, minlength=num_positions + 1)
+                )[:num_positions].astype(np.int32)
+
+    return {
+        COVERAGE__DEPTHS: _depths(np.ones(len(read_starts), dtype=bool)),
+        COVERAGE__LOW_MAPQ: _depths(np.array(is_low_mapq, dtype=bool)),
+        COVERAGE__ALTALIGNS: _depths(np.array(is_altalign, dtype=bool)),
+    }
+
+
+def save_coverage_arrays(coverage_arrays, output_path):
+    """Saves the coverage arrays to a compressed .npz file.
+
+    Chromosome names may contain any characters, so arrays are saved under
+    the index of their chromosome in the saved list of chromosomes.
+    """
+    chromosomes = sorted(coverage_arrays.keys())
+    arrays = {}
+    for chrom_idx, chrom in enumerate(chromosomes):
+        for key, array in coverage_arrays[chrom].iteritems():
+            arrays['%d_%s' % (chrom_idx, key)] = array
+
+    with open(output_path, 'wb') as fh:
+        np.savez_compressed(fh, chromosomes=np.array(chromosomes), **arrays)
+
+
+def load_coverage_arrays(coverage_path):
+    """Loads coverage arrays saved by save_coverage_arrays().
+    """
+    coverage_arrays = {}
+    with np.load(coverage_path) as npz:
+        for chrom_idx, chrom in enumerate(npz['chromosomes']):
+            coverage_arrays[str(chrom)] = dict(
+                    (key, npz['%d_%s' % (chrom_idx, key)])
+                    for key in COVERAGE_KEYS)
+    return coverage_arrays
+
+
+def _main(argv):
+    """Runs the coverage pool for _run_coverage_pool_in_subprocess().
+
+    Usage:
+        python -m pipeline.coverage bam_path memmap_dir processes
+    """
+    bam_path, memmap_dir, processes = argv[1:]
+    with open(os.path.join(memmap_dir, COVERAGE_WINDOWS_FILENAME)) as fh:
+        windows = [(str(window[0]),) + tuple(window[1:])
+                for window in json.load(fh)]
+    _run_coverage_pool(bam_path, _get_memmap_paths(memmap_dir), windows,
+            int(processes))
+
+
+if __name__ == '__main__':
+    _main(sys.argv)
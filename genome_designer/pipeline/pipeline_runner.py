@@ -6,13 +6,20 @@ and carry out the gauntlet of steps to perform alignments, alignment
 cleaning, snv calling, and effect prediction.
 """
 
+from contextlib import contextmanager
 from datetime import datetime
+import errno
+import fcntl
+import json
 import os
 import time
 
 from celery import group
+from celery import signature
 from celery import task
 from django.conf import settings
+from django.db import connection
+from django.db import transaction
 
 from main.celery_util import assert_celery_running
 from main.models import AlignmentGroup
@@ -36,6 +43,16 @@ from pipeline.variant_calling.pindel import merge_pindel_vcf
 # up to the ui and only used internally.
 VARIANT_CALLING_OPTION__CALLER_OVERRIDE = 'enabled_variant_callers_override'
 
+# Celery queues for the resource-heavy pipeline tasks. See CELERY_QUEUES.
+PIPELINE_QUEUE__ALIGNMENT = 'alignment'
+PIPELINE_QUEUE__VARIANT_CALLING = 'variant_calling'
+
+# Resources that tasks reserve on a worker.
+RESOURCE__THREADS = 'threads'
+RESOURCE__MEMORY_MB = 'memory_mb'
+RESOURCE__SCRATCH_MB = 'scratch_mb'
+RESOURCES = (RESOURCE__THREADS, RESOURCE__MEMORY_MB, RESOURCE__SCRATCH_MB)
+
 
 def run_pipeline(alignment_group_label, ref_genome, sample_list,
         skip_alignment=False, perform_variant_calling=True, alignment_options={},
@@ -82,10 +99,10 @@ def run_pipeline(alignment_group_label, ref_genome, sample_list,
     #
 
     # NOTE: Nested chords in celery don't work so we need to break up the
-    # pipeline into # two separate pipelines: 1) alignment and 2) variant
-    # calling. This task is the first task in the variant calling pipeline which
-    # polls the database until all alignments are complete before kicking off
-    # parallel variant calling tasks.
+    # pipeline into two separate pipelines: 1) alignment and 2) variant
+    # calling. Each alignment is followed by alignment_completed, which
+    # counts down AlignmentGroup.pending_alignment_count, and the last one to
+    # finish starts the variant calling pipeline.
 
     # NOTE: Since we don't want results to be passed as arguments in the
     # chain, use .si(...) and not .s(...)
@@ -102,55 +119,54 @@ def run_pipeline(alignment_group_label, ref_genome, sample_list,
     # TODO: Revisit such calls and see if we can clean them up.
     ref_genome = ReferenceGenome.objects.get(uid=ref_genome.uid)
 
+    # The final task of the pipeline, which runs only after all previous tasks
+    # are complete. Its id is fixed now so that the caller can wait on the
+    # pipeline even though the variant calling part is only put together
+    # and started by the last alignment, when coverage is known.
+    pipeline_completion = pipeline_completion_tasks.si(alignment_group)
+    variant_calling_async_result = pipeline_completion.freeze()
+
+    # TODO(gleb): We had this to deal with race conditions. Do we still need it?
+    ref_genome.save()
+
+    # HACK(gleb): Force ALIGNING so that UI starts refreshing. This should be
+    # right, but I'm open to removing if it's not right for some case I
+    # didn't think of.
+    # We also hold one count on pending alignments ourselves, so that variant
+    # calling doesn't start before all alignments have been enqueued.
+    alignment_group.status = AlignmentGroup.STATUS.ALIGNING
+    alignment_group.start_time = datetime.now()
+    alignment_group.end_time = None
+    alignment_group.pending_alignment_count = len(sample_alignments_to_run) + 1
+    alignment_group.pending_vcf_parse_count = 0
+    alignment_group.save(update_fields=['status', 'start_time', 'end_time',
+            'pending_alignment_count', 'pending_vcf_parse_count'])
+
     # Now we aggregate the alignments that need to be run, collecting their
     # signatures in a Celery group so that these alignments can be run in
     # parallel.
     alignment_task_signatures = []
     for sample_alignment in sample_alignments_to_run:
         alignment_task_signatures.append(
-                align_with_bwa_mem.si(
-                        alignment_group, sample_alignment,
-                        project=ref_genome.project))
+                _get_alignment_task_signature(
+                        alignment_group, sample_alignment, ref_genome.project,
+                        perform_variant_calling, variant_calling_options,
+                        pipeline_completion))
 
+    # Run the pipeline. This is a non-blocking call when celery is running so
+    # the rest of code proceeds immediately.
     if len(alignment_task_signatures) > 0:
         alignment_task_group = group(alignment_task_signatures)
         alignment_task_group_async_result = alignment_task_group.apply_async()
     else:
         alignment_task_group_async_result = None
 
-    # HACK(gleb): Force ALIGNING so that UI starts refreshing. This should be
-    # right, but I'm open to removing if it's not right for some case I
-    # didn't think of.
-    alignment_group.status = AlignmentGroup.STATUS.ALIGNING
-    alignment_group.start_time = datetime.now()
-    alignment_group.end_time = None
-    alignment_group.save(update_fields=['status', 'start_time', 'end_time'])
-
-    # Aggregate variant callers, which run in parallel once all alignments
-    # are done.
-    if perform_variant_calling:
-        variant_caller_group = _construct_variant_caller_group(
-                alignment_group, variant_calling_options)
-    else:
-        variant_caller_group = None
-
-    # Put together the whole pipeline.
-    variant_calling_pipeline = start_variant_calling_pipeline_task.si(
-            alignment_group)
-    if variant_caller_group is not None:
-        variant_calling_pipeline = (variant_calling_pipeline |
-                variant_caller_group)
-
-    # Add a final task which runs only after all previous tasks are complete.
-    pipeline_completion = pipeline_completion_tasks.si(alignment_group)
-    variant_calling_pipeline = variant_calling_pipeline | pipeline_completion
-
-    # TODO(gleb): We had this to deal with race conditions. Do we still need it?
-    ref_genome.save()
-
-    # Run the pipeline. This is a non-blocking call when celery is running so
-    # the rest of code proceeds immediately.
-    variant_calling_async_result = variant_calling_pipeline.apply_async()
+    # Release our count. If the alignments are already done (e.g. there were
+    # none to run, or celery is running eagerly), start variant calling here.
+    if _decrement_pending_alignment_count(alignment_group) == 0:
+        variant_calling_async_result = start_variant_calling_pipeline(
+                alignment_group, perform_variant_calling,
+                variant_calling_options, pipeline_completion)
 
     return (
             alignment_group,
@@ -217,6 +233,52 @@ def _get_or_create_sample_alignment_datasets(alignment_group, sample_list):
     return sample_alignments_to_run
 
 
+def _get_alignment_task_signature(alignment_group, sample_alignment, project,
+        perform_variant_calling, variant_calling_options, pipeline_completion):
+    """Returns the signature of the alignment of a single sample, followed by
+    alignment_completed.
+
+    alignment_completed is also attached as the error callback of the
+    alignment, so that the pending alignment count is released when the
+    alignment raises and the rest of the chain doesn't run.
+    """
+    alignment_completion = alignment_completed.si(
+            alignment_group, perform_variant_calling,
+            variant_calling_options, pipeline_completion)
+    alignment_task = schedule_with_resources(
+            align_with_bwa_mem.si(alignment_group, sample_alignment,
+                    project=project),
+            PIPELINE_QUEUE__ALIGNMENT, project)
+    alignment_task.link_error(alignment_completion)
+    return alignment_task | alignment_completion
+
+
+def start_variant_calling_pipeline(alignment_group, perform_variant_calling,
+        variant_calling_options, pipeline_completion):
+    """Puts together and starts the variant calling part of the pipeline.
+
+    Args:
+        alignment_group: The AlignmentGroup, whose alignments are done.
+        perform_variant_calling: Whether to run variant calling.
+        variant_calling_options: Control aspects of calling variants.
+        pipeline_completion: Signature of the final task of the pipeline.
+
+    Returns:
+        The async result of the pipeline.
+    """
+    variant_calling_pipeline = start_variant_calling_pipeline_task.si(
+            alignment_group)
+
+    # Aggregate variant callers, which run in parallel.
+    if perform_variant_calling:
+        variant_calling_pipeline = (variant_calling_pipeline |
+                _construct_variant_caller_group(
+                        alignment_group, variant_calling_options))
+
+    variant_calling_pipeline = variant_calling_pipeline | pipeline_completion
+    return variant_calling_pipeline.apply_async()
+
+
 def _construct_variant_caller_group(alignment_group, variant_calling_options):
     """Returns celery Group of variant calling tasks that can be run
     in parallel.
@@ -244,8 +306,12 @@ def _construct_variant_caller_group(alignment_group, variant_calling_options):
 
         if settings.FREEBAYES_PARALLEL and tool == TOOL_FREEBAYES:
             # Special handling for freebayes if running parallel. Break up
-            # ReferenceGenome into regions and create separate job for each.
-            fb_regions = freebayes_regions(ref_genome)
+            # ReferenceGenome into regions, balanced by the coverage of the
+            # alignments, and create separate job for each.
+            fb_regions = freebayes_regions(ref_genome,
+                    sample_alignments=(
+                            ExperimentSampleToAlignment.objects.filter(
+                                    alignment_group=alignment_group)))
             assert len(fb_regions) >= 0
 
             for region_num, fb_region in enumerate(fb_regions):
@@ -254,9 +320,11 @@ def _construct_variant_caller_group(alignment_group, variant_calling_options):
                     'region': fb_region,
                     'region_num': region_num
                 }
-                parallel_tasks.append(find_variants_with_tool.si(
-                        alignment_group, region_params,
-                        project=ref_genome.project))
+                parallel_tasks.append(schedule_with_resources(
+                        find_variants_with_tool.si(
+                                alignment_group, region_params,
+                                project=ref_genome.project),
+                        PIPELINE_QUEUE__VARIANT_CALLING, ref_genome.project))
         elif tool in [TOOL_LUMPY, TOOL_PINDEL]:
             sample_alignment_list = (
                     alignment_group.experimentsampletoalignment_set.all())
@@ -281,66 +349,305 @@ def _construct_variant_caller_group(alignment_group, variant_calling_options):
                     'region_num': sa.uid,
                     'sample_alignments': [sa]
                 }
-                parallel_tasks.append(find_variants_with_tool.si(
-                        alignment_group, per_sample_params,
-                        project=ref_genome.project))
+                parallel_tasks.append(schedule_with_resources(
+                        find_variants_with_tool.si(
+                                alignment_group, per_sample_params,
+                                project=ref_genome.project),
+                        PIPELINE_QUEUE__VARIANT_CALLING, ref_genome.project))
         else:
-            parallel_tasks.append(find_variants_with_tool.si(
-                    alignment_group, tool_params, project=ref_genome.project))
+            parallel_tasks.append(schedule_with_resources(
+                    find_variants_with_tool.si(
+                            alignment_group, tool_params,
+                            project=ref_genome.project),
+                    PIPELINE_QUEUE__VARIANT_CALLING, ref_genome.project))
 
     variant_calling_pipeline = (group(parallel_tasks) |
             merge_variant_data.si(alignment_group))
     return variant_calling_pipeline
 
 
+###############################################################################
+# Resource-aware scheduling.
+###############################################################################
+
+def schedule_with_resources(task_signature, queue, project):
+    """Wraps a pipeline task signature so that it is routed to the given queue
+    and only starts once the worker that picks it up has the resources for it.
+
+    Args:
+        task_signature: Immutable signature of the task to run.
+        queue: One of the PIPELINE_QUEUE__* queues, which determines the
+            resource cost of the task.
+        project: The Project the task is run for, used for sharing the
+            worker fairly between projects.
+
+    Returns:
+        Immutable signature of a run_with_resources task.
+    """
+    return run_with_resources.si(task_signature, queue, project.uid).set(
+            queue=queue)
+
+
+@task(max_retries=None, ignore_result=False)
+def run_with_resources(task_signature, queue, project_uid):
+    """Runs the task in this worker once the resources it needs are free.
+
+    Workers on the same machine keep track of the resources reserved by their
+    running tasks in a shared ledger file. If the task doesn't fit, or if
+    starting it would give this project more than its share of the machine
+    while other projects are waiting, the task is put back on the queue to be
+    tried again later.
+    """
+    cost = get_task_resource_cost(queue)
+
+    if settings.CELERY_ALWAYS_EAGER:
+        return signature(task_signature).apply().get()
+
+    reservation_key = run_with_resources.request.id
+    if not _try_reserve_resources(reservation_key, project_uid, cost):
+        raise run_with_resources.retry(
+                countdown=settings.PIPELINE_ADMISSION_RETRY_SEC)
+
+    try:
+        return signature(task_signature).apply().get()
+    finally:
+        _release_resources(reservation_key)
+
+
+def get_task_resource_cost(queue):
+    """Returns dictionary from resource to the amount reserved by a task in
+    the given queue.
+    """
+    cost = dict((resource, 0) for resource in RESOURCES)
+    cost.update(settings.PIPELINE_TASK_RESOURCE_COSTS.get(queue, {}))
+    if queue == PIPELINE_QUEUE__ALIGNMENT:
+        cost[RESOURCE__THREADS] = settings.ALIGNMENT_THREADS
+    return cost
+
+
+def get_worker_capacity():
+    """Returns dictionary from resource to the amount available on this
+    machine.
+    """
+    capacity = dict(settings.PIPELINE_WORKER_CAPACITY)
+    if not capacity.get(RESOURCE__THREADS):
+        capacity[RESOURCE__THREADS] = os.sysconf('SC_NPROCESSORS_ONLN')
+    if not capacity.get(RESOURCE__MEMORY_MB):
+        capacity[RESOURCE__MEMORY_MB] = (os.sysconf('SC_PAGE_SIZE') *
+                os.sysconf('SC_PHYS_PAGES') / (1024 * 1024))
+
+    # Scratch space is whatever is free now, on top of what running tasks
+    # have already reserved.
+    media_stat = os.statvfs(settings.MEDIA_ROOT)
+    capacity[RESOURCE__SCRATCH_MB] = (
+            media_stat.f_bavail * media_stat.f_frsize / (1024 * 1024))
+    return capacity
+
+
+def can_admit(cost, project_uid, reservations, waiting_project_uids,
+        capacity):
+    """Decides whether a task can start.
+
+    A task is admitted if the resources it needs are free, or if nothing else
+    is running so that tasks larger than the machine still run. When other
+    projects have tasks waiting, a project may use at most an equal share of
+    the threads.
+
+    Args:
+        cost: Dictionary from resource to amount needed by the task.
+        project_uid: Uid of the Project the task belongs to.
+        reservations: List of dictionaries with keys 'project_uid' and 'cost'
+            for the running tasks.
+        waiting_project_uids: Set of uids of Projects with waiting tasks.
+        capacity: Dictionary from resource to the amount on the machine.
+            Scratch space is the amount currently free.
+
+    Returns:
+        Boolean.
+    """
+    if not reservations:
+        return True
+
+    reserved = dict((resource, 0) for resource in RESOURCES)
+    project_threads = 0
+    for reservation in reservations:
+        for resource in RESOURCES:
+            reserved[resource] += reservation['cost'].get(resource, 0)
+        if reservation['project_uid'] == project_uid:
+            project_threads += reservation['cost'].get(RESOURCE__THREADS, 0)
+
+    for resource in (RESOURCE__THREADS, RESOURCE__MEMORY_MB):
+        if reserved[resource] + cost[resource] > capacity[resource]:
+            return False
+    if cost[RESOURCE__SCRATCH_MB] > capacity[RESOURCE__SCRATCH_MB]:
+        return False
+
+    other_waiting_project_uids = set(waiting_project_uids) - set([project_uid])
+    if other_waiting_project_uids:
+        active_project_uids = other_waiting_project_uids | set(
+                [r['project_uid'] for r in reservations] + [project_uid])
+        fair_share = (float(capacity[RESOURCE__THREADS]) /
+                len(active_project_uids))
+        if (project_threads > 0 and
+                project_threads + cost[RESOURCE__THREADS] > fair_share):
+            return False
+
+    return True
+
+
+def _try_reserve_resources(reservation_key, project_uid, cost):
+    """Reserves the resources in the ledger if the task can be admitted.
+
+    Returns:
+        Boolean indicating whether the resources were reserved.
+    """
+    capacity = get_worker_capacity()
+    with _locked_resource_ledger() as ledger:
+        reservations = ledger['reservations']
+        waiting = ledger['waiting']
+
+        # Scratch reserved by running tasks hasn't necessarily been written
+        # yet, so don't count it as free.
+        capacity[RESOURCE__SCRATCH_MB] -= sum(
+                [r['cost'].get(RESOURCE__SCRATCH_MB, 0)
+                        for r in reservations.values()])
+
+        # Tasks are waiting under their own reservation key, so that a
+        # project stays waiting until all of its turned away tasks are in.
+        admitted = can_admit(cost, project_uid, reservations.values(),
+                set([w['project_uid'] for w in waiting.values()]), capacity)
+        if admitted:
+            reservations[reservation_key] = {
+                'pid': os.getpid(),
+                'project_uid': project_uid,
+                'cost': cost,
+            }
+            waiting.pop(reservation_key, None)
+        else:
+            waiting[reservation_key] = {
+                'project_uid': project_uid,
+                'last_seen': time.time(),
+            }
+    return admitted
+
+
+def _release_resources(reservation_key):
+    """Removes the reservation from the ledger.
+    """
+    with _locked_resource_ledger() as ledger:
+        ledger['reservations'].pop(reservation_key, None)
+
+
+@contextmanager
+def _locked_resource_ledger():
+    """Context manager that yields the ledger of the resources reserved on
+    this machine, holding an exclusive lock on it, and writes it back after.
+
+    Reservations of processes that no longer exist and waiting tasks that
+    haven't retried in a while are dropped.
+    """
+    ledger_path = settings.PIPELINE_RESOURCE_LEDGER_PATH
+    with open(ledger_path, 'a+') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            fh.seek(0)
+            contents = fh.read()
+            ledger = json.loads(contents) if contents else {}
+            ledger.setdefault('reservations', {})
+            ledger.setdefault('waiting', {})
+
+            for key, reservation in ledger['reservations'].items():
+                if not _is_process_alive(reservation['pid']):
+                    del ledger['reservations'][key]
+
+            waiting_expiration = (time.time() -
+                    3 * settings.PIPELINE_ADMISSION_RETRY_SEC)
+            for key, waiting in ledger['waiting'].items():
+                if waiting['last_seen'] < waiting_expiration:
+                    del ledger['waiting'][key]
+
+            yield ledger
+
+            fh.seek(0)
+            fh.truncate()
+            fh.write(json.dumps(ledger))
+            fh.flush()
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
 @task
-def start_variant_calling_pipeline_task(alignment_group):
-    """First task in variant calling pipeline which waits for all alignments
-    to be complete.
+def alignment_completed(alignment_group, perform_variant_calling,
+        variant_calling_options, pipeline_completion):
+    """Runs after each sample alignment in the pipeline. The last one to
+    complete starts the variant calling pipeline.
 
-    Nested chords in celery don't work so we need to break up the pipeline into
-    two separate pipelines: 1) alignment and 2) variant calling. This task is
-    the first task in the variant calling pipeline which polls the database
-    until all alignments are complete.
+    This is the next link in the chain of the alignment, and also its error
+    callback, so it runs whether the alignment succeeded or raised.
+
+    NOTE: If the worker running the alignment is killed outright (e.g. by the
+    OOM killer), celery calls neither, and the pipeline stays in ALIGNING.
     """
-    print 'START VARIANT CALLING PIPELINE. WAITING FOR ALIGNMENTS TO COMPLETE.'
+    if _decrement_pending_alignment_count(alignment_group) == 0:
+        start_variant_calling_pipeline(alignment_group,
+                perform_variant_calling, variant_calling_options,
+                signature(pipeline_completion))
+
+
+def _decrement_pending_alignment_count(alignment_group):
+    """Atomically decrements AlignmentGroup.pending_alignment_count.
+
+    Returns:
+        The new count.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+            'UPDATE main_alignmentgroup '
+            'SET pending_alignment_count = pending_alignment_count - 1 '
+            'WHERE id = %s '
+            'RETURNING pending_alignment_count',
+            (alignment_group.id,))
+    pending_alignment_count = cursor.fetchone()[0]
+    transaction.commit_unless_managed()
+    return pending_alignment_count
+
 
-    POLL_INTERVAL_SEC = 5
+@task
+def start_variant_calling_pipeline_task(alignment_group):
+    """First task in variant calling pipeline, which runs once all alignments
+    are complete.
+
+    Marks the AlignmentGroup as FAILED and stops the pipeline if any of the
+    alignments failed.
+    """
+    print 'START VARIANT CALLING PIPELINE.'
 
     sample_alignment_list = ExperimentSampleToAlignment.objects.filter(
             alignment_group=alignment_group)
 
-    all_samples_ready = False
-    failed = False
-    while not all_samples_ready:
-        all_samples_ready = True
-        for sa in sample_alignment_list:
-            sa_fresh = ExperimentSampleToAlignment.objects.get(id=sa.id)
-            bwa_dataset = sa_fresh.dataset_set.get(label=Dataset.TYPE.BWA_ALIGN)
-            if bwa_dataset.status == Dataset.STATUS.FAILED:
-                failed = True
-                # # DEBUG: Uncomment to see alignment error output
-                # print '---------------ALIGNMENT ERROR OUTPUT---------------\n'
-                # error_dataset = sa_fresh.dataset_set.get(
-                #         label=Dataset.TYPE.BWA_ALIGN_ERROR)
-                # with open(error_dataset.get_absolute_location(),'r') as fh:
-                #     for line in fh:
-                #         print line
-                break
-
-            if not bwa_dataset.status == Dataset.STATUS.READY:
-                all_samples_ready = False
-                break
-
-        if failed:
+    for sa in sample_alignment_list:
+        bwa_dataset = sa.dataset_set.get(label=Dataset.TYPE.BWA_ALIGN)
+        if bwa_dataset.status != Dataset.STATUS.READY:
+            # # DEBUG: Uncomment to see alignment error output
+            # print '---------------ALIGNMENT ERROR OUTPUT---------------\n'
+            # error_dataset = sa.dataset_set.get(
+            #         label=Dataset.TYPE.BWA_ALIGN_ERROR)
+            # with open(error_dataset.get_absolute_location(),'r') as fh:
+            #     for line in fh:
+            #         print line
             alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
             alignment_group.status = AlignmentGroup.STATUS.FAILED
             alignment_group.save(update_fields=['status'])
             raise Exception("Alignment failed.")
 
-        if not all_samples_ready:
-            time.sleep(POLL_INTERVAL_SEC)
-
     # All ready. Set VARIANT_CALLING.
     alignment_group.status = AlignmentGroup.STATUS.VARIANT_CALLING
     alignment_group.save(update_fields=['status'])
@@ -370,7 +677,7 @@ def merge_variant_data(alignment_group):
 
 
 
-@task
+@task(max_retries=None, ignore_result=False)
 def pipeline_completion_tasks(alignment_group):
     """Final set of synchronous steps after all alignments and variant callers
     are finished.
@@ -382,6 +689,12 @@ def pipeline_completion_tasks(alignment_group):
     # Get fresh copy of alignment_group.
     alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
 
+    # Large vcfs of the variant callers are parsed in the background (see
+    # variants.vcf_parser). Check again later until they are all loaded.
+    if alignment_group.pending_vcf_parse_count > 0:
+        raise pipeline_completion_tasks.retry(
+                countdown=settings.PIPELINE_COMPLETION_RETRY_SEC)
+
     # Previous status should have been VARIANT_CALLING. If anything else,
     # then pipeline failed.
     if AlignmentGroup.STATUS.VARIANT_CALLING == alignment_group.status:
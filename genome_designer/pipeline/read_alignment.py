@@ -20,9 +20,11 @@ from main.model_utils import get_dataset_with_type
 from main.s3 import project_files_needed
 from pipeline.read_alignment_util import ensure_bwa_index
 from pipeline.callable_loci import get_callable_loci
+from pipeline.coverage import get_coverage_arrays
 from pipeline.read_alignment_util import index_bam_file
-from pipeline.read_alignment_util import extract_split_reads
-from pipeline.read_alignment_util import extract_discordant_read_pairs
+from pipeline.read_alignment_util import get_split_read_query_name
+from pipeline.read_alignment_util import is_discordant_read
+from utils.bam_utils import split_bam_by_read_class
 from utils.import_util import add_dataset_to_entity
 from utils.jbrowse_util import add_bam_file_track
 from utils.jbrowse_util import add_bed_file_track
@@ -113,7 +115,7 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
         align_input_args = ' '.join([
             '%s/bwa/bwa' % settings.TOOLS_DIR,
             'mem',
-            '-t', '1', # threads
+            '-t', str(settings.ALIGNMENT_THREADS), # threads
             '-R', '"'+read_group_string(experiment_sample)+'"',
             # uncomment this to keep secondary alignments (for finding and marking paralogy regions)
             # But before we can uncomment we need to fix de novo assembly code
@@ -126,34 +128,41 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
             read_fq_2_path, read_fq_2_fn = os.path.split(input_reads_2_fq_path)
             align_input_args += ' ' + input_reads_2_fq
 
-        # To skip saving the SAM file to disk directly, pipe output directly to
-        # make a BAM file.
-        align_input_args += ' | ' + settings.SAMTOOLS_BINARY + ' view -bS -'
-
-        ### 2. Generate SAM output.
-        output_bam = os.path.join(sample_alignment.get_model_data_dir(),
-                'bwa_align.bam')
-
-        error_output.write(align_input_args)
-
-        # Flush the output here so it gets written before the alignments.
-        error_output.flush()
-
-        with open(output_bam, 'w') as fh:
-            subprocess.check_call(align_input_args,
-                    stdout=fh, stderr=error_output,
-                    shell=True, executable=settings.BASH_PATH)
-
         # Set processing mask to not compute insert metrics if reads are
         # not paired end, as the lumpy script only works on paired end reads
         opt_processing_mask = {}
         if not is_paired_end:
             opt_processing_mask['compute_insert_metrics'] = False
 
-        # Do several layers of processing on top of the initial alignment.
-        result_bam_file = process_sam_bam_file(sample_alignment,
-                alignment_group.reference_genome, output_bam, error_output,
-                opt_processing_mask=opt_processing_mask)
+        if settings.ALIGNMENT_STREAMED:
+            # Pipe the alignment through all processing steps that transform
+            # the reads, writing only the final bam.
+            result_bam_file = process_bwa_mem_stream(sample_alignment,
+                    alignment_group.reference_genome, align_input_args,
+                    error_output, opt_processing_mask=opt_processing_mask)
+        else:
+            # To skip saving the SAM file to disk directly, pipe output
+            # directly to make a BAM file.
+            align_input_args += ' | ' + settings.SAMTOOLS_BINARY + ' view -bS -'
+
+            ### 2. Generate SAM output.
+            output_bam = os.path.join(sample_alignment.get_model_data_dir(),
+                    'bwa_align.bam')
+
+            error_output.write(align_input_args)
+
+            # Flush the output here so it gets written before the alignments.
+            error_output.flush()
+
+            with open(output_bam, 'w') as fh:
+                subprocess.check_call(align_input_args,
+                        stdout=fh, stderr=error_output,
+                        shell=True, executable=settings.BASH_PATH)
+
+            # Do several layers of processing on top of the initial alignment.
+            result_bam_file = process_sam_bam_file(sample_alignment,
+                    alignment_group.reference_genome, output_bam,
+                    error_output, opt_processing_mask=opt_processing_mask)
 
         # Add the resulting file to the dataset.
         bwa_dataset.filesystem_location = clean_filesystem_location(
@@ -161,8 +170,7 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
         bwa_dataset.save()
 
         # Isolate split and discordant reads for SV calling.
-        get_discordant_read_pairs(sample_alignment)
-        get_split_reads(sample_alignment)
+        get_sv_read_datasets(sample_alignment)
 
         # Add track to JBrowse.
         add_bam_file_track(alignment_group.reference_genome, sample_alignment,
@@ -337,6 +345,93 @@ def process_sam_bam_file(sample_alignment, reference_genome,
     return final_bam_location
 
 
+def process_bwa_mem_stream(sample_alignment, reference_genome, bwa_mem_cmd,
+        error_output=None, opt_processing_mask=DEFAULT_PROCESSING_MASK):
+    """Runs bwa mem and pipes its output through sorting, duplicate removal
+    and MD tag filling, then indexes the result.
+
+    This produces the same final .bam file as running bwa mem to a file and
+    calling process_sam_bam_file(), but without writing and re-reading the
+    intermediate files. The sort and bwa mem use settings.ALIGNMENT_THREADS
+    threads.
+
+    Args:
+        sample_alignment: The relationship between a sample and an alignment
+        reference_genome: The ReferenceGenome aligned to.
+        bwa_mem_cmd: The bwa mem command, writing sam to stdout.
+        error_output: File handle that can be passed as stderr to subprocess
+            calls.
+        opt_processing_mask: An optional mask that can be modified to
+            specify which processes to run. Sorting, duplicate removal and
+            MD tag filling always happen in the stream.
+
+    Returns:
+        The path of the final .bam file.
+    """
+    effective_mask = copy.copy(DEFAULT_PROCESSING_MASK)
+    effective_mask.update(opt_processing_mask)
+
+    output_prefix = os.path.join(sample_alignment.get_model_data_dir(),
+            'bwa_align')
+    final_bam_location = output_prefix + '.sorted.withmd.bam'
+
+    ref_genome_fasta_location = get_dataset_with_type(
+            reference_genome,
+            Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
+
+    # Intermediate bams are passed uncompressed where the tool allows it.
+    # With pipefail, a failure anywhere in the pipe fails the whole command.
+    stream_cmd = 'set -o pipefail; ' + ' | '.join([
+            bwa_mem_cmd,
+            ' '.join([
+                    settings.SAMTOOLS_BINARY,
+                    'view',
+                    '-Sbu',
+                    '-']),
+            ' '.join([
+                    settings.SAMTOOLS_BINARY,
+                    'sort',
+                    '-o',
+                    '-@', str(settings.ALIGNMENT_THREADS),
+                    '-m', str(settings.ALIGNMENT_SORT_MEMORY_PER_THREAD),
+                    '-',
+                    output_prefix + '.sorted.tmp']),
+            ' '.join([
+                    settings.SAMTOOLS_BINARY,
+                    'rmdup',
+                    '-',
+                    '-']),
+            ' '.join([
+                    settings.SAMTOOLS_BINARY,
+                    'fillmd',
+                    '-b',
+                    '-',
+                    ref_genome_fasta_location])])
+
+    error_output.write(stream_cmd)
+
+    # Flush the output here so it gets written before the alignments.
+    error_output.flush()
+
+    with open(final_bam_location, 'w') as fh:
+        subprocess.check_call(stream_cmd, stdout=fh, stderr=error_output,
+                shell=True, executable=settings.BASH_PATH)
+
+    index_bam_file(final_bam_location, error_output)
+
+    # MD tag filling leaves the pairing info intact, so insert metrics can be
+    # computed from the final bam.
+    if effective_mask['compute_insert_metrics']:
+        compute_insert_metrics(final_bam_location, sample_alignment,
+                error_output)
+
+    if effective_mask['compute_callable_loci']:
+        compute_callable_loci(reference_genome, sample_alignment,
+                final_bam_location, error_output)
+
+    return final_bam_location
+
+
 def read_group_string(experiment_sample):
     """
     Generate a SAM header string for the read group.
@@ -433,7 +528,12 @@ def compute_callable_loci(reference_genome, sample_alignment,
         callable_loci_bed_fn = (
                 _get_callable_loci_output_filename(bam_file_location))
 
-        get_callable_loci(bam_file_location, callable_loci_bed_fn)
+        # The alignment was just made, so any saved coverage is stale.
+        coverage_arrays = get_coverage_arrays(sample_alignment,
+                bam_path=bam_file_location, overwrite=True)
+
+        get_callable_loci(bam_file_location, callable_loci_bed_fn,
+                coverage_arrays=coverage_arrays)
 
         # Add callable loci bed as dataset
         callable_loci_bed_dataset = Dataset.objects.create(
@@ -591,82 +691,64 @@ def get_insert_size_mean_and_stdev(sample_alignment, stderr=None, _iteration=0):
             return tuple([int(p) for p in parts])
 
 
+# Reads indicating structural variants that are isolated after alignment.
+SV_READ_CLASSES = {
+    Dataset.TYPE.BWA_DISCORDANT: ('bwa_discordant_pairs.bam',
+            is_discordant_read),
+    Dataset.TYPE.BWA_SPLIT: ('bwa_split_reads.bam',
+            get_split_read_query_name),
+}
+
+
 def get_discordant_read_pairs(sample_alignment):
     """Isolate discordant pairs of reads from a sample alignment.
     """
-    # First, check if completed dataset already exists.
-    bwa_disc_dataset = get_dataset_with_type(
-            sample_alignment, Dataset.TYPE.BWA_DISCORDANT)
-    if bwa_disc_dataset is not None:
-        if (bwa_disc_dataset.status == Dataset.STATUS.READY and
-                os.path.exists(bwa_disc_dataset.get_absolute_location())):
-            return bwa_disc_dataset
-    else:
-        bwa_disc_dataset = Dataset.objects.create(
-                label=Dataset.TYPE.BWA_DISCORDANT,
-                type=Dataset.TYPE.BWA_DISCORDANT)
-        sample_alignment.dataset_set.add(bwa_disc_dataset)
-
-    # If here, we are going to run or re-run the Dataset.
-    bwa_disc_dataset.status = Dataset.STATUS.NOT_STARTED
-    bwa_disc_dataset.save(update_fields=['status'])
-
-    bam_dataset = get_dataset_with_type(sample_alignment, Dataset.TYPE.BWA_ALIGN)
-    bam_filename = bam_dataset.get_absolute_location()
-
-    assert os.path.exists(bam_filename), "BAM file '%s' is missing." % (
-            bam_filename)
-
-    # NOTE: This assumes the index just adds at .bai, w/ same path otherwise
-    # - will this always be true?
-    if not os.path.exists(bam_filename+'.bai'):
-        index_bam_file(bam_filename)
+    return get_sv_read_datasets(sample_alignment,
+            [Dataset.TYPE.BWA_DISCORDANT])[0]
 
-    bam_discordant_filename = os.path.join(sample_alignment.get_model_data_dir(),
-            'bwa_discordant_pairs.bam')
 
-    try:
-        bwa_disc_dataset.status = Dataset.STATUS.COMPUTING
-        bwa_disc_dataset.save(update_fields=['status'])
-        extract_discordant_read_pairs(bam_filename, bam_discordant_filename)
-
-    except subprocess.CalledProcessError:
-        bwa_disc_dataset.filesystem_location = ''
-        bwa_disc_dataset.status = Dataset.STATUS.FAILED
-    finally:
-        bwa_disc_dataset.status = Dataset.STATUS.READY
-        bwa_disc_dataset.filesystem_location = clean_filesystem_location(
-                bam_discordant_filename)
+def get_split_reads(sample_alignment):
+    """Isolate split reads from a sample alignment.
 
-    bwa_disc_dataset.save()
+    NOTE THAT THIS ONLY WORKS WITH BWA MEM.
+    """
+    return get_sv_read_datasets(sample_alignment,
+            [Dataset.TYPE.BWA_SPLIT])[0]
 
-    return bwa_disc_dataset
 
+def get_sv_read_datasets(sample_alignment,
+        dataset_types=(Dataset.TYPE.BWA_DISCORDANT, Dataset.TYPE.BWA_SPLIT)):
+    """Isolates the classes of reads indicating structural variants from a
+    sample alignment, in a single pass over the alignment.
 
-def get_split_reads(sample_alignment):
-    """Isolate split reads from a sample alignment.
+    Datasets that are already READY are returned as they are.
 
-    This uses a python script supplied with Lumpy that is run as a
-    separate process.
+    Args:
+        sample_alignment: The ExperimentSampleToAlignment.
+        dataset_types: Dataset types among the keys of SV_READ_CLASSES.
 
-    NOTE THAT THIS SCRIPT ONLY WORKS WITH BWA MEM.
+    Returns:
+        List of Datasets, in the order of dataset_types.
     """
-    bwa_split_dataset = get_dataset_with_type(
-            sample_alignment, Dataset.TYPE.BWA_SPLIT)
-    if bwa_split_dataset is not None:
-        if (bwa_split_dataset.status == Dataset.STATUS.READY and
-                os.path.exists(bwa_split_dataset.get_absolute_location())):
-            return bwa_split_dataset
-    else:
-        bwa_split_dataset = Dataset.objects.create(
-                label=Dataset.TYPE.BWA_SPLIT,
-                type=Dataset.TYPE.BWA_SPLIT,
-                status=Dataset.STATUS.NOT_STARTED)
-        sample_alignment.dataset_set.add(bwa_split_dataset)
-
-    # If here, we are going to run or re-run the Dataset.
-    bwa_split_dataset.status = Dataset.STATUS.NOT_STARTED
-    bwa_split_dataset.save(update_fields=['status'])
+    datasets = []
+    datasets_to_compute = []
+    for dataset_type in dataset_types:
+        dataset = get_dataset_with_type(sample_alignment, dataset_type)
+        if dataset is None:
+            dataset = Dataset.objects.create(
+                    label=dataset_type,
+                    type=dataset_type,
+                    status=Dataset.STATUS.NOT_STARTED)
+            sample_alignment.dataset_set.add(dataset)
+        elif (dataset.status == Dataset.STATUS.READY and
+                os.path.exists(dataset.get_absolute_location())):
+            datasets.append(dataset)
+            continue
+        datasets.append(dataset)
+        datasets_to_compute.append(dataset)
+
+    if not datasets_to_compute:
+        return datasets
 
     bam_dataset = get_dataset_with_type(sample_alignment, Dataset.TYPE.BWA_ALIGN)
     bam_filename = bam_dataset.get_absolute_location()
@@ -674,27 +756,31 @@ def get_split_reads(sample_alignment):
     assert os.path.exists(bam_filename), "BAM file '%s' is missing." % (
             bam_filename)
 
-    bam_split_filename = os.path.join(sample_alignment.get_model_data_dir(),
-            'bwa_split_reads.bam')
-
-    try:
-        bwa_split_dataset.status = Dataset.STATUS.COMPUTING
-        bwa_split_dataset.save(update_fields=['status'])
-        extract_split_reads(bam_filename, bam_split_filename)
-
-    except subprocess.CalledProcessError:
-        # if there are no split reads, then fail.
-        bwa_split_dataset.filesystem_location = ''
-        bwa_split_dataset.status = Dataset.STATUS.FAILED
-    finally:
-        bwa_split_dataset.status = Dataset.STATUS.READY
-        bwa_split_dataset.filesystem_location = clean_filesystem_location(
-                bam_split_filename)
+    read_classes = []
+    for dataset in datasets_to_compute:
+        (filename, class_fn) = SV_READ_CLASSES[dataset.type]
+        output_filename = os.path.join(sample_alignment.get_model_data_dir(),
+                filename)
+        read_classes.append((output_filename, class_fn))
 
+        dataset.status = Dataset.STATUS.COMPUTING
+        dataset.filesystem_location = clean_filesystem_location(
+                output_filename)
+        dataset.save(update_fields=['status', 'filesystem_location'])
 
-    bwa_split_dataset.save()
-
-    return bwa_split_dataset
+    try:
+        split_bam_by_read_class(bam_filename, read_classes)
+        status = Dataset.STATUS.READY
+    except (IOError, ValueError):
+        status = Dataset.STATUS.FAILED
+
+    for dataset in datasets_to_compute:
+        dataset.status = status
+        if status == Dataset.STATUS.FAILED:
+            dataset.filesystem_location = ''
+        dataset.save(update_fields=['status', 'filesystem_location'])
+
+    return datasets
 
 ##############################################################################
 # Clean-ups
@@ -13,15 +13,27 @@ ImportError: cannot import name ensure_bwa_index
 """
 
 import os
+import re
 import subprocess
 
-from utils.bam_utils import filter_bam_file_by_row
+from utils.bam_utils import split_bam_by_read_class
 
 from django.conf import settings
 
 SAMTOOLS_BINARY = settings.SAMTOOLS_BINARY
 TOOLS_DIR = settings.TOOLS_DIR
 
+# Characters of the cigar operations, indexed by the codes used by pysam.
+CIGAR_OPS = 'MIDNSHP=X'
+
+# Split reads have at most this many parts, i.e. one fewer supplementary
+# alignments.
+SPLIT_READ_MAX_SPLITS = 2
+
+# Minimum number of query bases of each part of a split read that are not
+# also in the other part.
+SPLIT_READ_MIN_NON_OVERLAP = 20
+
 
 def has_bwa_index(ref_genome_fasta):
     return os.path.exists(ref_genome_fasta + '.bwt')
@@ -70,82 +82,114 @@ def index_bam_file(bam_file, error_output=None):
 
 def extract_split_reads(bam_filename, bam_split_filename):
     """
-    Isolate split reads from a bam file.
-    This uses a python script supplied with Lumpy that is run as a
-    separate process.
+    Isolate split reads from a bam file. See get_split_read_query_name().
 
     This is an internal function that works directly with files, and
     is called separately by both SV calling and read ref alignment.
 
-    NOTE THAT THIS SCRIPT ONLY WORKS WITH BWA MEM.
+    NOTE THAT THIS ONLY WORKS WITH BWA MEM.
     """
     assert os.path.exists(bam_filename), "BAM file '%s' is missing." % (
             bam_filename)
+    split_bam_by_read_class(bam_filename,
+            [(bam_split_filename, get_split_read_query_name)])
 
-    # Use lumpy bwa-mem split read script to pull out split reads.
-    filter_split_reads = ' | '.join([
-            '{samtools} view -h {bam_filename}',
-            'python {lumpy_bwa_mem_sr_script} -i stdin',
-            '{samtools} view -Sb -']).format(
-                    samtools=settings.SAMTOOLS_BINARY,
-                    bam_filename=bam_filename,
-                    lumpy_bwa_mem_sr_script=
-                            settings.LUMPY_EXTRACT_SPLIT_READS_BWA_MEM)
-
-    with open(bam_split_filename, 'w') as fh:
-        subprocess.check_call(filter_split_reads,
-                stdout=fh,
-                shell=True,
-                executable=settings.BASH_PATH)
-
-    # sort the split reads, overwrite the old file
-    subprocess.check_call([settings.SAMTOOLS_BINARY, 'sort',
-            bam_split_filename,
-            os.path.splitext(bam_split_filename)[0]])
-
-    _filter_out_interchromosome_reads(bam_split_filename)
 
 def extract_discordant_read_pairs(bam_filename, bam_discordant_filename):
-    """Isolate discordant pairs of reads from a sample alignment.
+    """Isolate discordant pairs of reads from a sample alignment. See
+    is_discordant_read().
+    """
+    split_bam_by_read_class(bam_filename,
+            [(bam_discordant_filename, is_discordant_read)])
+
+
+def is_discordant_read(read):
+    """Whether the read is part of a pair that isn't properly paired, with
+    both reads mapped to the same chromosome. Secondary alignments and
+    duplicates are left out.
     """
-    # Use bam read alignment flags to pull out discordant pairs only
-    filter_discordant = ' | '.join([
-            '{samtools} view -u -F 0x0002 {bam_filename} ',
-            '{samtools} view -u -F 0x0100 - ',
-            '{samtools} view -u -F 0x0004 - ',
-            '{samtools} view -u -F 0x0008 - ',
-            '{samtools} view -b -F 0x0400 - ']).format(
-                    samtools=settings.SAMTOOLS_BINARY,
-                    bam_filename=bam_filename)
-
-    with open(bam_discordant_filename, 'w') as fh:
-        subprocess.check_call(filter_discordant,
-                stdout=fh, shell=True, executable=settings.BASH_PATH)
-
-    # sort the discordant reads, overwrite the old file
-    subprocess.check_call([settings.SAMTOOLS_BINARY, 'sort', 
-            bam_discordant_filename,
-            os.path.splitext(bam_discordant_filename)[0]])
-
-    _filter_out_interchromosome_reads(bam_discordant_filename)
-
-
-def _filter_out_interchromosome_reads(bam_filename, overwrite_input=True):
-    """Filters out read pairs which lie on different chromosomes.
-
-    Args:
-        bam_filename: Path to bam file.
-        overwrite_input: If True, overwrite the input file.
+    return (not read.is_proper_pair and
+            not read.is_secondary and
+            not read.is_unmapped and
+            not read.mate_is_unmapped and
+            not read.is_duplicate and
+            _is_mate_on_same_chromosome(read))
+
+
+def is_altalign_read(read):
+    """Whether the read has an alternative alignment at least as good as its
+    alignment.
     """
-    def is_rnext_same(line):
-        parts = line.split('\t')
-        rnext_col = parts[6]
-        return rnext_col == '='
+    return (read.has_tag('XS') and read.has_tag('AS') and
+            read.get_tag('AS') <= read.get_tag('XS'))
 
-    if overwrite_input:
-        output_bam_path = bam_filename
-    else:
-        output_bam_path = os.path.splitext(bam_filename)[0] + '.nointerchrom.bam'
 
-    filter_bam_file_by_row(bam_filename, is_rnext_same, output_bam_path)
+def get_split_read_query_name(read):
+    """Returns the query name to give the read in a bam of split reads, or
+    None if the read isn't a split read.
 
+    Follows the extractSplitReads_BwaMem script supplied with Lumpy: a split
+    read has at most SPLIT_READ_MAX_SPLITS - 1 supplementary alignments (SA
+    tag), and both it and the first supplementary alignment have at least
+    SPLIT_READ_MIN_NON_OVERLAP query bases not covered by the other.
+    Duplicates are left out, and the read is named with a _1 or _2 suffix
+    according to which read of the pair it is. We also leave out reads
+    whose mate is not on the same chromosome.
+    """
+    if read.is_duplicate or read.is_unmapped or not read.has_tag('SA'):
+        return None
+
+    supplementary_alignments = read.get_tag('SA').split(';')
+    if len(supplementary_alignments) > SPLIT_READ_MAX_SPLITS:
+        return None
+
+    if not _is_mate_on_same_chromosome(read):
+        return None
+
+    # Query intervals covered by the read and its supplementary alignment,
+    # in the orientation of the sequenced read.
+    supplementary_alignment = supplementary_alignments[0].split(',')
+    supplementary_cigar_ops = [(op, int(length)) for length, op in
+            re.findall(r'([0-9]+)([A-Z=])', supplementary_alignment[3])]
+    if supplementary_alignment[2] == '-':
+        supplementary_cigar_ops.reverse()
+    read_cigar_ops = [(CIGAR_OPS[op], length)
+            for op, length in read.cigartuples]
+    if read.is_reverse:
+        read_cigar_ops.reverse()
+    (read_start, read_end) = _get_aligned_query_interval(read_cigar_ops)
+    (supplementary_start, supplementary_end) = _get_aligned_query_interval(
+            supplementary_cigar_ops)
+
+    overlap = max(0, 1 + min(read_end, supplementary_end) -
+            max(read_start, supplementary_start))
+    min_non_overlap = min(
+            1 + read_end - read_start - overlap,
+            1 + supplementary_end - supplementary_start - overlap)
+    if min_non_overlap < SPLIT_READ_MIN_NON_OVERLAP:
+        return None
+
+    return read.query_name + ('_1' if read.is_read1 else '_2')
+
+
+def _get_aligned_query_interval(cigar_ops):
+    """Returns (start, end) of the aligned part of the query, from a list of
+    (op, length) cigar operations, as computed by Lumpy.
+    """
+    start = 0
+    end = 0
+    seen_aligned = False
+    for op, length in cigar_ops:
+        if op in ('H', 'S'):
+            if not seen_aligned:
+                start += length
+                end += length
+        elif op in ('M', 'I'):
+            end += length
+            seen_aligned = True
+    return (start, end)
+
+
+def _is_mate_on_same_chromosome(read):
+    return (read.next_reference_id >= 0 and
+            read.next_reference_id == read.reference_id)
@@ -27,3 +27,20 @@ class TestCallableLoci(TestCase):
         bed_output_path = os.path.join(tdir, 'callable_loci.bed')
 
         get_callable_loci(test_bam, bed_output_path)
+
+        with open(bed_output_path) as fh:
+            bed_records = [line.rstrip('\n').split('\t') for line in fh]
+        self.assertEqual([
+                ['NC_000913', '2001', '2001', 'LOW_COVERAGE'],
+                ['NC_000913', '2002', '2997', 'NO_COVERAGE'],
+                ['NC_000913', '2998', '2999', 'LOW_COVERAGE'],
+                ['NC_000913', '9999', '10000', 'LOW_COVERAGE']],
+                bed_records)
+
+        # Restricting to a region of the chromosome.
+        get_callable_loci(test_bam, bed_output_path, chrom='NC_000913',
+                start=2000, end=6000)
+        with open(bed_output_path) as fh:
+            bed_records = [line.rstrip('\n').split('\t') for line in fh]
+        self.assertEqual(3, len(bed_records))
+        self.assertEqual('NO_COVERAGE', bed_records[1][3])
@@ -2,19 +2,36 @@
 Tests for pipeline_runner.py
 """
 
+import json
 import os
+import shutil
+import subprocess
+import tempfile
+import time
 
+from celery import task
+from celery.exceptions import Retry
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.test import TestCase
 from django.test import TransactionTestCase
+from django.test.utils import override_settings
 
 from main.models import AlignmentGroup
 from main.models import Dataset
 from main.models import ExperimentSample
+from main.models import ExperimentSampleToAlignment
 from main.models import Project
 from main.models import Variant
 from main.testing_util import FullVCFTestSet
+from pipeline.pipeline_runner import _get_alignment_task_signature
+from pipeline.pipeline_runner import _locked_resource_ledger
+from pipeline.pipeline_runner import _release_resources
+from pipeline.pipeline_runner import can_admit
+from pipeline.pipeline_runner import pipeline_completion_tasks
 from pipeline.pipeline_runner import run_pipeline
+from pipeline.pipeline_runner import run_with_resources
+from pipeline.pipeline_runner import PIPELINE_QUEUE__VARIANT_CALLING
 from utils.import_util import copy_and_add_dataset_source
 from utils.import_util import import_reference_genome_from_local_file
 
@@ -42,6 +59,11 @@ TEST_SAMPLE_2_FASTQ2 = os.path.join(FAKE_GENOME_AND_READS_DIR,
         '9b19e708', 'test_genome_2.snps.simLibrary.2.fq')
 
 
+@task
+def echo(value):
+    return value
+
+
 class TestAlignmentPipeline(TransactionTestCase):
     """Tests for the pipeline.
 
@@ -108,6 +130,7 @@ class TestAlignmentPipeline(TransactionTestCase):
         alignment_group = AlignmentGroup.objects.get(uid=alignment_group.uid)
         self.assertEqual(AlignmentGroup.STATUS.COMPLETED,
                 alignment_group.status)
+        self.assertEqual(0, alignment_group.pending_alignment_count)
 
         # Make sure some expected variants are found.
         variants = Variant.objects.filter(
@@ -279,3 +302,169 @@ class TestAlignmentPipeline(TransactionTestCase):
         # for a failed alignment to the user.
         with self.assertRaises(Exception):
             run_pipeline('name_placeholder', ref_genome, sample_list)
+
+    def test_alignment_task__raises(self):
+        """The pending alignment count is released when the alignment task
+        raises, rather than recording its failure and returning.
+        """
+        alignment_group = AlignmentGroup.objects.create(
+                label='name_placeholder',
+                reference_genome=self.reference_genome,
+                aligner=AlignmentGroup.ALIGNER.BWA,
+                pending_alignment_count=1)
+        sample_alignment = ExperimentSampleToAlignment.objects.create(
+                alignment_group=alignment_group,
+                experiment_sample=self.experiment_sample)
+        bwa_dataset = Dataset.objects.create(
+                label=Dataset.TYPE.BWA_ALIGN,
+                type=Dataset.TYPE.BWA_ALIGN,
+                status=Dataset.STATUS.NOT_STARTED)
+        sample_alignment.dataset_set.add(bwa_dataset)
+
+        # Without its data dir, the alignment fails to open its error log
+        # and raises.
+        shutil.rmtree(sample_alignment.get_model_data_dir())
+
+        alignment_task = _get_alignment_task_signature(
+                alignment_group, sample_alignment, self.project, False, {},
+                pipeline_completion_tasks.si(alignment_group))
+        with self.settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=False):
+            with self.assertRaises(IOError):
+                alignment_task.apply()
+
+        alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
+        self.assertEqual(0, alignment_group.pending_alignment_count)
+        self.assertEqual(AlignmentGroup.STATUS.FAILED, alignment_group.status)
+
+
+class TestCanAdmit(TestCase):
+
+    CAPACITY = {'threads': 4, 'memory_mb': 8000, 'scratch_mb': 10000}
+
+    def _cost(self, threads):
+        return {'threads': threads, 'memory_mb': 1000, 'scratch_mb': 100}
+
+    def test_capacity(self):
+        self.assertTrue(can_admit(self._cost(2), 'p1', [], set(),
+                self.CAPACITY))
+
+        # A task larger than the machine still runs when nothing else does.
+        self.assertTrue(can_admit(self._cost(8), 'p1', [], set(),
+                self.CAPACITY))
+
+        running = [{'project_uid': 'p1', 'cost': self._cost(3)}]
+        self.assertTrue(can_admit(self._cost(1), 'p1', running, set(),
+                self.CAPACITY))
+        self.assertFalse(can_admit(self._cost(2), 'p1', running, set(),
+                self.CAPACITY))
+
+    def test_fair_share(self):
+        running = [{'project_uid': 'p1', 'cost': self._cost(2)}]
+
+        # Nobody else waiting, so p1 can use the whole machine.
+        self.assertTrue(can_admit(self._cost(1), 'p1', running, set(),
+                self.CAPACITY))
+
+        # p2 is waiting, so p1 is held to half the threads while p2 can
+        # start.
+        self.assertFalse(can_admit(self._cost(1), 'p1', running,
+                set(['p2']), self.CAPACITY))
+        self.assertTrue(can_admit(self._cost(1), 'p2', running,
+                set(['p2']), self.CAPACITY))
+
+
+class TestRunWithResources(TestCase):
+
+    def setUp(self):
+        _, self.ledger_path = tempfile.mkstemp(suffix='.json')
+        self.settings_override = override_settings(
+                CELERY_ALWAYS_EAGER=False,
+                PIPELINE_RESOURCE_LEDGER_PATH=self.ledger_path,
+                PIPELINE_WORKER_CAPACITY={'threads': 2, 'memory_mb': 8000},
+                PIPELINE_TASK_RESOURCE_COSTS={
+                    PIPELINE_QUEUE__VARIANT_CALLING: {
+                        'threads': 1,
+                        'memory_mb': 1000,
+                        'scratch_mb': 0,
+                    },
+                })
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        os.remove(self.ledger_path)
+
+    def _write_ledger(self, ledger):
+        with open(self.ledger_path, 'w') as fh:
+            fh.write(json.dumps(ledger))
+
+    def _run_with_resources(self, task_id, project_uid):
+        """Runs run_with_resources as a worker would for the given task id.
+        """
+        run_with_resources.push_request(id=task_id)
+        try:
+            return run_with_resources.run(echo.si(task_id),
+                    PIPELINE_QUEUE__VARIANT_CALLING, project_uid)
+        finally:
+            run_with_resources.pop_request()
+
+    def test_locked_resource_ledger(self):
+        finished_process = subprocess.Popen(['true'])
+        finished_process.wait()
+        cost = {'threads': 1, 'memory_mb': 1000, 'scratch_mb': 0}
+        self._write_ledger({
+            'reservations': {
+                'alive': {'pid': os.getpid(), 'project_uid': 'p1',
+                        'cost': cost},
+                'dead': {'pid': finished_process.pid, 'project_uid': 'p1',
+                        'cost': cost},
+            },
+            'waiting': {
+                'recent': {'project_uid': 'p2', 'last_seen': time.time()},
+                'stale': {'project_uid': 'p3', 'last_seen': 0},
+            },
+        })
+
+        with _locked_resource_ledger() as ledger:
+            self.assertEqual(['alive'], ledger['reservations'].keys())
+            self.assertEqual(['recent'], ledger['waiting'].keys())
+            ledger['waiting']['added'] = {
+                'project_uid': 'p4',
+                'last_seen': time.time(),
+            }
+
+        # Changes are written back.
+        with _locked_resource_ledger() as ledger:
+            self.assertEqual(set(['recent', 'added']),
+                    set(ledger['waiting'].keys()))
+
+    def test_run_with_resources__retry(self):
+        # p1 is using the whole machine.
+        self._write_ledger({
+            'reservations': {
+                'p1_task': {
+                    'pid': os.getpid(),
+                    'project_uid': 'p1',
+                    'cost': {'threads': 2, 'memory_mb': 1000,
+                            'scratch_mb': 0},
+                },
+            },
+        })
+
+        # Both tasks of p2 are turned away, to be retried later.
+        with self.assertRaises(Retry):
+            self._run_with_resources('p2_task_1', 'p2')
+        with self.assertRaises(Retry):
+            self._run_with_resources('p2_task_2', 'p2')
+        with _locked_resource_ledger() as ledger:
+            self.assertEqual(set(['p2_task_1', 'p2_task_2']),
+                    set(ledger['waiting'].keys()))
+
+        # Once p1 is done, the retried task runs and releases its resources
+        # after. p2 is still waiting with its other task.
+        _release_resources('p1_task')
+        self.assertEqual('p2_task_1',
+                self._run_with_resources('p2_task_1', 'p2'))
+        with _locked_resource_ledger() as ledger:
+            self.assertEqual({}, ledger['reservations'])
+            self.assertEqual(['p2_task_2'], ledger['waiting'].keys())
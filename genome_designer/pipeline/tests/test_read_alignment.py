@@ -3,12 +3,15 @@ Tests for read_alignment.py
 """
 
 import json
+from multiprocessing import Process
 import os
 import subprocess
+import tempfile
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TestCase
+import pysam
 
 from main.models import AlignmentGroup
 from main.models import Dataset
@@ -18,10 +21,18 @@ from main.models import ExperimentSampleToAlignment
 from main.models import Project
 from main.model_utils import clean_filesystem_location
 from main.testing_util import create_sample_and_alignment
+from pipeline.coverage import COVERAGE__ALTALIGNS
+from pipeline.coverage import COVERAGE__DEPTHS
+from pipeline.coverage import COVERAGE__LOW_MAPQ
+from pipeline.coverage import compute_coverage_arrays
+from pipeline.coverage import get_coverage_arrays
+from pipeline.coverage import load_coverage_arrays
+from pipeline.coverage import save_coverage_arrays
 from pipeline.read_alignment import align_with_bwa_mem
 from pipeline.read_alignment import compute_callable_loci
 from pipeline.read_alignment import get_discordant_read_pairs
 from pipeline.read_alignment import get_split_reads
+from pipeline.read_alignment import get_sv_read_datasets
 from pipeline.read_alignment import get_read_length
 from pipeline.read_alignment import get_insert_size_mean_and_stdev
 from pipeline.read_alignment_util import index_bam_file
@@ -159,6 +170,42 @@ class TestAlignmentPipeline(TestCase):
                     break
             self.assertTrue(found_bam_track)
 
+    def test_bwa_align_mem__streamed_matches_unstreamed(self):
+        """Tests that piping the alignment through the processing steps gives
+        the same reads as processing the intermediate files.
+        """
+        def _align(label):
+            alignment_group = AlignmentGroup.objects.create(
+                    label=label, reference_genome=self.reference_genome)
+            sample_alignment = ExperimentSampleToAlignment.objects.create(
+                    alignment_group=alignment_group,
+                    experiment_sample=self.experiment_sample)
+            bwa_dataset = Dataset.objects.create(
+                        label=Dataset.TYPE.BWA_ALIGN,
+                        type=Dataset.TYPE.BWA_ALIGN,
+                        status=Dataset.STATUS.NOT_STARTED)
+            sample_alignment.dataset_set.add(bwa_dataset)
+            sample_alignment.save()
+
+            align_with_bwa_mem(alignment_group, sample_alignment,
+                    project=self.project)
+
+            bwa_align_dataset = get_dataset_with_type(
+                    sample_alignment, Dataset.TYPE.BWA_ALIGN)
+            self.assertEqual(Dataset.STATUS.READY, bwa_align_dataset.status)
+            reads = subprocess.check_output([
+                    settings.SAMTOOLS_BINARY, 'view',
+                    bwa_align_dataset.get_absolute_location()])
+            return sorted(reads.splitlines())
+
+        with self.settings(ALIGNMENT_STREAMED=False):
+            unstreamed_reads = _align('unstreamed')
+        with self.settings(ALIGNMENT_STREAMED=True, ALIGNMENT_THREADS=2):
+            streamed_reads = _align('streamed')
+
+        self.assertTrue(len(streamed_reads) > 0)
+        self.assertEqual(unstreamed_reads, streamed_reads)
+
     def test_compressed_bwa_align(self):
         """Test a single BWA alignment.
         """
@@ -317,6 +364,90 @@ class TestAlignmentPieces(TestCase):
             first_bed_record[-1],
             'No_Coverage\n')
 
+    def test_get_coverage_arrays(self):
+        """Coverage arrays are computed once and then loaded from the saved
+        Dataset.
+        """
+        coverage_arrays = get_coverage_arrays(self.sample_alignment)
+        coverage_dataset = get_dataset_with_type(self.sample_alignment,
+                Dataset.TYPE.BWA_COVERAGE_ARRAYS)
+        self.assertTrue(os.path.exists(
+                coverage_dataset.get_absolute_location()))
+
+        bamfile = pysam.AlignmentFile(
+                self.bwa_dataset.get_absolute_location(), 'rb')
+        self.assertEqual(set(bamfile.references), set(coverage_arrays.keys()))
+        for chrom, chrom_len in zip(bamfile.references, bamfile.lengths):
+            chrom_arrays = coverage_arrays[chrom]
+            depths = chrom_arrays[COVERAGE__DEPTHS]
+            self.assertEqual(chrom_len, len(depths))
+
+            # Bam should have no reads at start.
+            self.assertEqual(0, depths[0])
+            self.assertTrue(depths.max() > 0)
+            self.assertTrue(
+                    (chrom_arrays[COVERAGE__ALTALIGNS] <= depths).all())
+            self.assertTrue(
+                    (chrom_arrays[COVERAGE__LOW_MAPQ] <= depths).all())
+
+        loaded_coverage_arrays = get_coverage_arrays(self.sample_alignment)
+        self.assertEqual(coverage_dataset.id, get_dataset_with_type(
+                self.sample_alignment,
+                Dataset.TYPE.BWA_COVERAGE_ARRAYS).id)
+        for chrom in coverage_arrays:
+            for key, array in coverage_arrays[chrom].iteritems():
+                self.assertTrue(
+                        (array == loaded_coverage_arrays[chrom][key]).all())
+
+    def test_compute_coverage_arrays__parallel(self):
+        """Coverage computed over windows in a process pool is the same as
+        coverage computed serially.
+        """
+        bam_path = self.bwa_dataset.get_absolute_location()
+        coverage_arrays = compute_coverage_arrays(bam_path, processes=1)
+        with self.settings(COVERAGE_WINDOW_SIZE=7919):
+            parallel_coverage_arrays = compute_coverage_arrays(bam_path,
+                    processes=3)
+
+        self.assertEqual(set(coverage_arrays.keys()),
+                set(parallel_coverage_arrays.keys()))
+        for chrom in coverage_arrays:
+            for key, array in coverage_arrays[chrom].iteritems():
+                self.assertTrue(
+                        (array == parallel_coverage_arrays[chrom][key]).all())
+
+    def test_compute_coverage_arrays__parallel_in_daemonic_process(self):
+        """A daemonic process, such as a celery worker process, computes
+        coverage in a process pool as well.
+        """
+        bam_path = self.bwa_dataset.get_absolute_location()
+        coverage_arrays = compute_coverage_arrays(bam_path, processes=1)
+
+        def _compute_and_save(output_path):
+            save_coverage_arrays(
+                    compute_coverage_arrays(bam_path, processes=3),
+                    output_path)
+
+        output_fh, output_path = tempfile.mkstemp(suffix='.npz',
+                dir=settings.TEMP_FILE_ROOT)
+        os.close(output_fh)
+        try:
+            with self.settings(COVERAGE_WINDOW_SIZE=7919):
+                process = Process(target=_compute_and_save,
+                        args=(output_path,))
+                process.daemon = True
+                process.start()
+                process.join()
+            self.assertEqual(0, process.exitcode)
+            parallel_coverage_arrays = load_coverage_arrays(output_path)
+        finally:
+            os.remove(output_path)
+
+        for chrom in coverage_arrays:
+            for key, array in coverage_arrays[chrom].iteritems():
+                self.assertTrue(
+                        (array == parallel_coverage_arrays[chrom][key]).all())
+
     def test_get_split_reads(self):
 
         bwa_sr_dataset = get_split_reads(self.sample_alignment)
@@ -334,6 +465,27 @@ class TestAlignmentPieces(TestCase):
                 stdout=subprocess.PIPE)
         self.assertEqual(3, sum([1 for line in p.stdout]))
 
+    def test_get_sv_read_datasets(self):
+        """Discordant and split reads are isolated in the same pass.
+        """
+        (bwa_disc_dataset, bwa_sr_dataset) = get_sv_read_datasets(
+                self.sample_alignment)
+
+        for dataset, expected_count in [
+                (bwa_disc_dataset, 134), (bwa_sr_dataset, 3)]:
+            self.assertEqual(Dataset.STATUS.READY, dataset.status)
+            p = subprocess.Popen(
+                    [SAMTOOLS_BINARY, 'view', dataset.get_absolute_location()],
+                    stdout=subprocess.PIPE)
+            self.assertEqual(expected_count, sum([1 for line in p.stdout]))
+
+        # Split reads are named by which read of the pair they are.
+        p = subprocess.Popen(
+                [SAMTOOLS_BINARY, 'view', bwa_sr_dataset.get_absolute_location()],
+                stdout=subprocess.PIPE)
+        for line in p.stdout:
+            self.assertTrue(line.split('\t')[0][-2:] in ('_1', '_2'))
+
     def test_get_read_length(self):
         bam_file = get_dataset_with_type(self.sample_alignment,
                 Dataset.TYPE.BWA_ALIGN).get_absolute_location()
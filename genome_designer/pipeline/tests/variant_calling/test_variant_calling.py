@@ -19,7 +19,9 @@ from main.models import Variant
 from pipeline.variant_calling import find_variants_with_tool
 from pipeline.variant_calling import VARIANT_TOOL_PARAMS_MAP
 from pipeline.variant_calling.freebayes import freebayes_regions
+from pipeline.variant_calling.freebayes import split_chromosome_into_regions
 from pipeline.variant_calling.freebayes import merge_freebayes_parallel
+from pipeline.variant_calling.freebayes import merge_sorted_vcfs
 from utils.import_util import add_dataset_to_entity
 from utils.import_util import copy_and_add_dataset_source
 from utils.import_util import copy_dataset_to_entity_data_dir
@@ -135,6 +137,49 @@ class TestSNPCallers(TestCase):
         regions = freebayes_regions(self.reference_genome, region_size=100)
         self.assertEqual(len(regions), 20)
 
+    def test_split_chromosome_into_regions(self):
+        # Uniform coverage gives regions of region_size.
+        self.assertEqual([(0, 300), (300, 600), (600, 700)],
+                split_chromosome_into_regions(700, 300, [10] * 7, 100, 60))
+
+        # Deep coverage in the third window splits regions around it.
+        self.assertEqual(
+                [(0, 200), (200, 300), (300, 600), (600, 700)],
+                split_chromosome_into_regions(
+                        700, 300, [10, 10, 100, 10, 10, 10, 10], 100, 60))
+
+        # No limit on data.
+        self.assertEqual([(0, 300), (300, 600), (600, 700)],
+                split_chromosome_into_regions(
+                        700, 300, [10, 10, 100, 10], 100, None))
+
+    def test_merge_sorted_vcfs(self):
+        header = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\n'
+        vcf_contents = [
+            header + 'chrB\t5\t.\tA\tT\nchrB\t20\t.\tC\tG\n',
+            header + 'chrB\t20\t.\tC\tG\nchrB\t20\t.\tC\tA\n'
+                    'chrA\t1\t.\tG\tT\n',
+            header,
+        ]
+        vcf_files = []
+        for idx, contents in enumerate(vcf_contents):
+            vcf_file = os.path.join(settings.MEDIA_ROOT,
+                    'partial.%d.vcf' % idx)
+            with open(vcf_file, 'w') as fh:
+                fh.write(contents)
+            vcf_files.append(vcf_file)
+
+        merged_vcf = os.path.join(settings.MEDIA_ROOT, 'merged.vcf')
+        merge_sorted_vcfs(vcf_files, merged_vcf, ['chrB', 'chrA'])
+        with open(merged_vcf) as fh:
+            self.assertEqual(
+                    header +
+                    'chrB\t5\t.\tA\tT\n'
+                    'chrB\t20\t.\tC\tG\n'
+                    'chrB\t20\t.\tC\tA\n'
+                    'chrA\t1\t.\tG\tT\n',
+                    fh.read())
+
     def test_call_snvs(self):
         """Test running the pipeline that calls SNPS.
 
@@ -6,6 +6,7 @@ import shutil
 import subprocess
 from uuid import uuid4
 
+from celery import task
 import vcf
 
 from utils.jbrowse_util import add_vcf_track
@@ -48,13 +49,18 @@ def common_postprocess_vcf(vcf_reader):
         vcf_reader.infos[key] = val
 
 
-def add_vcf_dataset(alignment_group, vcf_dataset_type, vcf_output_filename):
+def add_vcf_dataset(alignment_group, vcf_dataset_type, vcf_output_filename,
+        sort=True):
     """Sort vcf file, creates vcf dataset, and adds it to the alignment group.
+
+    Pass sort=False for a vcf that is already in the order of the reference
+    genome, which sort_vcf() would replace with lexical chromosome order.
     """
     if not os.path.exists(vcf_output_filename):
         return None
 
-    sort_vcf(vcf_output_filename)
+    if sort:
+        sort_vcf(vcf_output_filename)
 
     # If a Dataset already exists, delete it, might have been a bad run.
     existing_set = Dataset.objects.filter(
@@ -87,9 +93,17 @@ def process_vcf_dataset(alignment_group, vcf_dataset_type):
     add_vcf_track(alignment_group.reference_genome, alignment_group,
         vcf_dataset_type)
 
-    # Parse the resulting vcf, grab variant objects
-    parse_alignment_group_vcf(alignment_group, vcf_dataset_type)
+    # Parse the resulting vcf, grab variant objects. Large vcfs are parsed in
+    # the background, so the variants are flagged once they are loaded.
+    parse_alignment_group_vcf(alignment_group, vcf_dataset_type,
+            on_loaded=flag_callable_loci_variants.si(alignment_group))
+
 
+@task
+def flag_callable_loci_variants(alignment_group):
+    """Flags the variants of the AlignmentGroup from the callable loci BED
+    files of its samples. Runs once a VCF is parsed, see process_vcf_dataset().
+    """
     flag_variants_from_bed(alignment_group, Dataset.TYPE.BED_CALLABLE_LOCI)
 
 
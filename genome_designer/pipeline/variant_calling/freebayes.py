@@ -2,9 +2,9 @@
 """
 
 import collections
-import errno
-import fileinput
 import glob
+import heapq
+import itertools
 import tempfile
 import os
 import shutil
@@ -23,19 +23,27 @@ from pipeline.variant_calling.constants import TOOL_FREEBAYES
 
 from pipeline.variant_effects import run_snpeff
 from utils import uppercase_underscore
+from utils.bam_utils import BAI_LINEAR_INDEX_WINDOW_SIZE
+from utils.bam_utils import get_bam_index_window_sizes
 
 
 VCF_AF_HEADER = '##FORMAT=<ID=AF,Number=1,Type=Float,Description="Alternate allele observation frequency, AO/(RO+AO)">'
 
 
 def freebayes_regions(ref_genome,
-        region_size=settings.FREEBAYES_REGION_SIZE):
+        region_size=settings.FREEBAYES_REGION_SIZE, sample_alignments=None):
     """
-    Use bamtools (installed as part of freebayes) to intelligently
-    generate regions that will be run in freebayes in parallel.
+    Generate regions that will be run in freebayes in parallel.
+
+    Regions are at most region_size bases. If sample_alignments are given,
+    regions with much more alignment data than average are split further
+    (see settings.FREEBAYES_REGION_MAX_READ_DATA_FACTOR), so that regions
+    with deep coverage don't hold up the rest.
 
     ref_genome: the reference genome object
     region_size: how many bases each parallelized region 'chunk' will be
+    sample_alignments: optional ExperimentSampleToAlignments whose bam
+        alignments are used to estimate coverage
     """
     ref_genome_fasta = get_dataset_with_type(ref_genome,
             Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
@@ -45,30 +53,114 @@ def freebayes_regions(ref_genome,
 
     ref_genome_faidx = ref_genome_fasta + '.fai'
 
-    regions = []
-
+    chromosomes = []
     with open(ref_genome_faidx) as faidx_fh:
         # faidx has one line per chromosome
         for line in faidx_fh:
             fields = line.strip().split('\t')
             chr_name, chr_len = fields[:2]
-            chr_len = int(chr_len)
-            end = 0
-
-            while end < chr_len:
-                start = end
-                end = start + region_size
-                if end > chr_len:
-                    end = chr_len
-                regions.append('{chr_name}:{start}-{end}'.format(
-                        chr_name=chr_name,
-                        start=start,
-                        end=end))
-                start = end
+            chromosomes.append((chr_name, int(chr_len)))
+
+    # Estimated amount of alignment data along each chromosome, summed over
+    # samples.
+    chrom_to_window_sizes = collections.defaultdict(list)
+    if sample_alignments is not None:
+        for bam_file in _get_indexed_bam_files(sample_alignments):
+            for chr_name, window_sizes in get_bam_index_window_sizes(
+                    bam_file).iteritems():
+                total_window_sizes = chrom_to_window_sizes[chr_name]
+                for window_idx, window_size in enumerate(window_sizes):
+                    if window_idx < len(total_window_sizes):
+                        total_window_sizes[window_idx] += window_size
+                    else:
+                        total_window_sizes.append(window_size)
+
+    # Limit the data in a region relative to a region of average coverage.
+    genome_size = sum([length for _, length in chromosomes])
+    total_data_size = sum([sum(window_sizes)
+            for window_sizes in chrom_to_window_sizes.values()])
+    if total_data_size and genome_size:
+        max_region_data_size = (settings.FREEBAYES_REGION_MAX_READ_DATA_FACTOR *
+                total_data_size * min(region_size, genome_size) / genome_size)
+    else:
+        max_region_data_size = None
+
+    regions = []
+    for chr_name, chr_len in chromosomes:
+        for start, end in split_chromosome_into_regions(chr_len, region_size,
+                chrom_to_window_sizes.get(chr_name, []),
+                BAI_LINEAR_INDEX_WINDOW_SIZE, max_region_data_size):
+            regions.append('{chr_name}:{start}-{end}'.format(
+                    chr_name=chr_name,
+                    start=start,
+                    end=end))
+
+    return regions
+
+
+def split_chromosome_into_regions(chr_len, region_size, window_data_sizes,
+        window_size, max_region_data_size):
+    """Splits a chromosome into consecutive regions of at most region_size
+    bases, ending regions early at a window boundary if they would have more
+    than max_region_data_size of data.
+
+    Args:
+        chr_len: Length of the chromosome.
+        region_size: Maximum number of bases in a region.
+        window_data_sizes: List of amount of data in consecutive windows of
+            window_size bases. Windows past the end of the list are empty.
+        window_size: Size of windows in bases.
+        max_region_data_size: Maximum amount of data in a region, or None for
+            no limit. A region is never smaller than the rest of the window it
+            starts in.
+
+    Returns:
+        List of (start, end) tuples.
+    """
+    regions = []
+    end = 0
+    while end < chr_len:
+        start = end
+        end = min(start + region_size, chr_len)
+
+        if max_region_data_size is not None:
+            # Add up the data of the windows overlapping the region, counting
+            # partial windows in proportion to their overlap.
+            region_data_size = 0
+            position = start
+            while position < end:
+                window_idx = position / window_size
+                window_end = min((window_idx + 1) * window_size, end)
+                if window_idx < len(window_data_sizes):
+                    region_data_size += (window_data_sizes[window_idx] *
+                            float(window_end - position) / window_size)
+                if (region_data_size > max_region_data_size and
+                        position > start):
+                    end = position
+                    break
+                position = window_end
+
+        regions.append((start, end))
 
     return regions
 
 
+def _get_indexed_bam_files(sample_alignments):
+    """Returns the paths of the indexed bam alignments of the sample
+    alignments, skipping those that aren't ready.
+    """
+    bam_files = []
+    for sample_alignment in sample_alignments:
+        bam_dataset = get_dataset_with_type(sample_alignment,
+                Dataset.TYPE.BWA_ALIGN)
+        if bam_dataset is None or bam_dataset.status != Dataset.STATUS.READY:
+            continue
+        bam_file = bam_dataset.get_absolute_location()
+        if os.path.exists(bam_file + '.bai'):
+            bam_files.append(bam_file)
+    return bam_files
+
+
 def run_freebayes(fasta_ref, sample_alignments, vcf_output_dir,
         vcf_output_filename, alignment_type, region=None, **kwargs):
     """Run freebayes using the bam alignment files keyed by the alignment_type
@@ -207,10 +299,119 @@ def process_freebayes_region_vcf(vcf_output_filename):
     print 'moved from {} to {}'.format(temp_fh.name, vcf_output_filename)
 
 
+def merge_sorted_vcfs(vcf_files, output_filename, chromosome_order,
+        bgzip=False):
+    """Merges sorted VCF files into a single sorted VCF in one streaming pass,
+    dropping duplicate records (same CHROM, POS, REF and ALT).
+
+    The header is taken from the first file.
+
+    Args:
+        vcf_files: List of paths to VCF files, each sorted by chromosome in
+            chromosome_order and then by position.
+        output_filename: Path of the merged VCF.
+        chromosome_order: List of chromosome names in sorted order.
+            Chromosomes not in the list sort after these, by name.
+        bgzip: If True, the output is compressed with bgzip and indexed with
+            tabix.
+
+    Returns:
+        Path of the merged VCF, with '.bgz' appended if compressed.
+    """
+    chromosome_rank = dict((chrom, rank)
+            for rank, chrom in enumerate(chromosome_order))
+
+    def _sort_key(chrom):
+        return (chromosome_rank.get(chrom, len(chromosome_rank)), chrom)
+
+    vcf_fhs = [open(vcf_file) for vcf_file in vcf_files]
+    try:
+        # Read headers, keeping those of the first file.
+        header_lines = []
+        record_iterators = []
+        for file_idx, vcf_fh in enumerate(vcf_fhs):
+            first_record = None
+            for line in vcf_fh:
+                if not line.startswith('#'):
+                    first_record = line
+                    break
+                if file_idx == 0:
+                    header_lines.append(line)
+            record_iterators.append(_iter_vcf_records_with_sort_key(
+                    file_idx, first_record, vcf_fh, _sort_key))
+
+        if bgzip:
+            output_filename += '.bgz'
+        with open(output_filename, 'w') as output_fh:
+            if bgzip:
+                bgzip_proc = subprocess.Popen(
+                        [settings.BGZIP_BINARY, '-c'],
+                        stdin=subprocess.PIPE, stdout=output_fh)
+                write_fh = bgzip_proc.stdin
+            else:
+                write_fh = output_fh
+
+            write_fh.writelines(header_lines)
+
+            # Records at the same position are only duplicates of records at
+            # that position, so only remember those.
+            last_position = None
+            ref_alts_at_last_position = set()
+            for (chrom_key, pos, file_idx, ref_alt, line) in heapq.merge(
+                    *record_iterators):
+                if (chrom_key, pos) != last_position:
+                    last_position = (chrom_key, pos)
+                    ref_alts_at_last_position = set()
+                elif ref_alt in ref_alts_at_last_position:
+                    continue
+                ref_alts_at_last_position.add(ref_alt)
+                write_fh.write(line)
+
+            if bgzip:
+                bgzip_proc.stdin.close()
+                assert bgzip_proc.wait() == 0, "bgzip failed."
+    finally:
+        for vcf_fh in vcf_fhs:
+            vcf_fh.close()
+
+    if bgzip:
+        subprocess.check_call([settings.TABIX_BINARY, '-f', '-p', 'vcf',
+                output_filename])
+
+    return output_filename
+
+
+def _iter_vcf_records_with_sort_key(file_idx, first_record, vcf_fh,
+        chrom_sort_key):
+    """Yields tuples (chromosome sort key, position, file_idx, (REF, ALT),
+    line) for the records of a VCF, starting with first_record.
+    """
+    if first_record is None:
+        return
+    for line in itertools.chain([first_record], vcf_fh):
+        fields = line.split('\t', 5)
+        yield (chrom_sort_key(fields[0]), int(fields[1]), file_idx,
+                (fields[3], fields[4]), line)
+
+
+def _get_partial_vcf_region_num(partial_vcf_file):
+    """Returns the region number in the name of a partial freebayes VCF.
+    """
+    return int(os.path.basename(partial_vcf_file).split('.')[-2])
+
+
+def _get_chromosome_order(fasta_ref):
+    """Returns the list of chromosome names in the order of the fasta.
+    """
+    with open(fasta_ref + '.fai') as faidx_fh:
+        return [line.split('\t')[0] for line in faidx_fh]
+
+
 def merge_freebayes_parallel(alignment_group):
     """
     Merge, sort, and make unique all regional freebayes variant calls after
-    parallel execution.
+    parallel execution. Each region's calls are already sorted, so they
+    are merged in one pass with merge_sorted_vcfs().
 
     Returns the Dataset pointing to the merged vcf file. If no freebayes files,
     returns None.
@@ -232,55 +433,19 @@ def merge_freebayes_parallel(alignment_group):
     # Generate output filename.
     vcf_ouput_filename_merged = os.path.join(partial_freebayes_vcf_output_dir,
             uppercase_underscore(common_params['alignment_type']) + '.vcf')
-    vcf_ouput_filename_merged_fh = open(vcf_ouput_filename_merged, 'w')
-
-    streamsort_cmd = ' '.join([
-            settings.VCFSTREAMSORT_BINARY,
-            '-w 1000 | ',
-            settings.VCFUNIQ_BINARY])
-
-    # create a pipe to write to that will sort all the sub-vcfs
-    stream_merge_proc = subprocess.Popen(streamsort_cmd,
-            stdin=subprocess.PIPE,
-            stdout=vcf_ouput_filename_merged_fh,
-            shell=True)
-
-    # concatenate all the vcf files w/ fileinput and keep all but the first
-    # header and write to the stream_merge_proc stdin pipe
-    header=True
-    for line in fileinput.input(vcf_files):
-        #https://gist.github.com/waylan/2353749
-        try:
-            if line.startswith('##'):
-                if header:
-                    stream_merge_proc.stdin.write(line)
-                continue
-            elif line.startswith('#'):
-                if header:
-                   stream_merge_proc.stdin.write(line)
-                   header=False
-                continue
-            stream_merge_proc.stdin.write(line)
-        except IOError as e:
-            if e.errno == errno.EPIPE or e.errno == errno.EINVAL:
-                # Stop loop on "Invalid pipe" or "Invalid argument".
-                # No sense in continuing with broken pipe.
-                break
-            else:
-                # Raise any other error.
-                raise
 
-    # close the stdin to the stream merge, wait for it to finish,
-    # and close the file.
-    stream_merge_proc.stdin.close()
-    stream_merge_proc.wait()
-    vcf_ouput_filename_merged_fh.close()
+    # Order the region files by the region plan, so that ties between
+    # records are broken in plan order.
+    vcf_files = sorted(vcf_files, key=_get_partial_vcf_region_num)
+    merge_sorted_vcfs(vcf_files, vcf_ouput_filename_merged,
+            _get_chromosome_order(common_params['fasta_ref']))
 
     vcf_dataset_type = Dataset.TYPE.VCF_FREEBAYES
 
-    # add unannotated vcf dataset first
+    # add unannotated vcf dataset first. It is already merged in reference
+    # genome order, so don't sort it again.
     vcf_dataset = add_vcf_dataset(alignment_group, vcf_dataset_type,
-            vcf_ouput_filename_merged)
+            vcf_ouput_filename_merged, sort=False)
 
     # If genome is annotated then run snpeff now,
     # then update the vcf_output_filename and vcf_dataset_type.
@@ -293,7 +458,7 @@ def merge_freebayes_parallel(alignment_group):
 
         vcf_dataset = add_vcf_dataset(
                 alignment_group, vcf_dataset_type,
-                vcf_ouput_filename_merged_snpeff)
+                vcf_ouput_filename_merged_snpeff, sort=False)
 
     # generate variants, process, etc
     process_vcf_dataset(alignment_group, vcf_dataset_type)
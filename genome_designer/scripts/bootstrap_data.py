@@ -489,6 +489,9 @@ def reset_database():
     call_command('migrate', fake=True, interactive=False)
     print "\n\n\n\n----------------MIGRATION FINISHED"
 
+    # The table of the database cache backend isn't created by syncdb.
+    call_command('createcachetable', settings.CACHES['default']['LOCATION'])
+
     ### Recreate the media root.
     if os.path.exists(settings.MEDIA_ROOT):
         shutil.rmtree(settings.MEDIA_ROOT)
@@ -24,6 +24,8 @@ SAMTOOLS_BINARY = '%s/samtools/samtools' % TOOLS_DIR
 
 BGZIP_BINARY = '%s/tabix/bgzip' % TOOLS_DIR
 
+TABIX_BINARY = '%s/tabix/tabix' % TOOLS_DIR
+
 FASTQC_BINARY = '%s/fastqc/fastqc' % TOOLS_DIR
 
 VCFUNIQ_BINARY = '%s/freebayes/vcfuniq' % TOOLS_DIR
@@ -38,9 +40,6 @@ LUMPY_SCRIPTS_DIR = '%s/lumpy/scripts' % TOOLS_DIR
 
 LUMPY_PAIREND_DISTRO_BIN = '%s/lumpy/scripts/pairend_distro.py' % TOOLS_DIR
 
-LUMPY_EXTRACT_SPLIT_READS_BWA_MEM = (
-        '%s/lumpy/scripts/extractSplitReads_BwaMem' % TOOLS_DIR)
-
 # Merging lumpy vcfs
 
 LUMPY_L_SORT_BINARY = os.path.join(LUMPY_SCRIPTS_DIR, 'l_sort.py')
@@ -4,6 +4,7 @@ Utility functions for working with bam files.
 
 import os
 import shutil
+import struct
 import subprocess
 
 from django.conf import settings
@@ -14,6 +15,13 @@ from utils import convert_fasta_to_fastq
 
 BWA_BINARY = os.path.join(settings.TOOLS_DIR, 'bwa/bwa')
 
+# Size in bases of the windows of the linear index in a .bai file.
+BAI_LINEAR_INDEX_WINDOW_SIZE = 16384
+
+# Bin of the .bai index that holds the start and end file offsets of the
+# alignments to a reference, rather than alignments in a region.
+BAI_METADATA_PSEUDO_BIN = 37450
+
 
 def clipping_stats(bam_path, sample_size=1000):
 
@@ -42,6 +50,60 @@ def clipping_stats(bam_path, sample_size=1000):
             'std': np.std(terminal_clipping)}
 
 
+def get_bam_index_window_sizes(bam_path):
+    """Estimates how much alignment data there is along each chromosome of an
+    indexed bam, without reading the bam itself.
+
+    Uses the linear index of the .bai file, which records the file offset of
+    the first alignment overlapping each BAI_LINEAR_INDEX_WINDOW_SIZE window,
+    so the offset difference between consecutive windows is the compressed
+    size of the alignments starting in the window.
+
+    Returns:
+        Dictionary from chromosome name to list of compressed sizes in bytes
+        of the alignments in each window. Windows past the end of the list
+        have no alignments.
+    """
+    chromosome_names = pysam.AlignmentFile(bam_path).references
+
+    with open(bam_path + '.bai', 'rb') as fh:
+        assert fh.read(4) == 'BAI\1', "Not a bam index: %s.bai" % bam_path
+
+        def _read(fmt):
+            return struct.unpack('<' + fmt, fh.read(struct.calcsize(fmt)))
+
+        (num_chromosomes,) = _read('i')
+        window_sizes = {}
+        for chrom_idx in range(num_chromosomes):
+            chrom_begin_offset = 0
+            chrom_end_offset = None
+            (num_bins,) = _read('i')
+            for bin_idx in range(num_bins):
+                (bin_num, num_chunks) = _read('Ii')
+                chunks = _read('%dQ' % (2 * num_chunks))
+                if bin_num == BAI_METADATA_PSEUDO_BIN:
+                    (chrom_begin_offset, chrom_end_offset) = chunks[:2]
+
+            (num_windows,) = _read('i')
+            window_offsets = _read('%dQ' % num_windows)
+
+            # Virtual offsets keep the compressed offset in the upper 48 bits.
+            # Empty windows may have offset 0, so keep offsets non-decreasing.
+            compressed_offsets = []
+            previous_offset = chrom_begin_offset >> 16
+            for offset in window_offsets:
+                previous_offset = max(offset >> 16, previous_offset)
+                compressed_offsets.append(previous_offset)
+            if chrom_end_offset is not None:
+                compressed_offsets.append(
+                        max(chrom_end_offset >> 16, previous_offset))
+
+            window_sizes[chromosome_names[chrom_idx]] = [
+                    compressed_offsets[i + 1] - compressed_offsets[i]
+                    for i in range(len(compressed_offsets) - 1)]
+    return window_sizes
+
+
 def index_bam(bam):
     cmd = "{samtools} index {bam}".format(
             samtools=settings.SAMTOOLS_BINARY,
@@ -135,10 +197,72 @@ def rmdup(input_bam_file, output_bam_file):
     os.remove(output_sam)
 
 
+def filter_bam_file(input_bam_path, filter_fn, output_bam_path):
+    """Filters alignments out of a bam file that don't pass a given filter
+    function, streaming from bam to bam without intermediate files.
+
+    The header is kept.
+
+    Args:
+        input_bam_path: Absolute path to input bam file.
+        filter_fn: Function applied to each pysam.AlignedSegment of the input
+            bam and returns a Boolean. If True, keeps the alignment.
+        output_bam_path: Absolute path to the output bam file. May be the same
+            as the input.
+    """
+    filtered_bam = os.path.splitext(output_bam_path)[0] + '.filtered.bam'
+    split_bam_by_read_class(input_bam_path, [(filtered_bam, filter_fn)])
+
+    # Move temp file to the output location.
+    shutil.move(filtered_bam, output_bam_path)
+
+
+def split_bam_by_read_class(input_bam_path, read_classes):
+    """Streams the alignments of a bam file once, writing each alignment to
+    the output bam of every class it belongs to.
+
+    The header is kept in all outputs, and alignments keep their order.
+
+    Args:
+        input_bam_path: Absolute path to input bam file.
+        read_classes: List of tuples (output_bam_path, class_fn). class_fn is
+            applied to each pysam.AlignedSegment of the input bam and returns
+            a true value to write the alignment to the output. If the value
+            is a string, the alignment is written with it as query name.
+    """
+    input_bam = pysam.AlignmentFile(input_bam_path, 'rb')
+    output_bams = []
+    try:
+        class_fns = []
+        for output_bam_path, class_fn in read_classes:
+            output_bams.append(pysam.AlignmentFile(output_bam_path, 'wb',
+                    template=input_bam))
+            class_fns.append(class_fn)
+        classes = zip(class_fns, output_bams)
+
+        for read in input_bam.fetch(until_eof=True):
+            for class_fn, output_bam in classes:
+                result = class_fn(read)
+                if not result:
+                    continue
+                if isinstance(result, basestring):
+                    query_name = read.query_name
+                    read.query_name = result
+                    output_bam.write(read)
+                    read.query_name = query_name
+                else:
+                    output_bam.write(read)
+    finally:
+        for output_bam in output_bams:
+            output_bam.close()
+        input_bam.close()
+
+
 def filter_bam_file_by_row(input_bam_path, filter_fn, output_bam_path):
     """Filters rows out of a bam file that don't pass a given filter function.
 
-    This function keeps all header lines.
+    This function keeps all header lines. Goes through SAM text files on disk,
+    so prefer filter_bam_file() unless the filter needs the SAM line.
 
     Args:
         input_bam_path: Absolute path to input bam file.
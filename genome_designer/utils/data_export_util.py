@@ -50,7 +50,7 @@ def export_melted_variant_view(
         ref_genome = alignment_group.reference_genome
 
     mvm = MeltedVariantMaterializedViewManager(ref_genome)
-    mvm.create_if_not_exists_or_invalid()
+    mvm.create_if_not_exists_or_invalid(background=True)
 
     # We'll perform a query, using any filter_string provided.
     query_args = {}
@@ -285,11 +285,7 @@ def export_contig_list_as_vcf(contig_list, vcf_dest_path_or_filehandle):
         contig_left, contig_right = contig.contig_insertion_endpoints
 
         # Get Seqrecord
-        contig_fasta = get_dataset_with_type(
-                contig,
-                Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
-        with open(contig_fasta) as fh:
-                contig_seqrecord = SeqIO.parse(fh, 'fasta').next()
+        contig_seqrecord = contig.get_fasta_seqrecord()
 
         # Determine whether contig is reverse complement relative to reference
         is_reverse = contig.metadata.get('is_reverse', False)
@@ -506,8 +502,7 @@ def _ctg_to_jct_rows(sample_alignment, contig):
     file_path = contig.dataset_set.get(
             type=Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
     if os.path.exists(file_path):
-        with open(file_path) as fh:
-            contig_seq = str(SeqIO.read(fh, 'fasta').seq)
+        contig_seq = str(contig.get_fasta_seqrecord().seq)
     else:
         contig_seq = ''
 
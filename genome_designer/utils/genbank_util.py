@@ -1,8 +1,9 @@
+from collections import namedtuple
+
 from Bio import SeqIO
-import pyinter
-import pickle
+import numpy as np
 
-from main.model_utils import get_dataset_with_type
+FEATURE_INDEX_FILENAME = 'gbk_feature_idx.npy'
 
 GBK_FEATURES_TO_EXTRACT = [
         'CDS',
@@ -10,6 +11,11 @@ GBK_FEATURES_TO_EXTRACT = [
         'tRNA',
         'rRNA']
 
+# A feature found by GenbankFeatureIndex. name is None for features that have
+# neither a gene name nor a mobile element type.
+GenbankFeature = namedtuple('GenbankFeature',
+        ['chromosome', 'start', 'end', 'type', 'name'])
+
 def get_genbank_features_with_type(genbank_path, feature_type):
 
     chrom_intervals = {}
@@ -49,32 +55,113 @@ def generate_genbank_mobile_element_multifasta(genbank_path, output_fasta_path):
 
 
 def generate_gbk_feature_index(genbank_path, feature_index_output_path):
-    """
-    Create a pickled pyinterval index of genbank features so we can pull
-    them quickly.
-    """
+    """Creates an index of the genbank features of GBK_FEATURES_TO_EXTRACT,
+    for looking up features by position with GenbankFeatureIndex.
 
-    gbk_feature_list = []
+    The index is a single .npy record array, sorted by chromosome and then
+    by feature start, so that it can be memory-mapped and binary searched
+    rather than loaded and scanned in full.
+    """
+    feature_tuples = []
     with open(genbank_path, 'r') as fh:
         for seq_record in SeqIO.parse(fh, 'genbank'):
-            interval_list = []
-
             for f in seq_record.features:
-
                 if f.type not in GBK_FEATURES_TO_EXTRACT:
                     continue
 
-                f_ivl = pyinter.closedopen(
-                        f.location.start, f.location.end)
-                f_ivl.type = f.type
-
+                # Features without a gene or mobile element name are kept
+                # with an empty name.
                 if 'gene' in f.qualifiers:
-                    f_ivl.name = f.qualifiers['gene'][0]
+                    name = f.qualifiers['gene'][0]
                 elif 'mobile_element_type' in f.qualifiers:
-                    f_ivl.name = f.qualifiers['mobile_element_type'][0]
-                # For now, if the gene has no '.name' or '.mobile_element_type', ignore
-                gbk_feature_list.append(f_ivl)
-
-    with open(feature_index_output_path, 'w') as fh:
-        pickle.dump(gbk_feature_list, fh)
+                    name = f.qualifiers['mobile_element_type'][0]
+                else:
+                    name = ''
+
+                feature_tuples.append((seq_record.id,
+                        int(f.location.start), int(f.location.end),
+                        f.type, name))
+    feature_tuples.sort()
+
+    def _str_width(field_idx):
+        return max([1] + [len(t[field_idx]) for t in feature_tuples])
+
+    feature_index = np.zeros(len(feature_tuples), dtype=[
+            ('chromosome', 'S%d' % _str_width(0)),
+            ('start', np.int64),
+            ('end', np.int64),
+            ('max_end', np.int64),
+            ('type', 'S%d' % _str_width(3)),
+            ('name', 'S%d' % _str_width(4))])
+    for field_idx, field in enumerate(
+            ['chromosome', 'start', 'end', 'type', 'name']):
+        feature_index[field] = [t[field_idx] for t in feature_tuples]
+
+    # The largest end of any feature up to and including each feature of
+    # its chromosome, which is sorted by start and so lets queries binary
+    # search for the first feature that may reach them.
+    for chrom in np.unique(feature_index['chromosome']):
+        chrom_features = feature_index[feature_index['chromosome'] == chrom]
+        chrom_features['max_end'] = np.maximum.accumulate(
+                chrom_features['end'])
+        feature_index[feature_index['chromosome'] == chrom] = chrom_features
+
+    with open(feature_index_output_path, 'wb') as fh:
+        np.save(fh, feature_index)
+
+
+class GenbankFeatureIndex(object):
+    """Looks up genbank features by position in an index created by
+    generate_gbk_feature_index().
+    """
 
+    def __init__(self, feature_index_path):
+        self.features = np.load(feature_index_path, mmap_mode='r')
+
+        # Slice of the features of each chromosome.
+        self.chrom_slices = {}
+        chromosomes = self.features['chromosome']
+        for chrom in np.unique(chromosomes):
+            self.chrom_slices[chrom] = slice(
+                    np.searchsorted(chromosomes, chrom, side='left'),
+                    np.searchsorted(chromosomes, chrom, side='right'))
+
+    def get_features_at_interval(self, interval, chromosome=None):
+        """Returns the features overlapping the interval.
+
+        Args:
+            interval: Tuple (start, end) of a half-open interval. An empty
+                interval (start, start) is taken to be the position start.
+            chromosome: Optional chromosome of the interval. If None, or if
+                there are no features indexed for it, features of all
+                chromosomes are returned.
+
+        Returns:
+            List of GenbankFeature, ordered by chromosome and start.
+        """
+        start, end = interval
+        end = max(end, start + 1)
+
+        if chromosome in self.chrom_slices:
+            chrom_slices = [self.chrom_slices[chromosome]]
+        else:
+            chrom_slices = [self.chrom_slices[chrom]
+                    for chrom in sorted(self.chrom_slices)]
+
+        features = []
+        for chrom_slice in chrom_slices:
+            chrom_features = self.features[chrom_slice]
+
+            # Features from the first one whose max_end passes start, up to
+            # the last one starting before end, may overlap.
+            lo = np.searchsorted(chrom_features['max_end'], start,
+                    side='right')
+            hi = np.searchsorted(chrom_features['start'], end, side='left')
+            if lo >= hi:
+                continue
+            candidates = chrom_features[lo:hi]
+            for f in candidates[candidates['end'] > start]:
+                features.append(GenbankFeature(str(f['chromosome']),
+                        int(f['start']), int(f['end']), str(f['type']),
+                        str(f['name']) or None))
+        return features
@@ -35,7 +35,6 @@ from pipeline.read_alignment_util import ensure_bwa_index
 from pipeline.variant_effects import build_snpeff
 from utils import generate_safe_filename_prefix_from_label
 from utils import uppercase_underscore
-from utils.genbank_util import generate_gbk_feature_index
 from utils.jbrowse_util import prepare_jbrowse_ref_sequence
 from utils.jbrowse_util import add_genbank_file_track
 from variants.vcf_parser import get_or_create_variant
@@ -1201,22 +1200,7 @@ def prepare_ref_genome_related_datasets(ref_genome, dataset):
 
         # Create an indexed set of intervals so we can find contigs
         # and snps within genes without using snpEFF.
-
-        feature_index_output_path = os.path.join(
-                ref_genome.get_snpeff_genbank_parent_dir(),
-                'gbk_feature_idx.pickle')
-
-        generate_gbk_feature_index(
-                ref_genome.get_snpeff_genbank_file_path(),
-                feature_index_output_path)
-
-        gbk_idx_dataset = Dataset.objects.create(
-                label=Dataset.TYPE.FEATURE_INDEX,
-                type=Dataset.TYPE.FEATURE_INDEX)
-
-        gbk_idx_dataset.filesystem_location = feature_index_output_path
-        gbk_idx_dataset.save()
-        ref_genome.dataset_set.add(gbk_idx_dataset)
+        ref_genome.ensure_feature_index()
 
     # We create the bwa index once here, so that alignments running in
     # parallel don't step on each others' toes.
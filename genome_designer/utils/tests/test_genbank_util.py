@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 
 from django.conf import settings
 from django.test import TestCase
@@ -7,11 +9,14 @@ from main.model_utils import get_dataset_with_type
 from main.models import Chromosome
 from main.models import Dataset
 from main.testing_util import create_common_entities
+from utils.genbank_util import generate_gbk_feature_index
+from utils.genbank_util import GenbankFeatureIndex
 from utils.import_util import import_reference_genome_from_local_file
 
 
 TEST_DATA_DIR = os.path.join(settings.PWD, 'test_data')
 TEST_GENBANK = os.path.join(TEST_DATA_DIR, 'mg1655.genbank')
+TEST_SMALL_GENBANK = os.path.join(TEST_DATA_DIR, 'test_genbank.gb')
 
 
 class TestGenbankUtil(TestCase):
@@ -34,4 +39,31 @@ class TestGenbankUtil(TestCase):
                 Dataset.TYPE.MOBILE_ELEMENT_FASTA)
 
         assert os.path.exists(
-                me_fa_dataset.get_absolute_location())
\ No newline at end of file
+                me_fa_dataset.get_absolute_location())
+
+    def test_gbk_feature_index(self):
+        """Test looking up features by position in the feature index.
+        """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            feature_index_path = os.path.join(temp_dir, 'feature_index.npy')
+            generate_gbk_feature_index(TEST_SMALL_GENBANK, feature_index_path)
+            feature_index = GenbankFeatureIndex(feature_index_path)
+
+            def _names(interval, chromosome='NC_000913.1'):
+                return [f.name for f in feature_index.get_features_at_interval(
+                        interval, chromosome=chromosome)]
+
+            # Within a gene, and an empty interval at a position in it.
+            self.assertEqual(['tolC'], _names((200, 300)))
+            self.assertEqual(['tolC'], _names((1629, 1629)))
+
+            # Spanning genes, and between genes.
+            self.assertEqual(['tolC', 'ygiB', 'ygiC'], _names((1600, 2500)))
+            self.assertEqual([], _names((1630, 1777)))
+
+            # Unknown chromosomes search all chromosomes.
+            self.assertEqual(['zupT'], _names((5000, 6000), chromosome=None))
+            self.assertEqual(['zupT'], _names((5000, 6000), chromosome='x'))
+        finally:
+            shutil.rmtree(temp_dir)
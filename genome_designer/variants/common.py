@@ -3,8 +3,14 @@ Helpers and utils for working with Variants.
 """
 
 from collections import OrderedDict
+import json
 import re
 
+from django.db import connection
+from django.db import transaction
+from psycopg2.extras import Json as psycopg2_Json
+
+from main.model_utils import copy_rows
 from main.models import VariantCallerCommonData
 
 from materialized_view_manager import MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP
@@ -16,6 +22,7 @@ from variants.filter_key_map_constants import MAP_KEY__EXPERIMENT_SAMPLE
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__ES_LABEL
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_LABEL
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_UID
+from variants.melted_variant_schema import get_variant_set_sql_expression
 
 
 ###############################################################################
@@ -51,6 +58,19 @@ VARIANT_KEY_TO_MATERIALIZED_VIEW_COL_MAP = {
     MAP_KEY__EXPERIMENT_SAMPLE: 'es_data'
 }
 
+# First key of the Postgresql advisory lock held while the parent/child fields
+# of an AlignmentGroup are updated. The second key is the AlignmentGroup id.
+PARENT_CHILD_FIELDS_ADVISORY_LOCK_NAMESPACE = 7302
+
+# Temporary table that the updated VariantEvidence data is copied into.
+PARENT_CHILD_FIELDS_STAGING_TABLE_NAME = 'parent_child_fields_evidence_data'
+
+# Server-side cursor that the VariantEvidence rows are read through.
+PARENT_CHILD_FIELDS_CURSOR_NAME = 'parent_child_fields_evidence'
+
+# Number of VariantEvidence rows fetched from the cursor at a time.
+PARENT_CHILD_FIELDS_BATCH_SIZE = 5000
+
 ################################################################################
 # Parsing Regular Expressions
 ################################################################################
@@ -198,10 +218,12 @@ def convert_delim_key_value_triple_to_expr(triple):
     # Grab the parts for convenience.
     (delim, key, value) = triple
 
-    # HACK: Special handling for variant set keys.
+    # HACK: Special handling for variant set keys. These are arrays in the
+    # materialized view, so check containment, which can use the GIN index.
     if key in [MELTED_SCHEMA_KEY__VS_LABEL, MELTED_SCHEMA_KEY__VS_UID]:
         assert delim in ['==', '=']
-        return ('%s = ANY (' + key + ')', value)
+        return (get_variant_set_sql_expression(key) +
+                ' @> ARRAY[%s]::varchar[]', value)
 
     # Make '==' SQL-friendly.
     if delim == '==':
@@ -344,63 +366,92 @@ def determine_visible_field_names(hard_coded_keys, filter_string,
 
 def update_parent_child_variant_fields(alignment_group):
     """
-
     Update all variant evidence objects with the correct parent/child
     relationships.
 
     Add/update a data field called IN_PARENTS to the variant evidence data
-    json, which will check to see if the GT_TYPE is >= 0 in any of the
-    parents, and another called IN_CHILDREN, which will check to see if
-    GT_TYPE >= 0 in any of the children.
+    json, which will check to see if the GT_TYPE is > 0 in any of the
+    parents, and another called IN_CHILDREN, which counts the children with
+    GT_TYPE > 0.
 
     Ideally this is done before making the materialized view.
 
-    Note: This should only be run ONCE, right after all variants are done but
-    before the materialized view is made. Also, it should NEVER be run by
-    a task such that multiple are run in parallel, since that hoses the DB.
+    The values are computed for all VariantEvidence objects of the
+    AlignmentGroup with a single query, which is read through a server-side
+    cursor in batches, and the changed data is written back. Postgresql 9.3
+    can't modify json values in place, so the data is rewritten on the
+    client. Only the VariantEvidence objects of this AlignmentGroup are
+    touched, and runs for the same AlignmentGroup are serialized with an
+    advisory lock, so this is safe to run concurrently.
     """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+            (PARENT_CHILD_FIELDS_ADVISORY_LOCK_NAMESPACE, alignment_group.id))
+
+    # IN_PARENTS is NULL if none of the parents of the sample has evidence
+    # for the Variant, in which case the field is left alone.
+    gt_type_expr = "COALESCE((%s.data->>'GT_TYPE')::integer, 0)"
+    parent_gt_type = gt_type_expr % 'parent_ve'
+    child_gt_type = gt_type_expr % 'child_ve'
+
+    # A named cursor keeps the result on the server, in this transaction, so
+    # that only one batch of rows is held in memory at a time.
+    select_cursor = connection.connection.cursor(
+            name=PARENT_CHILD_FIELDS_CURSOR_NAME)
+    select_cursor.execute(
+            'SELECT ve.id, ve.data::text, '
+                '(SELECT max((' + parent_gt_type + ' > 0)::integer) '
+                    'FROM main_experimentsamplerelation AS relation '
+                    'INNER JOIN main_variantevidence AS parent_ve ON ('
+                        'parent_ve.experiment_sample_id = relation.parent_id '
+                        'AND parent_ve.variant_caller_common_data_id = '
+                            've.variant_caller_common_data_id) '
+                    'WHERE relation.child_id = ve.experiment_sample_id), '
+                '(SELECT count(*) '
+                    'FROM main_experimentsamplerelation AS relation '
+                    'INNER JOIN main_variantevidence AS child_ve ON ('
+                        'child_ve.experiment_sample_id = relation.child_id '
+                        'AND child_ve.variant_caller_common_data_id = '
+                            've.variant_caller_common_data_id) '
+                    'WHERE relation.parent_id = ve.experiment_sample_id '
+                    'AND ' + child_gt_type + ' > 0) '
+            'FROM main_variantevidence AS ve '
+            'INNER JOIN main_variantcallercommondata AS vccd ON ('
+                'vccd.id = ve.variant_caller_common_data_id) '
+            'WHERE vccd.alignment_group_id = %s',
+            (alignment_group.id,))
+
+    update_cursor = connection.cursor()
+    update_cursor.execute('DROP TABLE IF EXISTS %s' % (
+            PARENT_CHILD_FIELDS_STAGING_TABLE_NAME,))
+    update_cursor.execute('CREATE TEMP TABLE %s (id integer, data json)' % (
+            PARENT_CHILD_FIELDS_STAGING_TABLE_NAME,))
 
-    #1. Get parent-children uid relationships for all experiment_samples
-    # in alignment_group.
-    samples = alignment_group.get_samples()
-    parent_uid__to__child_uid_list = {}
-    for sample in samples:
-        child_uid_list = [child.uid for child in sample.get_children()]
-        parent_uid__to__child_uid_list[sample.uid] = child_uid_list
-
-    #2. Grab all variants and update the variant_evidence fields with data from
-    #   each pair.
-    for vcc in alignment_group.variantcallercommondata_set.all():
-        ve_set = vcc.variantevidence_set.all()
-        ve_uid__to__ve = {}
-        sample_uid__to__ve = {}
-        ve_uid__to__gt = {}
-        for ve in ve_set:
-            ve_uid__to__ve[ve.uid] = ve
-            sample_uid__to__ve[ve.experiment_sample.uid] = ve
-            ve_uid__to__gt[ve.uid] = (
-                    0 if ve.data['GT_TYPE'] is None else ve.data['GT_TYPE'])
-
-        for parent_uid, child_uids in parent_uid__to__child_uid_list.items():
-            if not parent_uid in sample_uid__to__ve:
-                continue
-            parent_ve = sample_uid__to__ve[parent_uid]
-
-            chldrn_ve_list = []
-            for child_uid in child_uids:
-                if child_uid in sample_uid__to__ve:
-                    chldrn_ve_list.append(sample_uid__to__ve[child_uid])
-
-            # If the parent GT_TYPE is > 0, then set in_parent to 1.
-            in_parent = int(ve_uid__to__gt[parent_ve.uid] > 0)
-
-            # For each child whose GT_TYPE is > 0, increment in_children.
-            in_children = 0
-            for child_ve in chldrn_ve_list:
-                child_ve.data['IN_PARENTS'] = in_parent
-                in_children += int(child_ve.data['GT_TYPE'] > 0)
-                child_ve.save(update_fields=['data'])
-
-            sample_uid__to__ve[parent_uid].data['IN_CHILDREN'] = in_children
-            sample_uid__to__ve[parent_uid].save(update_fields=['data'])
+    while True:
+        rows = select_cursor.fetchmany(PARENT_CHILD_FIELDS_BATCH_SIZE)
+        if not rows:
+            break
+
+        updated_rows = []
+        for ve_id, data_text, in_parents, in_children in rows:
+            data = json.loads(data_text) if data_text else {}
+            updated_data = dict(data)
+            if in_parents is not None:
+                updated_data['IN_PARENTS'] = in_parents
+            updated_data['IN_CHILDREN'] = in_children
+            if updated_data != data:
+                updated_rows.append((ve_id, psycopg2_Json(updated_data)))
+
+        copy_rows(PARENT_CHILD_FIELDS_STAGING_TABLE_NAME, ['id', 'data'],
+                updated_rows)
+    select_cursor.close()
+
+    update_cursor.execute(
+            'UPDATE main_variantevidence SET data = staging.data '
+            'FROM %s AS staging '
+            'WHERE main_variantevidence.id = staging.id' % (
+                    PARENT_CHILD_FIELDS_STAGING_TABLE_NAME,))
+    update_cursor.execute('DROP TABLE %s' % (
+            PARENT_CHILD_FIELDS_STAGING_TABLE_NAME,))
+    transaction.commit_unless_managed()
 
@@ -0,0 +1,285 @@
+"""
+Parser for the Variant filter language.
+
+A filter string is parsed into a tree whose leaves are the conditions
+recognized by the regexes in variants/common.py, combined with AND (&),
+OR (|), NOT (~) and parentheses. The tree is compiled to a SQL WHERE clause
+as is, rather than first being expanded into disjunctive normal form, which
+can be exponentially larger than the filter.
+
+Usage:
+    filter_tree = parse_filter_string('(position > 5 | position < 2) & ALT=C')
+    (where_clause, args) = filter_tree.compile(compile_condition)
+"""
+
+import re
+
+from variants.common import EXPRESSION_REGEX
+from variants.common import GENE_REGEX
+from variants.common import ParseError
+from variants.common import SAMPLE_SCOPE_REGEX
+from variants.common import SET_REGEX
+
+
+# Regexes that pick out the leaf conditions, in the order they are applied.
+CONDITION_REGEXES = [
+    SAMPLE_SCOPE_REGEX,
+    EXPRESSION_REGEX,
+    SET_REGEX,
+    GENE_REGEX,
+]
+
+TOKEN__AND = '&'
+TOKEN__OR = '|'
+TOKEN__NOT = '~'
+TOKEN__LEFT_PAREN = '('
+TOKEN__RIGHT_PAREN = ')'
+
+# Recognizes the operators between conditions.
+OPERATOR_REGEX = re.compile(
+        '\s*(?:'
+            '(?P<and>&|\\bAND\\b|\\band\\b)|'
+            '(?P<or>\||\\bOR\\b|\\bor\\b)|'
+            '(?P<not>~|\\bNOT\\b|\\bnot\\b)|'
+            '(?P<left_paren>\()|'
+            '(?P<right_paren>\))'
+        ')\s*')
+
+OPERATOR_REGEX_GROUP_TO_TOKEN = {
+    'and': TOKEN__AND,
+    'or': TOKEN__OR,
+    'not': TOKEN__NOT,
+    'left_paren': TOKEN__LEFT_PAREN,
+    'right_paren': TOKEN__RIGHT_PAREN,
+}
+
+
+###############################################################################
+# Filter tree nodes.
+###############################################################################
+
+class FilterNode(object):
+    """Base class for the nodes of a parsed filter.
+    """
+
+    def compile(self, compile_condition):
+        """Compiles the tree rooted at this node to a SQL expression.
+
+        Args:
+            compile_condition: Function that takes a condition string and
+                returns a tuple (sql expression, list of arguments).
+
+        Returns:
+            Tuple (sql expression, list of arguments).
+        """
+        raise NotImplementedError("Child classes must implement.")
+
+    def get_conditions(self):
+        """Returns the list of condition strings in the tree, in order.
+        """
+        raise NotImplementedError("Child classes must implement.")
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class FilterCondition(FilterNode):
+    """A single condition, e.g. 'position > 5'.
+    """
+
+    def __init__(self, condition_string):
+        self.condition_string = condition_string
+
+    def compile(self, compile_condition):
+        return compile_condition(self.condition_string)
+
+    def get_conditions(self):
+        return [self.condition_string]
+
+    def __repr__(self):
+        return 'FilterCondition(%r)' % self.condition_string
+
+
+class FilterAnd(FilterNode):
+    """Conjunction of two or more nodes.
+    """
+
+    SQL_OPERATOR = ' AND '
+
+    def __init__(self, children):
+        self.children = children
+
+    def compile(self, compile_condition):
+        sql_parts = []
+        args = []
+        for child in self.children:
+            (child_sql, child_args) = child.compile(compile_condition)
+            sql_parts.append('(' + child_sql + ')')
+            args.extend(child_args)
+        return (self.SQL_OPERATOR.join(sql_parts), args)
+
+    def get_conditions(self):
+        conditions = []
+        for child in self.children:
+            conditions.extend(child.get_conditions())
+        return conditions
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.children)
+
+
+class FilterOr(FilterAnd):
+    """Disjunction of two or more nodes.
+    """
+
+    SQL_OPERATOR = ' OR '
+
+
+class FilterNot(FilterNode):
+    """Negation of a node.
+    """
+
+    def __init__(self, child):
+        self.child = child
+
+    def compile(self, compile_condition):
+        (child_sql, child_args) = self.child.compile(compile_condition)
+        return ('NOT (' + child_sql + ')', child_args)
+
+    def get_conditions(self):
+        return self.child.get_conditions()
+
+    def __repr__(self):
+        return 'FilterNot(%r)' % self.child
+
+
+###############################################################################
+# Parsing.
+###############################################################################
+
+def parse_filter_string(filter_string):
+    """Parses the filter string into a tree of FilterNodes.
+
+    Returns:
+        The root FilterNode, or None if the filter string is empty.
+
+    Raises:
+        ParseError if the filter string is malformed.
+    """
+    tokens = _tokenize(filter_string)
+    if not tokens:
+        return None
+    return _FilterTokenParser(filter_string, tokens).parse()
+
+
+def _tokenize(filter_string):
+    """Splits the filter string into a list of tokens, which are either
+    FilterCondition objects or one of the TOKEN__* operators.
+    """
+    # First pick out the conditions, leaving the strings between them.
+    segments = [filter_string]
+    for regex in CONDITION_REGEXES:
+        split_segments = []
+        for segment in segments:
+            if isinstance(segment, FilterCondition):
+                split_segments.append(segment)
+                continue
+
+            # The regexes have a single group, so matches end up at odd
+            # indexes.
+            for idx, part in enumerate(regex.split(segment)):
+                if idx % 2:
+                    split_segments.append(FilterCondition(part))
+                else:
+                    split_segments.append(part)
+        segments = split_segments
+
+    # The strings between conditions should only contain operators.
+    tokens = []
+    for segment in segments:
+        if isinstance(segment, FilterCondition):
+            tokens.append(segment)
+            continue
+
+        position = 0
+        while segment[position:].strip():
+            match = OPERATOR_REGEX.match(segment, position)
+            if match is None:
+                raise ParseError(filter_string,
+                        'Unexpected input: %s' % segment[position:].strip())
+            tokens.append(OPERATOR_REGEX_GROUP_TO_TOKEN[match.lastgroup])
+            position = match.end()
+    return tokens
+
+
+class _FilterTokenParser(object):
+    """Recursive descent parser for the grammar:
+
+        expression := term (OR term)*
+        term := factor (AND factor)*
+        factor := NOT factor | '(' expression ')' | condition
+    """
+
+    def __init__(self, filter_string, tokens):
+        self.filter_string = filter_string
+        self.tokens = tokens
+        self.position = 0
+
+    def parse(self):
+        node = self._parse_expression()
+        if self.position != len(self.tokens):
+            raise ParseError(self.filter_string,
+                    'Unexpected %s' % self._describe(self._peek()))
+        return node
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _describe(self, token):
+        if token is None:
+            return 'end of filter'
+        if isinstance(token, FilterCondition):
+            return 'condition: ' + token.condition_string
+        return 'operator: ' + token
+
+    def _parse_expression(self):
+        children = [self._parse_term()]
+        while self._peek() == TOKEN__OR:
+            self._next()
+            children.append(self._parse_term())
+        if len(children) == 1:
+            return children[0]
+        return FilterOr(children)
+
+    def _parse_term(self):
+        children = [self._parse_factor()]
+        while self._peek() == TOKEN__AND:
+            self._next()
+            children.append(self._parse_factor())
+        if len(children) == 1:
+            return children[0]
+        return FilterAnd(children)
+
+    def _parse_factor(self):
+        token = self._next()
+        if isinstance(token, FilterCondition):
+            return token
+        elif token == TOKEN__NOT:
+            return FilterNot(self._parse_factor())
+        elif token == TOKEN__LEFT_PAREN:
+            node = self._parse_expression()
+            if self._next() != TOKEN__RIGHT_PAREN:
+                raise ParseError(self.filter_string, 'Unbalanced parentheses.')
+            return node
+        raise ParseError(self.filter_string,
+                'Expected a condition but got %s' % self._describe(token))
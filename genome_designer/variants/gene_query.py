@@ -19,7 +19,7 @@ def lookup_genes(alignment_group):
 	# Perform the query against the melted variant view.
 	materialized_view_manager = MeltedVariantMaterializedViewManager(
 		alignment_group.reference_genome)
-	materialized_view_manager.create_if_not_exists_or_invalid()
+	materialized_view_manager.create_if_not_exists_or_invalid(background=True)
 
 	# Build up the sql statement in parts.
 
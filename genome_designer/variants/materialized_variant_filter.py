@@ -6,29 +6,32 @@ code than the original implementation; thus it makes sense to re-implement
 from scratch.
 """
 
-import re
-
+from array import array
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import connection
-from sympy.logic import boolalg
 
-from variants.common import EXPRESSION_REGEX
-from variants.common import SAMPLE_SCOPE_REGEX
-from variants.common import GENE_REGEX
-from variants.common import SET_REGEX
 from variants.common import convert_delim_key_value_triple_to_expr
 from variants.common import generate_key_to_materialized_view_parent_col
 from variants.common import get_all_key_map
 from variants.common import get_delim_key_value_triple
-from variants.common import SymbolGenerator
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__BOOLEAN
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__FLOAT
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__INTEGER
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__STRING
+from variants.filter_parser import parse_filter_string
 from variants.materialized_view_manager import MATERIALIZED_TABLE_QUERY_SELECT_CLAUSE_COMPONENTS
 from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
 from variants.melted_variant_schema import CAST_SCHEMA_KEY__TOTAL_SAMPLE_COUNT
+from variants.melted_variant_schema import get_json_key_sql_expression
+from variants.melted_variant_schema import MATERIALIZED_TABLE_JSON_COL_TO_KEY_MAP_SUBMAP
+from variants.melted_variant_schema import MELTED_SCHEMA_KEY__CHROMOSOME
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__POSITION
+from variants.melted_variant_schema import MELTED_SCHEMA_KEY__REF
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__UID
+from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VA_ID
+from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VE_ID
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__ALT
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__ES_UID
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_UID
@@ -36,6 +39,72 @@ from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_LABEL
 from variants.filter_scope import FilterScope
 
 
+# Sort columns that are never NULL and constant per Variant, and so can lead
+# the sort key used for keyset pagination.
+KEYSET_PAGINATION_SORT_COLS = [
+    MELTED_SCHEMA_KEY__POSITION,
+    MELTED_SCHEMA_KEY__UID,
+    MELTED_SCHEMA_KEY__CHROMOSOME,
+    MELTED_SCHEMA_KEY__REF,
+]
+
+# Prefix of the extra columns holding the sort key of each row, which are
+# selected to record where a page ends.
+SEEK_KEY_COL_PREFIX = 'SEEK_KEY_'
+
+
+# Marks a cached filter that matches too many Variants for the cache to help.
+FILTER_RESULT_CACHE__NOT_SELECTIVE = 'not_selective'
+
+
+class LRUCache(object):
+    """Thread-safe, in-process cache that evicts the least recently used
+    entry once it holds more than max_size entries.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value for the key, or None if it is not cached.
+        """
+        with self._lock:
+            if not key in self._entries:
+                return None
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Sorted arrays of ids of the Variants matching a filter, keyed on the
+# ReferenceGenome, the generation of its materialized view, the normalized
+# filter string and the AlignmentGroup. Since the key includes the generation,
+# entries for a view that has since been updated are never hit again and
+# simply age out.
+FILTER_RESULT_CACHE = LRUCache(settings.MATERIALIZED_VIEW_FILTER_CACHE_SIZE)
+
+# Parsed filter trees, keyed on the filter string. Parsing doesn't depend on
+# the ReferenceGenome, so these are shared.
+FILTER_TREE_CACHE = LRUCache(settings.MATERIALIZED_VIEW_FILTER_CACHE_SIZE)
+
+
 # Uncomment for DEBUG
 # import logging
 # LOGGER = logging.getLogger('debug_logger')
@@ -64,11 +133,13 @@ class VariantFilterEvaluator(object):
                 to the samples according to the semantic setting of the scope.
         """
         # Manager for making queries to the materialized view table
-        # for this ReferenceGenome.
-
+        # for this ReferenceGenome. If the view needs a full rebuild, we
+        # query the existing view while it is rebuilt in the background.
         self.materialized_view_manager = MeltedVariantMaterializedViewManager(
                 ref_genome)
-        self.materialized_view_manager.create_if_not_exists_or_invalid()
+        self.is_view_refreshing = (
+                self.materialized_view_manager.create_if_not_exists_or_invalid(
+                        background=True))
 
         # Validation.
         if scope is not None:
@@ -95,71 +166,22 @@ class VariantFilterEvaluator(object):
         self.all_key_map = get_all_key_map(self.ref_genome)
         self.scope = scope
 
-        # Generator object that provides symbols in alphabetical order.
-        self.symbol_maker = SymbolGenerator()
-
-        # Catch trivial, no filter case.
-        if self.filter_string == '':
-            self.sympy_representation = ''
-        else:
-            self._create_symbolic_representation()
-
-    def _create_symbolic_representation(self):
-        """Creates a symbolic representation of the query to enable, among
-        other things, manipulation with sympy so we can get to disjunctive
-        normal form (DNF).
-        """
-        # Find all the expressions and replace them with symbols.
-        self.symbol_to_expression_map = {}
-
-        symbolified_string = self.filter_string
-        for regex in [SAMPLE_SCOPE_REGEX, EXPRESSION_REGEX, SET_REGEX,
-                GENE_REGEX]:
-            symbolified_string = self._symbolify_string_for_regex(
-                    symbolified_string, regex)
-
-        symbolified_string = re.sub('AND|and', '&', symbolified_string)
-        symbolified_string = re.sub('OR|or', '|', symbolified_string)
-
-        self.sympy_representation = boolalg.to_dnf(symbolified_string)
-
-
-    def _symbolify_string_for_regex(self, start_string, regex):
-        """Iterates through the string tokenized by the regex and replaces
-        the matching tokens with symbols.
-        """
-        tokens = regex.split(start_string)
-        symbolified_tokens = []
-        for token in tokens:
-            if regex.match(token):
-                symbol = self.symbol_maker.next()
-                self.symbol_to_expression_map[symbol] = token
-                symbolified_tokens.append(symbol)
-            else:
-                symbolified_tokens.append(token)
-        symbolified_string = ''.join(symbolified_tokens)
-        return symbolified_string
-
-
-    def get_condition_string_for_symbol(self, symbol):
-        """Returns the condition string that the symbol replaced.
-
-        Args:
-            symbol: A sympy.core.symbol.Symbol or string.
-
-        Returns:
-            A string representing a query condition.
-        """
-        if isinstance(symbol, str):
-            symbol_str = symbol
-        else:
-            symbol_str = str(symbol)
-        return self.symbol_to_expression_map[symbol_str]
-
+        # Parse the filter, or None if there is no filter.
+        self.filter_tree = FILTER_TREE_CACHE.get(self.filter_string)
+        if self.filter_tree is None:
+            self.filter_tree = parse_filter_string(self.filter_string)
+            FILTER_TREE_CACHE.set(self.filter_string, self.filter_tree)
 
     def evaluate(self):
         """Evaluates the given database query.
 
+        If the sort column allows it, pages are fetched using keyset
+        pagination: the sort key of the last row of each page is cached as a
+        bookmark, so that the next page can seek directly past it rather than
+        sorting and skipping over all previous rows with OFFSET. The cache
+        (settings.CACHES) is shared between web server processes, so the next
+        page finds the bookmark whichever process serves it.
+
         Returns:
             A FilterEvalResult object.
         """
@@ -177,21 +199,195 @@ class VariantFilterEvaluator(object):
         else:
             select_clause = self._select_clause()
 
-        # We also need the full count of results for pagination purposes, so
-        # we use something called window functions.
-        select_clause += ', count(*) OVER() AS full_count '
+        # Determine the sort key. If it is unique per row, we can use it
+        # for keyset pagination.
+        sort_key_cols = self._get_sort_key_cols()
+        use_keyset_pagination = (sort_key_cols is not None and
+                self.optimization_uid_list is None and
+                self.pagination_len != -1 and
+                not self.act_as_generator)
+
+        # Look up the bookmark left by the query for the previous page.
+        seek_key = None
+        if use_keyset_pagination:
+            select_clause += ', ' + ', '.join([
+                    '%s AS %s%d' % (self._sort_key_col_select_expr(col),
+                            SEEK_KEY_COL_PREFIX, i)
+                    for i, col in enumerate(sort_key_cols)])
+            if self.pagination_start > 0:
+                seek_key = cache.get(self._get_bookmark_cache_key(
+                        self.pagination_start))
 
         # Minimal sql_statement has select clause.
-        sql_statement = 'SELECT %s FROM %s ' % (select_clause,
+        from_where_clause, where_clause_args = self._from_where_clause(
+                sort_key_cols=sort_key_cols, seek_key=seek_key)
+        sql_statement = 'SELECT %s %s' % (select_clause, from_where_clause)
+
+        # If cast, need to group by position for array_agg to work.
+        if not self.is_melted:
+            sql_statement += 'GROUP BY %s ' % MELTED_SCHEMA_KEY__UID
+
+        # Add sort clause, defaulting to position.
+        if self.sort_by_direction == 'desc':
+            sort_direction = 'DESC '
+        else:
+            sort_direction = ''
+        if sort_key_cols is not None:
+            sql_statement += 'ORDER BY %s ' % ', '.join([
+                    self._sort_key_col_select_expr(col) + ' ' + sort_direction
+                    for col in sort_key_cols])
+        elif self.sort_by_column:
+            sql_statement += 'ORDER BY %s %s' % (self.sort_by_column,
+                    sort_direction)
+        else:
+            sql_statement += 'ORDER BY %s %s' % (MELTED_SCHEMA_KEY__POSITION,
+                    sort_direction)
+
+        # Add limit and offset clause. Only if no optimization limit.
+        # No offset is needed if we seek past the previous page.
+        if self.optimization_uid_list is None:
+            if self.pagination_len != -1:
+                sql_statement += 'LIMIT %d ' % self.pagination_len
+            if seek_key is None:
+                sql_statement += 'OFFSET %d ' % self.pagination_start
+
+        # DEBUG
+        # LOGGER.debug(sql_statement)
+
+        # Execute the query and store the results in hashable representation
+        # so that they can be combined through boolean operators with other
+        # evaluations.
+        cursor = connection.cursor()
+        cursor.execute(sql_statement, where_clause_args)
+
+        # Column header data.
+        col_descriptions = [col[0].upper() for col in cursor.description]
+
+        # Either act as a generator, or return all results.
+        if self.act_as_generator:
+            def as_generator():
+              next_row = cursor.fetchone()
+              while next_row:
+                  yield dict(zip(col_descriptions, next_row))
+                  next_row = cursor.fetchone()
+            return as_generator()
+
+        results = [dict(zip(col_descriptions, row))
+                for row in cursor.fetchall()]
+
+        if use_keyset_pagination:
+            # Leave a bookmark for the next page and strip the seek key
+            # columns from the results.
+            if len(results) == self.pagination_len:
+                last_row = results[-1]
+                cache.set(self._get_bookmark_cache_key(
+                                self.pagination_start + len(results)),
+                        [last_row[SEEK_KEY_COL_PREFIX + str(i)]
+                                for i in range(len(sort_key_cols))],
+                        settings.MATERIALIZED_VIEW_QUERY_CACHE_TIMEOUT)
+            for row in results:
+                for i in range(len(sort_key_cols)):
+                    del row[SEEK_KEY_COL_PREFIX + str(i)]
+
+        return results
+
+    def count(self):
+        """Returns the total number of results matching the filter, ignoring
+        pagination. For the melted view, this is the number of rows, and for
+        the cast view, the number of Variants.
+
+        Counts are cached against the generation of the materialized view.
+        If there is no filter string, the planner's estimate is used instead
+        when it exceeds settings.MATERIALIZED_VIEW_ESTIMATED_COUNT_THRESHOLD.
+        """
+        cache_key = self._get_query_cache_key('count')
+        num_results = cache.get(cache_key)
+        if num_results is not None:
+            return num_results
+
+        # In the cast view, the count is the number of matching Variants.
+        if not self.is_melted:
+            matching_variant_ids = self._get_matching_variant_ids()
+            if matching_variant_ids is not None:
+                return len(matching_variant_ids)
+
+        from_where_clause, where_clause_args = self._from_where_clause()
+        cursor = connection.cursor()
+
+        if not self.filter_string:
+            num_results = self._estimate_count(cursor, from_where_clause,
+                    where_clause_args)
+            if (num_results <
+                    settings.MATERIALIZED_VIEW_ESTIMATED_COUNT_THRESHOLD):
+                num_results = None
+
+        if num_results is None:
+            if self.is_melted:
+                count_select_clause = 'count(*)'
+            else:
+                count_select_clause = 'count(DISTINCT %s)' % (
+                        MELTED_SCHEMA_KEY__UID)
+            cursor.execute('SELECT %s %s' % (count_select_clause,
+                    from_where_clause), where_clause_args)
+            num_results = cursor.fetchone()[0]
+
+        cache.set(cache_key, num_results,
+                settings.MATERIALIZED_VIEW_QUERY_CACHE_TIMEOUT)
+        return num_results
+
+    def _estimate_count(self, cursor, from_where_clause, where_clause_args):
+        """Returns the planner's estimate of the number of results.
+        """
+        if self.is_melted:
+            sql_statement = 'SELECT 1 %s' % from_where_clause
+        else:
+            sql_statement = 'SELECT %s %s GROUP BY %s' % (
+                    MELTED_SCHEMA_KEY__UID, from_where_clause,
+                    MELTED_SCHEMA_KEY__UID)
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql_statement,
+                where_clause_args)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def _from_where_clause(self, sort_key_cols=None, seek_key=None,
+            use_filter_result_cache=True):
+        """Builds the FROM and WHERE clauses shared by the data and count
+        queries.
+
+        Args:
+            sort_key_cols: Columns of the sort key. Required if seek_key
+                is provided.
+            seek_key: Optional list of values of the sort key of the last row
+                of the previous page. If provided, only rows after it are
+                matched.
+            use_filter_result_cache: If True, and the ids of the Variants
+                matching the filter are cached, restrict the query to the rows
+                of those Variants so the filter is only evaluated against them.
+
+        Returns:
+            Tuple (sql string, list of arguments).
+        """
+        sql_statement = 'FROM %s ' % (
                 self.materialized_view_manager.get_table_name())
 
         # Maybe construct WHERE clause.
-        if self.sympy_representation:
+        if self.filter_tree is not None:
             where_clause, where_clause_args = self._where_clause()
         else:
             where_clause = None
             where_clause_args = []
 
+        # Restrict to the Variants known to match. The filter itself is still
+        # applied since it may only match some of the rows of a Variant.
+        if where_clause and use_filter_result_cache:
+            matching_variant_ids = self._get_matching_variant_ids()
+            if matching_variant_ids is not None:
+                where_clause = 'id = ANY(%s) AND (' + where_clause + ')'
+                where_clause_args = (
+                        [list(matching_variant_ids)] + where_clause_args)
+
         # Optimization UID part.
         if self.optimization_uid_list is not None:
             opt_uid_part = '(uid in ('
@@ -220,50 +416,133 @@ class VariantFilterEvaluator(object):
         else:
             where_clause = where_clause_alignment_group_part
 
+        # Maybe seek past the previous page. The sort key columns are constant
+        # per Variant, so this is valid before grouping in the cast view.
+        if seek_key is not None:
+            if self.sort_by_direction == 'desc':
+                seek_op = '<'
+            else:
+                seek_op = '>'
+            seek_part = '(%s) %s (%s)' % (', '.join(sort_key_cols), seek_op,
+                    ', '.join(['%s'] * len(seek_key)))
+            if where_clause:
+                where_clause = '(%s) AND %s' % (where_clause, seek_part)
+            else:
+                where_clause = seek_part
+            where_clause_args = where_clause_args + list(seek_key)
+
         # Add WHERE clause to SQL statement.
         if where_clause:
             sql_statement += 'WHERE (' + where_clause + ') '
 
-        # If cast, need to group by position for array_agg to work.
-        if not self.is_melted:
-            sql_statement += 'GROUP BY %s ' % MELTED_SCHEMA_KEY__UID
+        return (sql_statement, where_clause_args)
 
-        # Add optional sort clause, defaulting to position.
-        if self.sort_by_column:
-            sql_statement += 'ORDER BY %s ' % self.sort_by_column
-        else:
-            sql_statement += 'ORDER BY %s ' % MELTED_SCHEMA_KEY__POSITION
-        if self.sort_by_direction == 'desc':
-            sql_statement += 'DESC '
+    def _get_matching_variant_ids(self):
+        """Returns the sorted array of ids of the Variants with any rows
+        matching the filter, computing and caching it on the first call for
+        the current generation of the view.
 
-        # Add limit and offset clause. Only if no optimization limit.
-        if self.optimization_uid_list is None:
-            if self.pagination_len != -1:
-                sql_statement += 'LIMIT %d ' % self.pagination_len
-            sql_statement += 'OFFSET %d ' % self.pagination_start
+        Returns None if there is no filter, the query is restricted to an
+        optimization_uid_list, or the filter matches more than
+        settings.MATERIALIZED_VIEW_FILTER_CACHE_MAX_VARIANTS Variants, in which
+        case restricting queries to the matching ids wouldn't help.
+        """
+        if not self.filter_string or self.optimization_uid_list is not None:
+            return None
 
-        # DEBUG
-        # LOGGER.debug(sql_statement)
+        if self.alignment_group:
+            alignment_group_id = self.alignment_group.id
+        else:
+            alignment_group_id = None
+        cache_key = (self.ref_genome.id, self._get_view_generation(),
+                ' '.join(self.filter_string.split()), alignment_group_id)
+
+        matching_variant_ids = FILTER_RESULT_CACHE.get(cache_key)
+        if matching_variant_ids is None:
+            from_where_clause, where_clause_args = self._from_where_clause(
+                    use_filter_result_cache=False)
+            cursor = connection.cursor()
+            cursor.execute('SELECT DISTINCT id %s' % from_where_clause,
+                    where_clause_args)
+            matching_variant_ids = array('l',
+                    sorted([row[0] for row in cursor.fetchall()]))
+            if (len(matching_variant_ids) >
+                    settings.MATERIALIZED_VIEW_FILTER_CACHE_MAX_VARIANTS):
+                matching_variant_ids = FILTER_RESULT_CACHE__NOT_SELECTIVE
+            FILTER_RESULT_CACHE.set(cache_key, matching_variant_ids)
+
+        if matching_variant_ids is FILTER_RESULT_CACHE__NOT_SELECTIVE:
+            return None
+        return matching_variant_ids
 
-        # Execute the query and store the results in hashable representation
-        # so that they can be combined through boolean operators with other
-        # evaluations.
-        cursor = connection.cursor()
-        cursor.execute(sql_statement, where_clause_args)
+    def _get_sort_key_cols(self):
+        """Returns the list of columns that make up a unique sort key for
+        the requested sort order, or None if the sort column can't be used
+        for keyset pagination.
+        """
+        if self.sort_by_column:
+            sort_col = self.sort_by_column.upper()
+        else:
+            sort_col = MELTED_SCHEMA_KEY__POSITION
 
-        # Column header data.
-        col_descriptions = [col[0].upper() for col in cursor.description]
+        if self.is_melted:
+            if not sort_col in KEYSET_PAGINATION_SORT_COLS:
+                return None
+            # A Variant has one row per VariantEvidence and alternate allele,
+            # and rows for VariantSets not associated with a sample have
+            # neither.
+            sort_key_cols = [sort_col, MELTED_SCHEMA_KEY__UID,
+                    'COALESCE(%s, 0)' % MELTED_SCHEMA_KEY__VE_ID,
+                    'COALESCE(%s, 0)' % MELTED_SCHEMA_KEY__VA_ID]
+        else:
+            if not sort_col in [MELTED_SCHEMA_KEY__POSITION,
+                    MELTED_SCHEMA_KEY__UID]:
+                return None
+            sort_key_cols = [sort_col, MELTED_SCHEMA_KEY__UID]
+
+        # Remove the repeated UID if sorting by UID.
+        if sort_col == MELTED_SCHEMA_KEY__UID:
+            sort_key_cols = sort_key_cols[1:]
+        return sort_key_cols
+
+    def _sort_key_col_select_expr(self, col):
+        """Returns the expression for the sort key column in the SELECT and
+        ORDER BY clauses, which in the cast view must be aggregated.
+        """
+        if self.is_melted or col == MELTED_SCHEMA_KEY__UID:
+            return col
+        return 'MIN(%s)' % col
 
-        # Either act as a generator, or return all results.
-        if self.act_as_generator:
-            def as_generator():
-              next_row = cursor.fetchone()
-              while next_row:
-                  yield dict(zip(col_descriptions, next_row))
-                  next_row = cursor.fetchone()
-            return as_generator()
+    def _get_query_cache_key(self, prefix, *extra):
+        """Returns a key for caching results derived from this query, which
+        is only valid for the current generation of the materialized view.
+        """
+        if self.alignment_group:
+            alignment_group_id = self.alignment_group.id
         else:
-            return [dict(zip(col_descriptions, row)) for row in cursor.fetchall()]
+            alignment_group_id = None
+        key_parts = (
+                self.ref_genome.id,
+                self._get_view_generation(),
+                alignment_group_id,
+                self.filter_string,
+                self.is_melted,
+                self.optimization_uid_list) + extra
+        return 'variant_filter_%s_%s' % (prefix,
+                hashlib.md5(repr(key_parts)).hexdigest())
+
+    def _get_bookmark_cache_key(self, pagination_start):
+        """Returns the key for caching the sort key of the row just before
+        pagination_start in the sort order of this query.
+        """
+        return self._get_query_cache_key('bookmark', self.sort_by_column,
+                self.sort_by_direction, pagination_start)
+
+    def _get_view_generation(self):
+        if not hasattr(self, '_view_generation'):
+            self._view_generation = (
+                    self.materialized_view_manager.get_generation())
+        return self._view_generation
 
     def _select_clause(self):
         """Determines the SELECT clause for the materialized view.
@@ -320,102 +599,28 @@ class VariantFilterEvaluator(object):
         return list(cols_to_fetch)
 
     def _where_clause(self):
-        # Returns None if no where clause, or
-        #   a tuple (where clause, arguments)
-        if not self.sympy_representation:
-            return None
+        """Compiles the filter tree to a SQL expression.
 
-        # On a high level, the algorithm breaks down into doing as much
-        # filtering on the SQL side, and then doing the rest in application
-        # memory. Fields that we currently handle in memory include those that
-        # are part of the catch-all serialized data field, as well as SQL
-        # fields which we must then use to establish the specific relationship
-        # between Variants and ExperimentSamples.
-
-        # First we bin the individual symbols in the clause according to how
-        # they should be handled. The binning decision works according to:
-        #     * Symbols that can be handled in SQL are picked out.
-        #         * They are all turned into Q objects.
-        #         * Those that are relevant to per-sample filtering are saved
-        #           for further analysis along with remaining triples below.
-        #     * Symbols that are a scoped expression are handled recursively
-        #       and the FilterEvalResult object returned.
-        #     * Non-SQL triples (part of serialized string) are saved for
-        #       for processing in-memory at the end.
-        #
-        # Order doesn't matter since this is a conjunction (AND) clause.
-
-        def _conjuntion_clause(conjunction_clause):
-
-            # Store the results of binning in these data structures.
-            filter_eval_results = []
-            sql_ready_symbol_list = []
-            remaining_triples = []
-
-            # Bin the parts of the query, potentially making recursive calls
-            # if we have scoped filters (e.g. per-sample).
-            if not conjunction_clause == '':
-                # Handle the case where a conjunction might be a single condition.
-                if not conjunction_clause.is_Boolean:
-                    symbol_list = [conjunction_clause]
-                else:
-                    symbol_list = conjunction_clause.args
-
-                # Bin.
-                for symbol in symbol_list:
-                    updated_structs = self._single_symbol_mux(
-                            symbol, filter_eval_results, sql_ready_symbol_list,
-                            remaining_triples)
-                    (filter_eval_results, sql_ready_symbol_list,
-                            remaining_triples) = updated_structs
+        Returns:
+            Tuple (where clause, list of arguments).
+        """
+        return self.filter_tree.compile(self._compile_condition)
 
-            where_clause_conjunctive_expr_list = []
-            where_clause_args = []
-            for triple in remaining_triples:
-                (expr, arg) = convert_delim_key_value_triple_to_expr(triple)
-                where_clause_conjunctive_expr_list.append(expr)
-                where_clause_args.append(arg)
-            return (' AND '.join(where_clause_conjunctive_expr_list),
-                    where_clause_args)
+    def _compile_condition(self, condition_string):
+        """Compiles a single condition of the filter tree.
 
-        # If only one conjunction clause, evaluate directly
-        if not isinstance(self.sympy_representation, boolalg.Or):
-            return _conjuntion_clause(self.sympy_representation)
-        else:
-            conjunction_clause_info = [_conjuntion_clause(conjunction_clause)
-                    for conjunction_clause in self.sympy_representation.args]
-            where_clause = ' OR '.join(['(' + info[0] + ')'
-                for info in conjunction_clause_info])
-            args = []
-            for info in conjunction_clause_info:
-                args.extend(info[1])
-            return (where_clause, args)
-
-
-    def _single_symbol_mux(self, symbol, filter_eval_results, q_list,
-            remaining_triples):
-        """Helper method for evaluating a single symbol.
-        """
-        result = self._handle_single_symbol(symbol)
-        remaining_triples.append(result)
-        return (filter_eval_results, q_list, remaining_triples)
-
-
-    def _handle_single_symbol(self, symbol):
-        """Returns one of:
-            * A FilterEvalResult object if the symbol represents a scoped
-                filter condition.
-            * A Tuple pair (Q_OBJ_TYPE, Django Q object), if the symbol
-                represents a condition that
-            can be evaluated against the SQL database.
-            * A triple of delim, key, value if the condition must be evaluated
-                in-memory.
+        Returns:
+            Tuple (sql expression, list of arguments).
         """
-        # Look up the expression that the symbol represents.
-        condition_string = self.get_condition_string_for_symbol(symbol)
+        (expr, arg) = convert_delim_key_value_triple_to_expr(
+                self._handle_condition(condition_string))
+        return (expr, [arg])
 
-        # Finally, if here, then this should be a basic, delimiter-separated
-        # expression.
+    def _handle_condition(self, condition_string):
+        """Returns a triple of delim, key, value for the condition string,
+        with the key rewritten to be used against the materialized view.
+        """
+        # This should be a basic, delimiter-separated expression.
         (delim, key, value) = get_delim_key_value_triple(condition_string,
                 self.all_key_map)
 
@@ -436,28 +641,18 @@ class VariantFilterEvaluator(object):
 
         json_field = generate_key_to_materialized_view_parent_col(
                 self.ref_genome).get(arg, None)
-        json_field_expanded = {
-                'vccd_data': 'snp_caller_common_data',
-                'va_data': 'snp_alternate_data',
-                'es_data': 'experiment_sample_data',
-                've_data': 'snp_evidence_data'}.get(json_field, None)
+        json_field_expanded = MATERIALIZED_TABLE_JSON_COL_TO_KEY_MAP_SUBMAP.get(
+                json_field, None)
 
         if json_field_expanded:
             # Get the type of the field from the original variant_key_map
             field_type = self.ref_genome.variant_key_map[
                     json_field_expanded][arg]['type']
 
-            # support these data types
-            # string doesn't need to be cast
-            field_type_expanded = {
-                    VARIANT_KEY_MAP_TYPE__INTEGER: '::Integer',
-                    VARIANT_KEY_MAP_TYPE__FLOAT: '::Float',
-                    VARIANT_KEY_MAP_TYPE__BOOLEAN: '::Boolean',
-                    VARIANT_KEY_MAP_TYPE__STRING: ''}.get(field_type, None)
-
-            if field_type_expanded is not None:
-                return "(%s->>'%s')%s" % (
-                    json_field, arg, field_type_expanded)
+            json_key_expression = get_json_key_sql_expression(
+                    json_field, arg, field_type)
+            if json_key_expression is not None:
+                return json_key_expression
 
         # default to returning arg exactly as is
         return arg
@@ -474,10 +669,14 @@ class LookupVariantsResult(object):
         result_list: List of cast or melted Variant objects.
         num_total_variants: Total number of variants that match query.
             For pagination.
+        is_view_refreshing: True if the results come from a stale
+            materialized view that is being rebuilt in the background.
     """
-    def __init__(self, result_list, num_total_variants):
+    def __init__(self, result_list, num_total_variants,
+            is_view_refreshing=False):
         self.result_list = result_list
         self.num_total_variants = num_total_variants
+        self.is_view_refreshing = is_view_refreshing
 
 
 def lookup_variants(query_args, reference_genome, alignment_group=None):
@@ -500,40 +699,47 @@ def lookup_variants(query_args, reference_genome, alignment_group=None):
     assert not 'get_uids_only' in query_args
     assert not 'optimization_uid_list' in query_args
 
-    # If cast view, set num_total_variants after initial uids-only call.
-    # If melted, set num_total_variants after full data call.
-    num_total_variants = None
+    is_view_refreshing = False
 
     if not query_args.get('is_melted', True):
         query_args['get_uids_only'] = True
-        uid_only_results = get_variants_that_pass_filter(
-                query_args, reference_genome, alignment_group=alignment_group)
+        count_evaluator = VariantFilterEvaluator(query_args, reference_genome,
+                alignment_group=alignment_group)
+        is_view_refreshing = count_evaluator.is_view_refreshing
+        uid_only_results = count_evaluator.evaluate()
         query_args['optimization_uid_list'] = [
                 r['UID'] for r in uid_only_results]
-        if len(uid_only_results):
-            num_total_variants = uid_only_results[0]['FULL_COUNT']
-        else:
-            num_total_variants = 0
+        num_page_results = len(uid_only_results)
 
     # If we did a first uids-only call, only do the second call if there were
     # any results.
-    if num_total_variants is None or num_total_variants > 0:
+    if (query_args.get('optimization_uid_list') is None or
+            len(query_args['optimization_uid_list'])):
         # Query full data.
         query_args['get_uids_only'] = False
-        page_results = get_variants_that_pass_filter(query_args, reference_genome,
+        evaluator = VariantFilterEvaluator(query_args, reference_genome,
                 alignment_group=alignment_group)
-
-        # Figure out number of total variants by parsing one of the above results,
-        # Only if not set in 1st call. This code should only run for melted results.
-        if num_total_variants is None:
-            if len(page_results):
-                num_total_variants = page_results[0]['FULL_COUNT']
-            else:
-                num_total_variants = 0
+        is_view_refreshing = is_view_refreshing or evaluator.is_view_refreshing
+        page_results = evaluator.evaluate()
     else:
         page_results = []
 
-    return LookupVariantsResult(page_results, num_total_variants)
+    # For melted results, count the rows of the full data call.
+    if query_args.get('is_melted', True):
+        count_evaluator = evaluator
+        num_page_results = len(page_results)
+
+    # The total count is a separate query, unless the first page already
+    # contains all the results.
+    pagination_len = query_args.get('pagination_len', -1)
+    if (query_args.get('pagination_start', 0) == 0 and
+            (pagination_len == -1 or num_page_results < pagination_len)):
+        num_total_variants = num_page_results
+    else:
+        num_total_variants = count_evaluator.count()
+
+    return LookupVariantsResult(page_results, num_total_variants,
+            is_view_refreshing=is_view_refreshing)
 
 
 def get_variants_that_pass_filter(query_args, ref_genome, alignment_group=None):
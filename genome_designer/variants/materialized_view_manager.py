@@ -1,12 +1,56 @@
 """
 Manages the Materialized view of the Variant data for filtering.
+
+When settings.MATERIALIZED_VIEW_INCREMENTAL is True, the melted data is kept
+in a regular table rather than a Postgresql materialized view. Writers record
+the ids of the Variants they touched in a companion dirty table (see
+ReferenceGenome.invalidate_materialized_view()), and only the rows for those
+Variants are re-computed the next time the table is requested. A full rebuild
+still happens when the table is missing, explicitly invalidated, or the
+ReferenceGenome.variant_key_map has changed since the last build.
+
+Full rebuilds requested from web requests can be run in the background (see
+settings.MATERIALIZED_VIEW_BACKGROUND_REFRESH). The new view is built under a
+shadow name and renamed over the live one, so readers keep querying the old,
+stale-but-consistent copy until the swap.
 """
 
+import hashlib
+import json
+
+from celery import task
+from django.conf import settings
 from django.db import connection
+from django.db import DatabaseError
 from django.db import transaction
+from django.db.models import F
 
 from main.consistency import ensure_all_ref_genome_variant_set_consistency
 from melted_variant_schema import *
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__STRING
+
+
+# Columns of the melted view that get a B-tree index, covering the columns
+# that queries sort by, join on, or restrict by AlignmentGroup.
+MATERIALIZED_TABLE_BTREE_INDEXED_COLS = [
+    'id',
+    MELTED_SCHEMA_KEY__UID,
+    MELTED_SCHEMA_KEY__POSITION,
+    MELTED_SCHEMA_KEY__ALIGNMENT_GROUP_ID,
+    MELTED_SCHEMA_KEY__ES_UID,
+]
+
+# Array-valued columns of the melted view, indexed with GIN so that
+# containment (@>) queries can use them. The index is on the expression from
+# get_variant_set_sql_expression(), which the filter uses.
+MATERIALIZED_TABLE_GIN_INDEXED_COLS = [
+    MELTED_SCHEMA_KEY__VS_UID,
+    MELTED_SCHEMA_KEY__VS_LABEL,
+]
+
+# First key of the Postgresql advisory lock held while a view is rebuilt in
+# the background. The second key is the ReferenceGenome id.
+MATERIALIZED_VIEW_ADVISORY_LOCK_NAMESPACE = 7301
 
 
 class AbstractMaterializedViewManager(object):
@@ -28,6 +72,12 @@ class AbstractMaterializedViewManager(object):
         """
         raise NotImplementedError("Child classes must implement.")
 
+    def get_shadow_table_name(self):
+        """Name of the table that a replacement view is built under before
+        being swapped in.
+        """
+        return self.get_table_name() + '_shadow'
+
     def create(self):
         """Creates the materialized view in the Postgresql DB.
         """
@@ -35,15 +85,62 @@ class AbstractMaterializedViewManager(object):
         self.drop()
 
         # Delegate to child class.
+        invalidation_count = self.get_invalidation_count()
         self.create_internal()
+        self.mark_valid(invalidation_count)
+
+    def create_shadow_and_swap(self):
+        """Creates the materialized view under the shadow name and then
+        replaces the existing view with it in a single transaction.
 
-    def create_internal(self):
+        Readers keep querying the existing view while the new one is built,
+        so this can run in the background.
+
+        Returns:
+            True if the view was marked valid, or False if it was invalidated
+            again while being built.
+        """
+        invalidation_count = self.get_invalidation_count()
+        shadow_table_name = self.get_shadow_table_name()
+        self.drop(shadow_table_name)
+        self.create_internal(table_name=shadow_table_name)
+
+        with transaction.commit_on_success():
+            # Pass the name explicitly so that child classes only drop the
+            # view itself.
+            self.drop(self.view_table_name)
+            self.rename(shadow_table_name, self.view_table_name)
+        return self.mark_valid(invalidation_count)
+
+    def create_internal(self, table_name=None):
         """Creates the materialized view in the Postgresql DB.
 
         Child classes should implement.
+
+        Args:
+            table_name: Name to create the view under. Defaults to
+                view_table_name.
         """
         raise NotImplementedError("Child classes must implement.")
 
+    def get_invalidation_count(self):
+        """Returns a count of the times the view was marked out of date,
+        read before the view is (re)created and passed to mark_valid().
+
+        Child classes may implement.
+        """
+        return None
+
+    def mark_valid(self, invalidation_count=None):
+        """Called after the view has been (re)created.
+
+        Child classes may implement.
+
+        Returns:
+            True if the view was marked valid.
+        """
+        return True
+
     def refresh(self):
         """Refreshes the view.
         """
@@ -53,16 +150,42 @@ class AbstractMaterializedViewManager(object):
                 self.view_table_name)
         self.cursor.execute(refresh_statement)
 
-    def drop(self):
+    def drop(self, table_name=None):
         """Drops the materialized view in the Postgresql DB.
+
+        Handles the view being backed by either a materialized view or a
+        regular table (incremental mode).
+
+        Args:
+            table_name: Name of the view to drop. Defaults to view_table_name.
         """
         assert self.view_table_name
         assert self.cursor
-        drop_sql_statement = "DROP MATERIALIZED VIEW IF EXISTS %s" % (
-                self.view_table_name,)
+        if table_name is None:
+            table_name = self.view_table_name
+        relkind = self.get_relkind(table_name)
+        if relkind == 'm':
+            drop_sql_statement = "DROP MATERIALIZED VIEW IF EXISTS %s" % (
+                    table_name,)
+        elif relkind == 'r':
+            drop_sql_statement = "DROP TABLE IF EXISTS %s" % (table_name,)
+        else:
+            return
         self.cursor.execute(drop_sql_statement)
         transaction.commit_unless_managed()
 
+    def rename(self, from_table_name, to_table_name):
+        """Renames a materialized view or table.
+        """
+        assert self.cursor
+        if self.get_relkind(from_table_name) == 'm':
+            rename_sql_statement = 'ALTER MATERIALIZED VIEW %s RENAME TO %s'
+        else:
+            rename_sql_statement = 'ALTER TABLE %s RENAME TO %s'
+        self.cursor.execute(rename_sql_statement % (
+                from_table_name, to_table_name))
+        transaction.commit_unless_managed()
+
     def create_if_not_exists_or_invalid(self):
         """Creates the table if it doesn't exist or is not valid.
 
@@ -83,20 +206,36 @@ class AbstractMaterializedViewManager(object):
 
     def check_table_exists(self):
         """Check if the table exists.
+        """
+        return self.get_relkind() in ('m', 'r')
+
+    def get_relkind(self, table_name=None):
+        """Returns the Postgresql relkind of the view table, 'm' for a
+        materialized view, 'r' for a regular table, or None if it doesn't
+        exist.
 
         NOTE: Figured out the raw sql query by running psql with -E flag
         and then calling \d. The -E flag causes the raw sql of the commands
         to be shown.
+
+        Args:
+            table_name: Name of the relation to check. Defaults to
+                view_table_name.
         """
         assert self.view_table_name
         assert self.cursor
+        if table_name is None:
+            table_name = self.view_table_name
         raw_sql = (
-            'SELECT c.relname '
+            'SELECT c.relkind '
             'FROM pg_catalog.pg_class c '
-            'WHERE c.relkind=%s AND c.relname=%s '
+            'WHERE c.relname=%s '
         )
-        self.cursor.execute(raw_sql, ('m', self.view_table_name))
-        return bool(self.cursor.fetchone())
+        self.cursor.execute(raw_sql, (table_name,))
+        result = self.cursor.fetchone()
+        if result is None:
+            return None
+        return result[0]
 
 
 class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
@@ -107,6 +246,7 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
     def __init__(self, reference_genome):
         self.reference_genome = reference_genome
         self.view_table_name = self.get_table_name()
+        self.dirty_table_name = self.get_dirty_table_name()
         self.cursor = connection.cursor()
 
     def get_table_name(self):
@@ -114,20 +254,340 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
         """
         return 'materialized_melted_variant_' + self.reference_genome.uid
 
+    def get_dirty_table_name(self):
+        """Name of the table holding ids of Variants whose rows in the view
+        are stale.
+        """
+        return self.get_table_name() + '_dirty'
+
     def is_valid(self):
         """Override.
         """
         return self.reference_genome.is_materialized_variant_view_valid
 
-    def create_internal(self):
+    def is_incremental(self):
+        return settings.MATERIALIZED_VIEW_INCREMENTAL
+
+    def create_if_not_exists_or_invalid(self, background=False):
         """Override.
+
+        In incremental mode, only re-computes the rows of dirty Variants when
+        a full rebuild is not required.
+
+        Args:
+            background: If True and settings.MATERIALIZED_VIEW_BACKGROUND_REFRESH
+                is set, a required full rebuild of an existing view is handed
+                off to a celery task, and callers keep querying the existing,
+                stale view in the meantime.
+
+        Returns:
+            True if the view is stale and is being rebuilt in the background.
         """
-        ensure_all_ref_genome_variant_set_consistency(self.reference_genome)
+        if not self.check_table_exists():
+            self.create()
+        elif not self.is_valid() or not self._is_incremental_update_possible():
+            if background and settings.MATERIALIZED_VIEW_BACKGROUND_REFRESH:
+                self.schedule_background_rebuild()
+                return True
+            self.create()
+        elif self.is_incremental():
+            self.update_dirty_variants()
+        return False
+
+    def schedule_background_rebuild(self):
+        """Starts a celery task that rebuilds the view, unless one is already
+        running.
+        """
+        if self.is_background_rebuild_running():
+            return
+        rebuild_materialized_view_in_background.delay(self.reference_genome)
+
+    def _get_advisory_lock_key(self):
+        return (MATERIALIZED_VIEW_ADVISORY_LOCK_NAMESPACE,
+                self.reference_genome.id)
+
+    def is_background_rebuild_running(self):
+        """Checks whether any connection holds the rebuild lock for this view.
+
+        Two-key advisory locks show up in pg_locks with the keys in classid
+        and objid, and objsubid = 2.
+        """
+        self.cursor.execute(
+                'SELECT 1 FROM pg_locks '
+                'WHERE locktype = %s AND classid = %s AND objid = %s '
+                'AND objsubid = 2',
+                ('advisory',) + self._get_advisory_lock_key())
+        return bool(self.cursor.fetchone())
+
+    def rebuild_in_background(self):
+        """Rebuilds the view under the shadow name and swaps it in, holding a
+        session advisory lock so that concurrent rebuilds are skipped.
+
+        The lock is released automatically if the worker dies. If the view is
+        invalidated again while it is being built, another rebuild is
+        scheduled.
+        """
+        self.cursor.execute('SELECT pg_try_advisory_lock(%s, %s)',
+                self._get_advisory_lock_key())
+        if not self.cursor.fetchone()[0]:
+            return
+        is_marked_valid = True
+        try:
+            # Another task may have finished the rebuild while this one was
+            # queued.
+            self.reference_genome = self.reference_genome.__class__.objects.get(
+                    id=self.reference_genome.id)
+            if (self.check_table_exists() and self.is_valid() and
+                    self._is_incremental_update_possible()):
+                return
+            is_marked_valid = self.create_shadow_and_swap()
+        finally:
+            self.cursor.execute('SELECT pg_advisory_unlock(%s, %s)',
+                    self._get_advisory_lock_key())
+
+        if not is_marked_valid:
+            self.schedule_background_rebuild()
+
+    def _is_incremental_update_possible(self):
+        """Checks whether the existing table can be patched in place rather
+        than rebuilt.
+        """
+        if not self.is_incremental():
+            # Nothing to check, the view is valid.
+            return True
+        if self.get_relkind() != 'r':
+            # Left over materialized view from non-incremental mode.
+            return False
+        return self._get_stored_key_map_fingerprint() == (
+                self._compute_key_map_fingerprint())
+
+    def _compute_key_map_fingerprint(self):
+        return hashlib.md5(json.dumps(self.reference_genome.variant_key_map,
+                sort_keys=True)).hexdigest()
+
+    def _get_stored_key_map_fingerprint(self):
+        """The key map fingerprint is stored as the comment on the table so
+        that it lives and dies with the table.
+        """
+        self.cursor.execute('SELECT obj_description(%s::regclass, %s)',
+                (self.view_table_name, 'pg_class'))
+        return self.cursor.fetchone()[0]
+
+    def drop(self, table_name=None):
+        """Override.
+
+        Also drops the dirty Variant table, unless a specific table_name is
+        given, as when swapping in a rebuilt view. Variants marked dirty while
+        the replacement was being built must be kept.
+        """
+        super(MeltedVariantMaterializedViewManager, self).drop(table_name)
+        if table_name is None:
+            self.cursor.execute(
+                    'DROP TABLE IF EXISTS %s' % self.dirty_table_name)
+            transaction.commit_unless_managed()
+
+    def create_internal(self, table_name=None):
+        """Override.
+        """
+        if table_name is None:
+            table_name = self.view_table_name
+
+        # Clear dirty Variants first. Anything marked dirty after this point
+        # is re-computed again on the next update, which is harmless.
+        dirty_variant_ids = None
+        if self.is_incremental():
+            self._ensure_dirty_table_exists()
+            self.cursor.execute('DELETE FROM %s RETURNING variant_id' % (
+                    self.dirty_table_name,))
+            dirty_variant_ids = list(set(
+                    [row[0] for row in self.cursor.fetchall()]))
+
+        ensure_all_ref_genome_variant_set_consistency(self.reference_genome,
+                variant_ids=dirty_variant_ids)
+
+        if self.is_incremental():
+            create_sql_statement = 'CREATE TABLE %s AS (%s)' % (
+                    table_name, self._melted_select_sql())
+        else:
+            create_sql_statement = 'CREATE MATERIALIZED VIEW %s AS (%s)' % (
+                    table_name, self._melted_select_sql())
+        self.cursor.execute(create_sql_statement)
+
+        if self.is_incremental():
+            self.cursor.execute('COMMENT ON TABLE %s IS %%s' % (
+                    table_name,),
+                    (self._compute_key_map_fingerprint(),))
+
+        self._create_indexes(table_name)
+
+        # Refresh planner statistics so that the first queries against the
+        # new view (and the planner-based count estimates) are sensible.
+        self.cursor.execute('ANALYZE %s' % table_name)
+
+        transaction.commit_unless_managed()
+
+    def _create_indexes(self, table_name):
+        """Creates indexes on the commonly queried columns, and expression
+        indexes on the json keys listed in
+        settings.MATERIALIZED_VIEW_INDEXED_JSON_KEYS that exist in this
+        ReferenceGenome's variant_key_map.
+
+        Index names are left to Postgres so that the indexes of a shadow
+        table don't clash with the ones of the live table.
+        """
+        for col in MATERIALIZED_TABLE_BTREE_INDEXED_COLS:
+            self.cursor.execute('CREATE INDEX ON %s (%s)' % (table_name, col))
+
+        for col in MATERIALIZED_TABLE_GIN_INDEXED_COLS:
+            self.cursor.execute('CREATE INDEX ON %s USING GIN ((%s))' % (
+                    table_name, get_variant_set_sql_expression(col)))
+
+        for json_col, key_list in (
+                settings.MATERIALIZED_VIEW_INDEXED_JSON_KEYS.iteritems()):
+            submap = self.reference_genome.variant_key_map.get(
+                    MATERIALIZED_TABLE_JSON_COL_TO_KEY_MAP_SUBMAP[json_col],
+                    {})
+            for key in key_list:
+                if not key in submap:
+                    continue
+
+                # Per-alternate and multi-valued keys are stored as arrays
+                # and can't be cast.
+                field_type = submap[key]['type']
+                if (field_type != VARIANT_KEY_MAP_TYPE__STRING and
+                        submap[key].get('num') != 1):
+                    continue
+
+                expression = get_json_key_sql_expression(
+                        json_col, key, field_type)
+                if expression is None:
+                    continue
+
+                # A value that fails to cast would abort the whole build, so
+                # give up on just this index instead.
+                self.cursor.execute('SAVEPOINT create_json_key_index')
+                try:
+                    self.cursor.execute('CREATE INDEX ON %s ((%s))' % (
+                            table_name, expression))
+                except DatabaseError:
+                    self.cursor.execute(
+                            'ROLLBACK TO SAVEPOINT create_json_key_index')
+                self.cursor.execute('RELEASE SAVEPOINT create_json_key_index')
+
+    def get_invalidation_count(self):
+        """Override.
+        """
+        ref_genome_model = self.reference_genome.__class__
+        return ref_genome_model.objects.filter(
+                id=self.reference_genome.id).values_list(
+                        'materialized_variant_view_invalidation_count',
+                        flat=True)[0]
+
+    def mark_valid(self, invalidation_count=None):
+        """Override.
+
+        If invalidation_count is given, the valid bit is only set if the view
+        hasn't been invalidated since, e.g. while it was being rebuilt in the
+        background.
+        """
+        # Set the valid bit.
+        ref_genome_model = self.reference_genome.__class__
+        ref_genome_query = ref_genome_model.objects.filter(
+                id=self.reference_genome.id)
+        if invalidation_count is not None:
+            ref_genome_query = ref_genome_query.filter(
+                    materialized_variant_view_invalidation_count=(
+                            invalidation_count))
+        is_marked_valid = bool(ref_genome_query.update(
+                is_materialized_variant_view_valid=True))
+        self.reference_genome.is_materialized_variant_view_valid = (
+                is_marked_valid)
+        self.bump_generation()
+        return is_marked_valid
+
+    def bump_generation(self):
+        """Increments the generation of the view, invalidating any cached
+        results derived from it.
+        """
+        ref_genome_model = self.reference_genome.__class__
+        ref_genome_model.objects.filter(id=self.reference_genome.id).update(
+                materialized_variant_view_generation=F(
+                        'materialized_variant_view_generation') + 1)
+        self.reference_genome.materialized_variant_view_generation = (
+                self.get_generation())
+
+    def get_generation(self):
+        """Returns the current generation of the view as stored in the
+        database.
+        """
+        ref_genome_model = self.reference_genome.__class__
+        return ref_genome_model.objects.filter(
+                id=self.reference_genome.id).values_list(
+                        'materialized_variant_view_generation', flat=True)[0]
+
+    def mark_variants_dirty(self, variant_ids):
+        """Records Variants whose rows in the view need to be re-computed.
+
+        Args:
+            variant_ids: Iterable of Variant ids.
+        """
+        variant_ids = list(set(variant_ids))
+        if not variant_ids:
+            return
+        self._ensure_dirty_table_exists()
+        self.cursor.execute(
+                'INSERT INTO %s (variant_id) SELECT unnest(%%s)' % (
+                        self.dirty_table_name,),
+                (variant_ids,))
+        transaction.commit_unless_managed()
+
+    def update_dirty_variants(self):
+        """Re-computes the rows for all Variants marked dirty since the last
+        update, deleting and re-inserting them in a single transaction.
+        """
+        self._ensure_dirty_table_exists()
+        with transaction.commit_on_success():
+            self.cursor.execute('DELETE FROM %s RETURNING variant_id' % (
+                    self.dirty_table_name,))
+            dirty_variant_ids = list(set(
+                    [row[0] for row in self.cursor.fetchall()]))
+            if not dirty_variant_ids:
+                return
+
+            ensure_all_ref_genome_variant_set_consistency(
+                    self.reference_genome, variant_ids=dirty_variant_ids)
+
+            self.cursor.execute(
+                    'DELETE FROM %s WHERE id = ANY(%%s)' % (
+                            self.view_table_name,),
+                    (dirty_variant_ids,))
+            self.cursor.execute(
+                    'INSERT INTO %s %s' % (self.view_table_name,
+                            self._melted_select_sql(restrict_to_variants=True)),
+                    (dirty_variant_ids, dirty_variant_ids))
+            self.bump_generation()
+
+    def _ensure_dirty_table_exists(self):
+        self.cursor.execute(
+                'CREATE TABLE IF NOT EXISTS %s (variant_id integer NOT NULL)' % (
+                        self.dirty_table_name,))
+
+    def _melted_select_sql(self, restrict_to_variants=False):
+        """Returns the SELECT statement that generates the melted rows.
+
+        Args:
+            restrict_to_variants: If True, the statement takes two parameters,
+                each a list of Variant ids, and only rows for those Variants
+                are generated.
+        """
+        if restrict_to_variants:
+            variant_restriction = 'AND main_variant.id = ANY(%s) '
+        else:
+            variant_restriction = ''
 
         # Query all columns except the catch-all key value fields first,
         # then join with the key-value columns.
-        create_sql_statement = (
-            'CREATE MATERIALIZED VIEW %s AS ('
+        return (
                 'WITH melted_variant_data AS ('
                     '('
                         'SELECT %s FROM main_variant '
@@ -160,6 +620,7 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
                                     'main_variantevidence.id = main_variantevidence_variantalternate_set.variantevidence_id) '
                             'LEFT JOIN main_variantalternate ON main_variantevidence_variantalternate_set.variantalternate_id = main_variantalternate.id '
                         'WHERE (main_variant.reference_genome_id = %d) '
+                            '%s'
                         'GROUP BY %s'
                     ') '
                     'UNION '
@@ -170,6 +631,7 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
                             'INNER JOIN main_variantset ON main_varianttovariantset.variant_set_id = main_variantset.id '
                             'INNER JOIN main_chromosome ON (main_variant.chromosome_id = main_chromosome.id) '
                         'WHERE (main_variant.reference_genome_id = %d) '
+                            '%s'
                         'GROUP BY %s'
                     ') '
                     'ORDER BY POSITION, EXPERIMENT_SAMPLE_UID DESC '
@@ -192,22 +654,23 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
                         'LEFT JOIN es_data_table ON es_data_table.id = melted_variant_data.es_id '
                         'LEFT JOIN ve_data_table ON ve_data_table.id = melted_variant_data.ve_id '
                         'LEFT JOIN vccd_data_table ON vccd_data_table.id = melted_variant_data.vccd_id'
-            ')'
             % (
-                    self.view_table_name,
-
                     MATERIALIZED_TABLE_SELECT_CLAUSE,
                     self.reference_genome.id,
+                    variant_restriction,
                     MATERIALIZED_TABLE_GROUP_BY_CLAUSE,
 
                     MATERIALIZED_TABLE_VTVS_SELECT_CLAUSE,
                     self.reference_genome.id,
+                    variant_restriction,
                     MATERIALIZED_TABLE_VTVS_GROUP_BY_CLAUSE)
             )
 
-        self.cursor.execute(create_sql_statement)
-        transaction.commit_unless_managed()
 
-        # Set the valid bit.
-        self.reference_genome.is_materialized_variant_view_valid = True
-        self.reference_genome.save()
+@task
+def rebuild_materialized_view_in_background(reference_genome):
+    """Celery task that rebuilds the melted variant view for the
+    ReferenceGenome without blocking readers of the existing view.
+    """
+    MeltedVariantMaterializedViewManager(
+            reference_genome).rebuild_in_background()
@@ -5,6 +5,15 @@ materialized view of the melted variant data.
 Build the schema used to build the materialized view.
 """
 
+from variants.filter_key_map_constants import MAP_KEY__ALTERNATE
+from variants.filter_key_map_constants import MAP_KEY__COMMON_DATA
+from variants.filter_key_map_constants import MAP_KEY__EVIDENCE
+from variants.filter_key_map_constants import MAP_KEY__EXPERIMENT_SAMPLE
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__BOOLEAN
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__FLOAT
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__INTEGER
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__STRING
+
 
 class SchemaBuilder(object):
     """Builder object for the schema.
@@ -208,3 +217,50 @@ MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP = dict([
 for key, query_schema in MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP.iteritems():
     assert query_schema is not None, (
             "Missing query schema for queryable %s" % key)
+
+# Map from catch-all json column in the materialized table to the
+# ReferenceGenome.variant_key_map submap describing its keys.
+MATERIALIZED_TABLE_JSON_COL_TO_KEY_MAP_SUBMAP = {
+    'vccd_data': MAP_KEY__COMMON_DATA,
+    'va_data': MAP_KEY__ALTERNATE,
+    'es_data': MAP_KEY__EXPERIMENT_SAMPLE,
+    've_data': MAP_KEY__EVIDENCE,
+}
+
+# Postgres casts for values of json keys, by variant_key_map type.
+# String doesn't need to be cast.
+VARIANT_KEY_MAP_TYPE_TO_SQL_CAST = {
+    VARIANT_KEY_MAP_TYPE__INTEGER: '::Integer',
+    VARIANT_KEY_MAP_TYPE__FLOAT: '::Float',
+    VARIANT_KEY_MAP_TYPE__BOOLEAN: '::Boolean',
+    VARIANT_KEY_MAP_TYPE__STRING: '',
+}
+
+
+def get_json_key_sql_expression(json_col, key, field_type):
+    """Returns the SQL expression that extracts the key from the json column,
+    cast to the key's type, e.g. "(ve_data->>'GT_TYPE')::Integer".
+
+    Queries and expression indexes must use the same expression for the index
+    to be used.
+
+    Returns:
+        The expression string, or None if the type is not supported.
+    """
+    sql_cast = VARIANT_KEY_MAP_TYPE_TO_SQL_CAST.get(field_type, None)
+    if sql_cast is None:
+        return None
+    return "(%s->>'%s')%s" % (json_col, key, sql_cast)
+
+
+def get_variant_set_sql_expression(col):
+    """Returns the SQL expression for a variant set array column with the
+    array of NULLs, which a Variant in no set gets from the LEFT JOIN, turned
+    into NULL, e.g. "NULLIF(array_remove(VARIANT_SET_LABEL, NULL), '{}')".
+
+    Filtering with containment on this expression gives the same results as
+    the former "%s = ANY (col)" condition, so that a Variant in no set still
+    doesn't match "NOT VARIANT_SET_LABEL = x". The GIN index is built on the
+    same expression so that the filter can use it.
+    """
+    return "NULLIF(array_remove(%s, NULL), '{}')" % col
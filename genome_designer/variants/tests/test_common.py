@@ -99,6 +99,15 @@ class TestCommon(TestCase):
 
         self.assertEqual(ve_sample_3.data['GT_TYPE'],2)
         self.assertEqual(ve_sample_2.data['IN_CHILDREN'],1)
+        self.assertEqual(ve_sample_3.data['IN_PARENTS'],
+                int(ve_sample_2.data['GT_TYPE'] > 0))
+        self.assertEqual(ve_sample_3.data['IN_CHILDREN'],0)
+
+        # Running again doesn't change anything.
+        update_parent_child_variant_fields(
+                self.common_entities['alignment_group'])
+        self.assertEqual(ve_sample_2.data, ve_for_uid(u'9b19e708').data)
+        self.assertEqual(ve_sample_3.data, ve_for_uid(u'9dd7a7a1').data)
 
 
 class TestSymbolGenerator(TestCase):
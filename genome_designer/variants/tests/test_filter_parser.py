@@ -0,0 +1,95 @@
+"""
+Tests for filter_parser.py.
+"""
+
+from django.test import TestCase
+
+from variants.common import ParseError
+from variants.filter_parser import FilterAnd
+from variants.filter_parser import FilterCondition
+from variants.filter_parser import FilterNot
+from variants.filter_parser import FilterOr
+from variants.filter_parser import parse_filter_string
+
+
+def _compile_condition(condition_string):
+    """Compiles conditions to placeholders so the structure is easy to check.
+    """
+    return ('%s', [condition_string.strip()])
+
+
+class TestParseFilterString(TestCase):
+
+    def test_empty(self):
+        self.assertEqual(None, parse_filter_string(''))
+        self.assertEqual(None, parse_filter_string('   '))
+
+    def test_single_condition(self):
+        self.assertEqual(FilterCondition('position > 5'),
+                parse_filter_string('position > 5'))
+
+    def test_operators(self):
+        self.assertEqual(
+                FilterAnd([
+                        FilterCondition('position > 5 '),
+                        FilterCondition('chromosome = chrom1')]),
+                parse_filter_string('position > 5 & chromosome = chrom1'))
+
+        self.assertEqual(
+                FilterOr([
+                        FilterCondition('position > 5 '),
+                        FilterCondition('position < 2')]),
+                parse_filter_string('position > 5 | position < 2'))
+
+        self.assertEqual(
+                FilterNot(FilterCondition('position > 5')),
+                parse_filter_string('~(position > 5)'))
+
+    def test_precedence(self):
+        """AND binds tighter than OR, unless overridden by parentheses.
+        """
+        self.assertEqual(
+                FilterOr([
+                        FilterCondition('A1 = 1 '),
+                        FilterAnd([
+                                FilterCondition('A2 = 2 '),
+                                FilterCondition('A3 = 3')])]),
+                parse_filter_string('A1 = 1 | A2 = 2 & A3 = 3'))
+
+        self.assertEqual(
+                FilterAnd([
+                        FilterOr([
+                                FilterCondition('A1 = 1 '),
+                                FilterCondition('A2 = 2')]),
+                        FilterCondition('A3 = 3')]),
+                parse_filter_string('(A1 = 1 | A2 = 2) & A3 = 3'))
+
+    def test_compile_without_dnf_expansion(self):
+        """Nested ORs inside ANDs compile to a WHERE clause of the same size
+        as the filter.
+        """
+        filter_string = ' & '.join(['(A%d = 1 | B%d = 2)' % (i, i)
+                for i in range(20)])
+        filter_tree = parse_filter_string(filter_string)
+        (where_clause, args) = filter_tree.compile(_compile_condition)
+        self.assertEqual(40, len(args))
+        self.assertEqual(40, where_clause.count('%s'))
+        self.assertEqual(['A0 = 1', 'B0 = 2', 'A1 = 1'], args[:3])
+        self.assertEqual(40, len(filter_tree.get_conditions()))
+
+    def test_compile(self):
+        filter_tree = parse_filter_string('A1 = 1 & ~(A2 = 2 | A3 = 3)')
+        (where_clause, args) = filter_tree.compile(_compile_condition)
+        self.assertEqual('(%s) AND (NOT ((%s) OR (%s)))', where_clause)
+        self.assertEqual(['A1 = 1', 'A2 = 2', 'A3 = 3'], args)
+
+    def test_malformed(self):
+        for filter_string in [
+                'position > 5 &',
+                '& position > 5',
+                '(position > 5',
+                'position > 5)',
+                'position > 5 position < 2',
+                '# position > 5']:
+            with self.assertRaises(ParseError):
+                parse_filter_string(filter_string)
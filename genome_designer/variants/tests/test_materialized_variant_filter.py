@@ -7,7 +7,6 @@ import os
 from django.db import connection
 from django.contrib.auth.models import User
 from django.test import TestCase
-from sympy.core.function import sympify
 
 from main.models import AlignmentGroup
 from main.models import Chromosome
@@ -27,7 +26,11 @@ from variants.dynamic_snp_filter_key_map import update_filter_key_map
 from settings import PWD as GD_ROOT
 from variants.common import determine_visible_field_names
 from variants.common import ParseError
+from variants.filter_parser import FilterAnd
+from variants.filter_parser import FilterCondition
+from variants.materialized_variant_filter import FILTER_RESULT_CACHE
 from variants.materialized_variant_filter import get_variants_that_pass_filter
+from variants.materialized_variant_filter import lookup_variants
 from variants.materialized_variant_filter import VariantFilterEvaluator
 from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__CHROMOSOME
@@ -407,6 +410,62 @@ class TestVariantFilter(BaseTestVariantFilterTestCase):
         ]
 
 
+    def test_filter__variant_set(self):
+        """Tests filtering on variant set membership, including Variants that
+        are in no set.
+        """
+        # A Variant that is only associated with a sample, and in no set.
+        variant_no_set = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=self.ref_genome,
+                chromosome=self.chromosome1,
+                position=2,
+                ref_value='A')
+        variant_no_set.variantalternate_set.add(
+                VariantAlternate.objects.create(
+                        variant=variant_no_set,
+                        alt_value='G'))
+        alignment_group = AlignmentGroup.objects.create(
+                label='Alignment 1',
+                reference_genome=self.ref_genome,
+                aligner=AlignmentGroup.ALIGNER.BWA)
+        common_data_obj = VariantCallerCommonData.objects.create(
+                variant=variant_no_set,
+                source_dataset=self.vcf_dataset,
+                alignment_group=alignment_group)
+        VariantEvidence.objects.create(
+                experiment_sample=self.sample_obj_1,
+                variant_caller_common_data=common_data_obj,
+                data={'called': True, 'gt_type': 2, 'gt_bases': 'G/G',
+                        'gt_nums': '1/1'})
+
+        # A Variant in the catchall set.
+        variant_in_set = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=self.ref_genome,
+                chromosome=self.chromosome1,
+                position=5,
+                ref_value='A')
+        variant_in_set.variantalternate_set.add(
+                VariantAlternate.objects.create(
+                        variant=variant_in_set,
+                        alt_value='T'))
+        VariantToVariantSet.objects.create(variant=variant_in_set,
+                variant_set=self.catchall_variant_set)
+
+        variants = run_query('VARIANT_SET_LABEL = catchall', self.ref_genome)
+        self.assertEqual([5],
+                [var[MELTED_SCHEMA_KEY__POSITION] for var in variants])
+
+        # A Variant in no set matches neither the condition nor its negation.
+        self.assertEqual(0, len(run_query(
+                'NOT VARIANT_SET_LABEL = catchall', self.ref_genome)))
+        self.assertEqual(0, len(run_query(
+                'VARIANT_SET_LABEL = other', self.ref_genome)))
+        variants = run_query('NOT VARIANT_SET_LABEL = other', self.ref_genome)
+        self.assertEqual([5],
+                [var[MELTED_SCHEMA_KEY__POSITION] for var in variants])
+
     def test_filter__key_missing_from_map(self):
         """Tests that filtering using an unrecognized key fails when using an
         improperly initialized key map.
@@ -599,44 +658,139 @@ class TestVariantFilterEvaluator(BaseTestVariantFilterTestCase):
         """
         query_args = {'filter_string': 'position > 5'}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual('position > 5',
-                evaluator.symbol_to_expression_map['A'])
+        self.assertEqual(FilterCondition('position > 5'),
+                evaluator.filter_tree)
 
         # Test &.
         query_args = {'filter_string': 'position>5 & GT= 2'}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A & B')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual('position>5 ',
-                evaluator.symbol_to_expression_map['A'])
-        self.assertEqual('GT= 2',
-                evaluator.symbol_to_expression_map['B'])
+        self.assertEqual(
+                FilterAnd([
+                        FilterCondition('position>5 '),
+                        FilterCondition('GT= 2')]),
+                evaluator.filter_tree)
 
         # Test decimals.
         query_args = {'filter_string': 'AF > 0.5'}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual('AF > 0.5',
-                evaluator.symbol_to_expression_map['A'])
+        self.assertEqual(FilterCondition('AF > 0.5'), evaluator.filter_tree)
 
         # Test hyphens
         QUERY = 'EXPERIMENT_SAMPLE_LABEL = C-E5-2'
         query_args = {'filter_string': QUERY}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual(QUERY, evaluator.symbol_to_expression_map['A'])
+        self.assertEqual(FilterCondition(QUERY), evaluator.filter_tree)
 
         # Test quotes
         QUERY = 'EXPERIMENT_SAMPLE_LABEL = "C-E5-2"'
         query_args = {'filter_string': QUERY}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual(QUERY, evaluator.symbol_to_expression_map['A'])
+        self.assertEqual(FilterCondition(QUERY), evaluator.filter_tree)
+
+        # No filter.
+        query_args = {'filter_string': ''}
+        evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
+        self.assertEqual(None, evaluator.filter_tree)
+
+    def test_pagination(self):
+        """Tests paging through results, which uses keyset pagination after
+        the first page, and the separate count query.
+        """
+        for pos in range(10):
+            var = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=self.ref_genome,
+                chromosome=self.chromosome1,
+                position=pos,
+                ref_value='A')
+
+            var.variantalternate_set.add(
+                    VariantAlternate.objects.create(
+                            variant=var,
+                            alt_value='G'))
+
+            VariantToVariantSet.objects.create(variant=var,
+                    variant_set=self.catchall_variant_set)
+
+        for is_melted in [True, False]:
+            for sort_by_direction in ['asc', 'desc']:
+                positions = []
+                for pagination_start in range(0, 10, 3):
+                    query_args = {
+                        'filter_string': '',
+                        'is_melted': is_melted,
+                        'sort_by_column': MELTED_SCHEMA_KEY__POSITION,
+                        'sort_by_direction': sort_by_direction,
+                        'pagination_start': pagination_start,
+                        'pagination_len': 3,
+                    }
+                    result = lookup_variants(query_args, self.ref_genome)
+                    self.assertEqual(10, result.num_total_variants)
+                    for row in result.result_list:
+                        self.assertFalse('SEEK_KEY_0' in row)
+                    positions.extend([row[MELTED_SCHEMA_KEY__POSITION]
+                            for row in result.result_list])
+
+                expected_positions = range(10)
+                if sort_by_direction == 'desc':
+                    expected_positions.reverse()
+                self.assertEqual(expected_positions, positions)
+
+        # Filtered count.
+        query_args = {
+            'filter_string': 'position > 5',
+            'pagination_start': 3,
+            'pagination_len': 3,
+        }
+        result = lookup_variants(query_args, self.ref_genome)
+        self.assertEqual(4, result.num_total_variants)
+        self.assertEqual(1, len(result.result_list))
+
+    def test_filter_result_cache(self):
+        """Tests that the ids of the Variants matching a filter are cached,
+        and that the cache is invalidated when the view changes.
+        """
+        def _create_variant(pos):
+            var = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=self.ref_genome,
+                chromosome=self.chromosome1,
+                position=pos,
+                ref_value='A')
+
+            var.variantalternate_set.add(
+                    VariantAlternate.objects.create(
+                            variant=var,
+                            alt_value='G'))
+
+            VariantToVariantSet.objects.create(variant=var,
+                    variant_set=self.catchall_variant_set)
+            return var
+
+        variants = [_create_variant(pos) for pos in range(10)]
+
+        for is_melted in [True, False]:
+            query_args = {
+                'filter_string': 'position  > 5',
+                'is_melted': is_melted,
+            }
+            result = lookup_variants(query_args, self.ref_genome)
+            self.assertEqual(4, result.num_total_variants)
+            self.assertEqual(4, len(result.result_list))
+
+        generation = self.materialized_view_manager.get_generation()
+        cached_variant_ids = FILTER_RESULT_CACHE.get((self.ref_genome.id,
+                generation, 'position > 5', None))
+        self.assertEqual(sorted([var.id for var in variants[6:]]),
+                list(cached_variant_ids))
+
+        # Adding a Variant updates the view, so the cached ids are not used.
+        _create_variant(20)
+        result = lookup_variants({'filter_string': 'position > 5'},
+                self.ref_genome)
+        self.assertEqual(5, result.num_total_variants)
+        self.assertTrue(
+                self.materialized_view_manager.get_generation() > generation)
 
 
 class TestMinimal(BaseTestVariantFilterTestCase):
@@ -7,6 +7,7 @@ from django.test import TestCase
 
 from main.models import Chromosome
 from main.models import Dataset
+from main.models import ReferenceGenome
 from main.models import Variant
 from main.models import VariantAlternate
 from main.models import VariantCallerCommonData
@@ -146,3 +147,132 @@ class TestMaterializedViewManager(TestCase):
             if data_row[MELTED_SCHEMA_KEY__VS_UID][0] is not None:
                 observed_rows_with_variant_set_data += 1
         self.assertEqual(1, observed_rows_with_variant_set_data)
+
+
+    def test_incremental_update(self):
+        """Test that rows for dirty Variants are re-computed without a full
+        rebuild.
+        """
+        mvm = MeltedVariantMaterializedViewManager(
+                self.common_entities['reference_genome'])
+        mvm.create()
+        self.assertEqual('r', mvm.get_relkind())
+
+        variant = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=self.common_entities['reference_genome'],
+                chromosome=Chromosome.objects.get(reference_genome=self.common_entities['reference_genome']),
+                position=2,
+                ref_value='A'
+        )
+        VariantAlternate.objects.create(
+                variant=variant,
+                alt_value='T',
+        )
+        variant_set = VariantSet.objects.create(
+                label='vs1',
+                reference_genome=self.common_entities['reference_genome']
+        )
+
+        # Saving the VariantToVariantSet marks the Variant dirty.
+        VariantToVariantSet.objects.create(
+                variant=variant,
+                variant_set=variant_set
+        )
+        self.cursor.execute('SELECT variant_id FROM %s' %
+                mvm.get_dirty_table_name())
+        self.assertEqual([(variant.id,)], self.cursor.fetchall())
+
+        mvm.create_if_not_exists_or_invalid()
+        self.cursor.execute('SELECT * FROM %s' % mvm.get_table_name())
+        results = [dict(zip([col[0].upper() for col in self.cursor.description], row))
+                for row in self.cursor.fetchall()]
+        self.assertEqual(1, len(results))
+        self.assertEqual(['vs1'], results[0][MELTED_SCHEMA_KEY__VS_LABEL])
+
+        # Dirty Variants are cleared.
+        self.cursor.execute('SELECT variant_id FROM %s' %
+                mvm.get_dirty_table_name())
+        self.assertEqual(0, len(self.cursor.fetchall()))
+
+
+    def test_rebuild_in_background(self):
+        """Test that the view is rebuilt under the shadow name and swapped in.
+        """
+        ref_genome = self.common_entities['reference_genome']
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+        mvm.create()
+
+        variant = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=ref_genome,
+                chromosome=Chromosome.objects.get(reference_genome=ref_genome),
+                position=2,
+                ref_value='A'
+        )
+        VariantAlternate.objects.create(
+                variant=variant,
+                alt_value='T',
+        )
+        variant_set = VariantSet.objects.create(
+                label='vs1',
+                reference_genome=ref_genome
+        )
+        VariantToVariantSet.objects.create(
+                variant=variant,
+                variant_set=variant_set
+        )
+        ref_genome.invalidate_materialized_view()
+
+        # The existing view is still served while stale.
+        self.cursor.execute('SELECT * FROM %s' % mvm.get_table_name())
+        self.assertEqual(0, len(self.cursor.fetchall()))
+
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+        mvm.rebuild_in_background()
+        self.cursor.execute('SELECT * FROM %s' % mvm.get_table_name())
+        self.assertEqual(1, len(self.cursor.fetchall()))
+        self.assertIsNone(mvm.get_relkind(mvm.get_shadow_table_name()))
+        self.assertTrue(mvm.reference_genome.is_materialized_variant_view_valid)
+        self.assertFalse(mvm.is_background_rebuild_running())
+
+    def test_invalidated_while_rebuilding(self):
+        """Test that a view invalidated while it is being rebuilt is not
+        marked valid once the rebuild is done.
+        """
+        ref_genome = self.common_entities['reference_genome']
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+        mvm.create()
+        self.assertTrue(mvm.is_valid())
+
+        # The rebuild reads the invalidation count before building the view.
+        invalidation_count = mvm.get_invalidation_count()
+        ref_genome.invalidate_materialized_view()
+
+        self.assertFalse(mvm.mark_valid(invalidation_count))
+        self.assertFalse(ReferenceGenome.objects.get(
+                id=ref_genome.id).is_materialized_variant_view_valid)
+
+        self.assertTrue(mvm.mark_valid(mvm.get_invalidation_count()))
+        self.assertTrue(ReferenceGenome.objects.get(
+                id=ref_genome.id).is_materialized_variant_view_valid)
+
+
+    def test_create_indexes(self):
+        """Test that the view is created with column and json key indexes.
+        """
+        mvm = MeltedVariantMaterializedViewManager(
+                self.common_entities['reference_genome'])
+        mvm.create()
+        self.cursor.execute(
+                'SELECT indexdef FROM pg_indexes WHERE tablename = %s',
+                (mvm.get_table_name(),))
+        index_defs = [row[0] for row in self.cursor.fetchall()]
+        self.assertTrue(any(['(\"position\")' in index_def or '(position)' in index_def
+                for index_def in index_defs]))
+        self.assertTrue(any(['gin' in index_def.lower()
+                for index_def in index_defs]))
+
+        # GT_TYPE is a hard-coded key in every variant_key_map.
+        self.assertTrue(any(['GT_TYPE' in index_def
+                for index_def in index_defs]))
@@ -19,8 +19,10 @@ from main.testing_util import create_common_entities
 from main.testing_util import create_recoli_sv_data_from_vcf
 from main.testing_util import create_sample_and_alignment
 from main.testing_util import TEST_DATA_DIR
+from pipeline.variant_calling.common import flag_callable_loci_variants
 from utils.import_util import copy_and_add_dataset_source
 from utils.import_util import import_reference_genome_from_local_file
+from utils.jbrowse_util import add_vcf_track_given_dataset
 from variants.vcf_parser import parse_alignment_group_vcf
 from variants.vcf_parser import parse_vcf
 
@@ -40,6 +42,24 @@ LUMPY_4_SAMPLES_2_DELETIONS_VCF = os.path.join(
         VCF_PARSER_TEST_DATA_DIR, 'lumpy_4_samples_2_deletions.vcf')
 
 
+def _summarize(alignment_group):
+    """Returns the data parsed for each Variant called in the AlignmentGroup.
+    """
+    summary = {}
+    for vccd in VariantCallerCommonData.objects.filter(
+            alignment_group=alignment_group):
+        variant = vccd.variant
+        evidence = sorted([
+                (ve.experiment_sample.uid, ve.data,
+                        sorted([va.alt_value for va in
+                                ve.variantalternate_set.all()]))
+                for ve in vccd.variantevidence_set.all()])
+        summary[(variant.position, variant.ref_value)] = (
+                variant.type, sorted(variant.get_alternates()),
+                vccd.data, evidence)
+    return summary
+
+
 class TestVCFParser(TestCase):
 
     def setUp(self):
@@ -129,6 +149,101 @@ class TestVCFParser(TestCase):
         self.assertTrue(len(v_1330_gc.variantevidence_set.all()))
         self.assertEqual(v_1330_c.data['INFO_ABP'], v_1330_gc.data['INFO_ABP'])
 
+    def test_parser__bulk_matches_per_record(self):
+        """Tests that the bulk loader creates the same data as creating the
+        models one record at a time, including for existing Variants.
+        """
+        VCF_DATATYPE = Dataset.TYPE.VCF_FREEBAYES
+
+        Chromosome.objects.create(
+            reference_genome=self.reference_genome,
+            label='Chromosome',
+            num_bases=9001)
+
+        with open(TEST_GENOME_SNPS) as fh:
+            reader = vcf.Reader(fh)
+            experiment_sample_uids = reader.samples
+        for sample_uid in experiment_sample_uids:
+            ExperimentSample.objects.create(
+                uid=sample_uid,
+                project=self.project,
+                label='fakename:' + sample_uid
+            )
+
+        def _parse(label):
+            alignment_group = AlignmentGroup.objects.create(
+                    label=label, reference_genome=self.reference_genome)
+            copy_and_add_dataset_source(alignment_group, VCF_DATATYPE,
+                    VCF_DATATYPE, TEST_GENOME_SNPS)
+            parse_alignment_group_vcf(alignment_group, VCF_DATATYPE)
+            return alignment_group
+
+        with self.settings(VCF_BULK_INGESTION=False):
+            per_record_alignment_group = _parse('per record')
+        num_variants = Variant.objects.filter(
+                reference_genome=self.reference_genome).count()
+
+        # The Variants and VariantAlternates exist already, so this also
+        # checks that the loader reuses them.
+        bulk_alignment_group = _parse('bulk')
+        self.assertEqual(num_variants, Variant.objects.filter(
+                reference_genome=self.reference_genome).count())
+
+        self.assertEqual(_summarize(per_record_alignment_group),
+                _summarize(bulk_alignment_group))
+
+    def test_parser__sharded_matches_single_pass(self):
+        """Tests that parsing the regions of a tabix-indexed VCF in a chord of
+        separate tasks creates the same data as parsing it in a single pass.
+        """
+        VCF_DATATYPE = Dataset.TYPE.VCF_FREEBAYES
+
+        with open(TEST_GENOME_SNPS) as fh:
+            reader = vcf.Reader(fh)
+            experiment_sample_uids = reader.samples
+        for sample_uid in experiment_sample_uids:
+            ExperimentSample.objects.create(
+                uid=sample_uid,
+                project=self.project,
+                label='fakename:' + sample_uid
+            )
+
+        def _parse(label):
+            alignment_group = AlignmentGroup.objects.create(
+                    label=label, reference_genome=self.reference_genome)
+            vcf_dataset = copy_and_add_dataset_source(alignment_group,
+                    VCF_DATATYPE, VCF_DATATYPE, TEST_GENOME_SNPS)
+            add_vcf_track_given_dataset(self.reference_genome,
+                    alignment_group, vcf_dataset)
+            return (alignment_group, parse_vcf(vcf_dataset, alignment_group,
+                    on_loaded=flag_callable_loci_variants.si(
+                            alignment_group)))
+
+        def _variant_ids(alignment_group):
+            return set(VariantCallerCommonData.objects.filter(
+                    alignment_group=alignment_group).values_list(
+                            'variant_id', flat=True))
+
+        with self.settings(VCF_PARSE_SHARDED=False):
+            (single_pass_alignment_group, single_pass_variants) = _parse(
+                    'single pass')
+        self.assertEqual(
+                set([variant.id for variant in single_pass_variants]),
+                _variant_ids(single_pass_alignment_group))
+
+        # Split the 2000 base genome into 10 regions. The chord runs eagerly
+        # in tests, so the records are loaded once parse_vcf() returns.
+        with self.settings(VCF_PARSE_SHARDED=True, VCF_PARSE_SHARD_SIZE=200):
+            (sharded_alignment_group, sharded_variants) = _parse('sharded')
+        self.assertIsNone(sharded_variants)
+        self.assertEqual(0, AlignmentGroup.objects.get(
+                id=sharded_alignment_group.id).pending_vcf_parse_count)
+
+        self.assertEqual(_variant_ids(single_pass_alignment_group),
+                _variant_ids(sharded_alignment_group))
+        self.assertEqual(_summarize(single_pass_alignment_group),
+                _summarize(sharded_alignment_group))
+
     def test_parser_skip_het(self):
         """Test that skipping het_only variants works.
         """
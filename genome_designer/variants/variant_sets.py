@@ -86,7 +86,8 @@ def update_variant_in_set_memberships(ref_genome, uid_data_str_list,
                 variant_uid_to_obj_map, sample_uid_to_obj_map)
 
     # These actions invalidate the materialized view.
-    ref_genome.invalidate_materialized_view()
+    ref_genome.invalidate_materialized_view(
+            variant_ids=[v.id for v in variant_uid_to_obj_map.values()])
 
     # Return success response if we got here.
     return {
@@ -4,11 +4,27 @@ Methods for reading vcf files and importing it in our database representation.
 We leverage pyvcf as much as possible.
 """
 
+import json
+import os
+
+from celery import chord
+from celery import signature
+from celery import task
+from django.conf import settings
+from django.db import connection
 from django.db import reset_queries
-
+from django.db import transaction
+from psycopg2.extras import Json as psycopg2_Json
+import pysam
 import vcf
 
+from main.model_utils import allocate_model_ids
+from main.model_utils import copy_model_instances
+from main.model_utils import copy_rows
+from main.model_utils import ensure_unique_uids
 from main.model_utils import get_dataset_with_type
+from main.model_utils import get_normalized_alt_representation
+from main.models import AlignmentGroup
 from main.models import Chromosome
 from main.models import ExperimentSample
 from main.models import ReferenceGenome
@@ -49,15 +65,18 @@ class QueryCache(object):
         self.uid_to_experiment_sample_map = {}
 
 
-def parse_alignment_group_vcf(alignment_group, vcf_dataset_type):
+def parse_alignment_group_vcf(alignment_group, vcf_dataset_type,
+        on_loaded=None):
     """Parses the VCF associated with the AlignmentGroup and saves data there.
+
+    See parse_vcf() for on_loaded.
     """
     vcf_dataset = get_dataset_with_type(alignment_group, vcf_dataset_type)
-    parse_vcf(vcf_dataset, alignment_group)
+    parse_vcf(vcf_dataset, alignment_group, on_loaded=on_loaded)
 
 
 def parse_vcf(vcf_dataset, alignment_group,
-            should_update_parent_child_relationships=True):
+            should_update_parent_child_relationships=True, on_loaded=None):
     """
     Parses the VCF and creates Variant models relative to ReferenceGenome.
 
@@ -66,24 +85,19 @@ def parse_vcf(vcf_dataset, alignment_group,
             not diploid, these variants are likely to be just poorly mapped
             reads, so discard the variants created by them. In the future, this
             option will be moved to an alignment_group options dictionary.
-    """
-    reference_genome = alignment_group.reference_genome
 
-    # This helper object will help prevent repeated calls to the database.
-    # We'll use it at least for ExperimentSamples.
-    query_cache = QueryCache()
+    If on_loaded, an immutable task signature, is given, the caller doesn't
+    need the Variants right away. Large tabix-indexed VCFs are then parsed in
+    the background, one celery task per region (see
+    settings.VCF_PARSE_SHARDED), and on_loaded runs once all of them are
+    loaded. Otherwise on_loaded runs before this returns.
 
-    # First count the number of records to give helpful status debug output.
-    record_count = 0
-    with open(vcf_dataset.get_absolute_location()) as fh:
-        vcf_reader = vcf.Reader(fh)
-        for record in vcf_reader:
-            record_count += 1
+    Returns:
+        List of Variants, one per imported record, or None if the VCF is
+        being parsed in the background.
+    """
+    reference_genome = alignment_group.reference_genome
 
-    # Now iterate through the vcf file again and parse the data.
-    # NOTE: Do not save handles to the Variants, else suffer the wrath of a
-    # memory leak when parsing a large vcf file.
-    variant_list = []
     with open(vcf_dataset.get_absolute_location()) as fh:
         vcf_reader = vcf.Reader(fh)
 
@@ -94,38 +108,47 @@ def parse_vcf(vcf_dataset, alignment_group,
         update_filter_key_map(reference_genome, vcf_reader)
         reference_genome = ReferenceGenome.objects.get(id=reference_genome.id)
 
-        for record_idx, record in enumerate(vcf_reader):
-            print 'vcf_parser: Parsing %d out of %d' % (
-                    record_idx + 1, record_count)
-
-            # Make sure the QueryCache object has experiment samples populated.
-            # Assumes every row has same samples. (Pretty sure this is true
-            # for well-formatted vcf file.)
-            if (len(query_cache.uid_to_experiment_sample_map) == 0 and
-                    len(record.samples) > 0):
-
-                for sample in record.samples:
-                    sample_uid = sample.sample
-                    query_cache.uid_to_experiment_sample_map[sample_uid] = (
-                            ExperimentSample.objects.get(uid=sample_uid))
-
-            # If the record has no GT_TYPE = 2 samples, then skip by default
-            if alignment_group.alignment_options['skip_het_only']:
-                if sum([s.gt_type == 2 for s in record.samples]) == 0:
-                    print 'HET only, skipping record %d' % (record_idx + 1)
-                    continue
-
-            # Get or create the Variant for this record. This step
-            # also generates the alternate objects and assigns their
-            # data fields as well.
-            variant, _ = get_or_create_variant(reference_genome,
-                    record, vcf_dataset, alignment_group, query_cache)
-            variant_list.append(variant)
-
-            # For large VCFs, the cached SQL object references can exhaust memory
-            # so we explicitly clear them here. Our efficiency doesn't really suffer.
-            reset_queries()
+        shard_regions = None
+        if on_loaded is not None:
+            tabix_vcf_dataset = _get_tabix_vcf_dataset(vcf_dataset,
+                    alignment_group)
+            shard_regions = _get_shard_regions(tabix_vcf_dataset,
+                    reference_genome)
+
+        if shard_regions is not None:
+            _start_sharded_vcf_parse(vcf_dataset, tabix_vcf_dataset,
+                    alignment_group, shard_regions,
+                    should_update_parent_child_relationships, on_loaded)
+            return None
+        elif settings.VCF_BULK_INGESTION:
+            variant_list = _bulk_load_vcf_records(vcf_reader, vcf_dataset,
+                    alignment_group, reference_genome)
+        else:
+            variant_list = _load_vcf_records(vcf_reader, vcf_dataset,
+                    alignment_group, reference_genome)
+
+    _finish_vcf_parse(alignment_group, reference_genome,
+            [variant.id for variant in variant_list],
+            should_update_parent_child_relationships)
+
+    if on_loaded is not None:
+        signature(on_loaded).apply().get()
 
+    return variant_list
+
+
+def _finish_vcf_parse(alignment_group, reference_genome, variant_ids,
+        should_update_parent_child_relationships):
+    """Updates the parent/child fields and the materialized view once the
+    records of a VCF are loaded.
+
+    Args:
+        alignment_group: The AlignmentGroup.
+        reference_genome: The ReferenceGenome of alignment_group.
+        variant_ids: Ids of the Variants of the loaded records.
+        should_update_parent_child_relationships: Whether to update the
+            parent/child fields.
+    """
     # Finally, update the parent/child relationships for these new
     # created variants.
     # We don't want to do this in the case of SVs, since they are called separately
@@ -134,12 +157,583 @@ def parse_vcf(vcf_dataset, alignment_group,
     if should_update_parent_child_relationships:
         update_parent_child_variant_fields(alignment_group)
 
+        # Parent/child fields may have been updated for any Variant called in
+        # this AlignmentGroup, not only the ones from this VCF.
+        dirty_variant_ids = VariantCallerCommonData.objects.filter(
+                alignment_group=alignment_group).values_list(
+                        'variant_id', flat=True)
+    else:
+        dirty_variant_ids = variant_ids
+
     # Force invalidate materialized view here.
-    reference_genome.invalidate_materialized_view()
+    reference_genome.invalidate_materialized_view(
+            variant_ids=dirty_variant_ids)
+
+
+def _should_skip_record(alignment_group, record, record_idx):
+    """Returns True if the record should not be imported.
+    """
+    # If the record has no GT_TYPE = 2 samples, then skip by default
+    if alignment_group.alignment_options['skip_het_only']:
+        if sum([s.gt_type == 2 for s in record.samples]) == 0:
+            print 'HET only, skipping record %d' % (record_idx + 1)
+            return True
+    return False
+
+
+def _load_vcf_records(vcf_reader, vcf_dataset, alignment_group,
+        reference_genome):
+    """Creates the models for each record of the VCF one at a time.
+
+    Returns:
+        List of Variants, one per imported record.
+    """
+    # This helper object will help prevent repeated calls to the database.
+    # We'll use it at least for ExperimentSamples.
+    query_cache = QueryCache()
+
+    # First count the number of records to give helpful status debug output.
+    record_count = 0
+    with open(vcf_dataset.get_absolute_location()) as fh:
+        for record in vcf.Reader(fh):
+            record_count += 1
+
+    # Now iterate through the vcf file and parse the data.
+    # NOTE: Do not save handles to the Variants, else suffer the wrath of a
+    # memory leak when parsing a large vcf file.
+    variant_list = []
+    for record_idx, record in enumerate(vcf_reader):
+        print 'vcf_parser: Parsing %d out of %d' % (
+                record_idx + 1, record_count)
+
+        # Make sure the QueryCache object has experiment samples populated.
+        # Assumes every row has same samples. (Pretty sure this is true
+        # for well-formatted vcf file.)
+        if (len(query_cache.uid_to_experiment_sample_map) == 0 and
+                len(record.samples) > 0):
+
+            for sample in record.samples:
+                sample_uid = sample.sample
+                query_cache.uid_to_experiment_sample_map[sample_uid] = (
+                        ExperimentSample.objects.get(uid=sample_uid))
+
+        if _should_skip_record(alignment_group, record, record_idx):
+            continue
+
+        # Get or create the Variant for this record. This step
+        # also generates the alternate objects and assigns their
+        # data fields as well.
+        variant, _ = get_or_create_variant(reference_genome,
+                record, vcf_dataset, alignment_group, query_cache)
+        variant_list.append(variant)
+
+        # For large VCFs, the cached SQL object references can exhaust memory
+        # so we explicitly clear them here. Our efficiency doesn't really suffer.
+        reset_queries()
 
     return variant_list
 
 
+def _bulk_load_vcf_records(vcf_reader, vcf_dataset, alignment_group,
+        reference_genome):
+    """Loads the records of the VCF in batches using VcfBulkLoader.
+
+    Returns:
+        List of Variants, one per imported record.
+    """
+    loader = VcfBulkLoader(reference_genome, vcf_dataset, alignment_group)
+    for record_idx, record in enumerate(vcf_reader):
+        if _should_skip_record(alignment_group, record, record_idx):
+            continue
+        loader.add_record(record)
+    variant_ids = loader.finish()
+
+    id_to_variant = Variant.objects.in_bulk(set(variant_ids))
+    return [id_to_variant[variant_id] for variant_id in variant_ids]
+
+
+def _get_tabix_vcf_dataset(vcf_dataset, alignment_group):
+    """Returns the compressed, tabix-indexed version of the VCF, or None if it
+    doesn't exist or is older than the VCF.
+    """
+    tabix_vcf_dataset = get_dataset_with_type(alignment_group,
+            vcf_dataset.type, compressed=True)
+    if (tabix_vcf_dataset is None or
+            tabix_vcf_dataset.filesystem_idx_location == ''):
+        return None
+
+    tabix_location = tabix_vcf_dataset.get_absolute_location()
+    if not (os.path.exists(tabix_location) and os.path.exists(
+            tabix_vcf_dataset.get_absolute_idx_location())):
+        return None
+    if (os.path.getmtime(tabix_location) <
+            os.path.getmtime(vcf_dataset.get_absolute_location())):
+        return None
+
+    return tabix_vcf_dataset
+
+
+def _get_shard_regions(tabix_vcf_dataset, reference_genome):
+    """Splits the Chromosomes of the VCF into regions that can be parsed
+    independently.
+
+    Returns:
+        List of tuples (chromosome label, start, end), with start and end
+        0-based and half-open, or None if the VCF should be parsed in a single
+        pass.
+    """
+    if not (settings.VCF_PARSE_SHARDED and settings.VCF_BULK_INGESTION):
+        return None
+    if tabix_vcf_dataset is None:
+        return None
+
+    vcf_chromosome_labels = pysam.TabixFile(
+            tabix_vcf_dataset.get_absolute_location()).contigs
+    chromosome_label_to_num_bases = dict(Chromosome.objects.filter(
+            reference_genome=reference_genome).values_list(
+                    'seqrecord_id', 'num_bases'))
+
+    # Let the single pass report records on unknown chromosomes.
+    if not set(vcf_chromosome_labels).issubset(chromosome_label_to_num_bases):
+        return None
+
+    regions = []
+    for chromosome_label in vcf_chromosome_labels:
+        num_bases = chromosome_label_to_num_bases[chromosome_label]
+        for start in xrange(0, num_bases, settings.VCF_PARSE_SHARD_SIZE):
+            end = min(start + settings.VCF_PARSE_SHARD_SIZE, num_bases)
+            regions.append((chromosome_label, start, end))
+
+    if len(regions) < 2:
+        return None
+    return regions
+
+
+def _start_sharded_vcf_parse(vcf_dataset, tabix_vcf_dataset, alignment_group,
+        shard_regions, should_update_parent_child_relationships, on_loaded):
+    """Starts a chord that loads the records of each region of the VCF in a
+    separate parse_vcf_region() task, followed by finish_sharded_vcf_parse().
+
+    The regions don't overlap, so no two tasks create the same Variant.
+
+    Nothing waits for the chord. Instead,
+    AlignmentGroup.pending_vcf_parse_count is incremented here and
+    decremented once the chord is done, whether it succeeded or failed, so
+    that the pipeline can tell when all of its VCFs are loaded.
+    """
+    _add_to_pending_vcf_parse_count(alignment_group, 1)
+
+    callback = finish_sharded_vcf_parse.s(vcf_dataset, alignment_group,
+            should_update_parent_child_relationships, on_loaded)
+    callback.link_error(sharded_vcf_parse_failed.si(alignment_group))
+
+    try:
+        chord([parse_vcf_region.si(vcf_dataset, tabix_vcf_dataset,
+                        alignment_group, region)
+                for region in shard_regions])(callback)
+    except:
+        _add_to_pending_vcf_parse_count(alignment_group, -1)
+        raise
+
+
+def _add_to_pending_vcf_parse_count(alignment_group, delta):
+    """Atomically adds delta to AlignmentGroup.pending_vcf_parse_count.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+            'UPDATE main_alignmentgroup '
+            'SET pending_vcf_parse_count = pending_vcf_parse_count + %s '
+            'WHERE id = %s',
+            (delta, alignment_group.id))
+    transaction.commit_unless_managed()
+
+
+@task(ignore_result=False)
+def parse_vcf_region(vcf_dataset, tabix_vcf_dataset, alignment_group, region):
+    """Loads the records of the VCF that start in the region.
+
+    Args:
+        vcf_dataset: Dataset of the VCF that the records are attributed to.
+        tabix_vcf_dataset: Compressed and indexed version of vcf_dataset.
+        alignment_group: The AlignmentGroup.
+        region: Tuple (chromosome label, start, end), with start and end
+            0-based and half-open.
+
+    Returns:
+        List of ids of the Variants of the loaded records, in order.
+    """
+    (chromosome_label, start, end) = region
+    reference_genome = ReferenceGenome.objects.get(
+            id=alignment_group.reference_genome_id)
+
+    vcf_reader = vcf.Reader(filename=tabix_vcf_dataset.get_absolute_location(),
+            compressed=True)
+    loader = VcfBulkLoader(reference_genome, vcf_dataset, alignment_group,
+            region=region)
+    for record_idx, record in enumerate(
+            vcf_reader.fetch(chromosome_label, start, end)):
+        # Records that overlap the start of the region belong to the previous
+        # region.
+        if record.start < start:
+            continue
+        if _should_skip_record(alignment_group, record, record_idx):
+            continue
+        loader.add_record(record)
+    return loader.finish()
+
+
+@task(ignore_result=False)
+def finish_sharded_vcf_parse(shard_variant_ids_list, vcf_dataset,
+        alignment_group, should_update_parent_child_relationships,
+        on_loaded):
+    """Runs once all the regions of a VCF are loaded by parse_vcf_region().
+    See _start_sharded_vcf_parse().
+
+    Args:
+        shard_variant_ids_list: List of the results of the parse_vcf_region()
+            tasks, in the order of the regions.
+        vcf_dataset: Dataset of the VCF.
+        alignment_group: The AlignmentGroup.
+        should_update_parent_child_relationships: Whether to update the
+            parent/child fields.
+        on_loaded: Immutable signature of the task to run next, or None.
+    """
+    variant_ids = []
+    for shard_variant_ids in shard_variant_ids_list:
+        variant_ids.extend(shard_variant_ids)
+
+    reference_genome = ReferenceGenome.objects.get(
+            id=alignment_group.reference_genome_id)
+    _finish_vcf_parse(alignment_group, reference_genome, variant_ids,
+            should_update_parent_child_relationships)
+
+    if on_loaded is not None:
+        signature(on_loaded).apply().get()
+
+    _add_to_pending_vcf_parse_count(alignment_group, -1)
+
+
+@task
+def sharded_vcf_parse_failed(alignment_group):
+    """Error callback of the chord started by _start_sharded_vcf_parse(), run
+    if any of its tasks raised.
+    """
+    alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
+    alignment_group.status = AlignmentGroup.STATUS.FAILED
+    alignment_group.save(update_fields=['status'])
+
+    _add_to_pending_vcf_parse_count(alignment_group, -1)
+
+
+class VcfBulkLoader(object):
+    """Loads VCF records into the database in batches.
+
+    Rather than creating the models for each record through the ORM, the
+    loader keeps in-memory maps of the Chromosomes, ExperimentSamples and
+    existing Variants, builds the model objects for a batch of records in
+    memory, and inserts them with COPY.
+
+    VariantEvidence objects are linked to their VariantAlternates by the
+    post_variant_evidence_create signal when created through the ORM. Here the
+    links are staged in a temporary table instead, and created with a single
+    statement in finish().
+
+    If a region is given, only records that start in the region may be
+    added, and only the existing Variants in the region are loaded.
+
+    Usage:
+        loader = VcfBulkLoader(reference_genome, vcf_dataset, alignment_group)
+        for record in vcf_reader:
+            loader.add_record(record)
+        variant_ids = loader.finish()
+    """
+
+    STAGING_TABLE_NAME = 'vcf_bulk_loader_evidence_alternate'
+
+    def __init__(self, reference_genome, vcf_dataset, alignment_group,
+            region=None):
+        self.reference_genome = reference_genome
+        self.vcf_dataset = vcf_dataset
+        self.alignment_group = alignment_group
+        self.cursor = connection.cursor()
+
+        self.chromosome_label_to_id = dict(Chromosome.objects.filter(
+                reference_genome=reference_genome).values_list(
+                        'seqrecord_id', 'id'))
+
+        existing_variants = Variant.objects.filter(
+                reference_genome=reference_genome)
+        if region is not None:
+            (chromosome_label, start, end) = region
+            existing_variants = existing_variants.filter(
+                    chromosome_id=self.chromosome_label_to_id[
+                            chromosome_label],
+                    position__gt=start,
+                    position__lte=end)
+
+        self.variant_key_to_id = {}
+        for chromosome_id, position, ref_value, variant_id in (
+                existing_variants.values_list(
+                        'chromosome_id', 'position', 'ref_value', 'id')):
+            self.variant_key_to_id[
+                    (chromosome_id, position, ref_value)] = variant_id
+
+        # Populated from the first record with samples. Assumes every row has
+        # the same samples.
+        self.sample_uid_to_id = None
+
+        self.alt_keys = set(
+                reference_genome.get_variant_alternate_map().keys())
+
+        # Ids of the Variants of the loaded records, in order.
+        self.variant_ids = []
+
+        self.batch = []
+        self.num_loaded_records = 0
+
+        self.cursor.execute('DROP TABLE IF EXISTS %s' % (
+                self.STAGING_TABLE_NAME,))
+        self.cursor.execute(
+                'CREATE TEMP TABLE %s ('
+                    'variant_evidence_id integer, '
+                    'variant_id integer, '
+                    'alt_value text)' % (self.STAGING_TABLE_NAME,))
+
+    def add_record(self, record):
+        """Adds a pyvcf Record to be loaded.
+        """
+        if self.sample_uid_to_id is None and len(record.samples) > 0:
+            self._populate_sample_uid_to_id(record)
+
+        self.batch.append(record)
+        if len(self.batch) >= settings.VCF_BULK_INGESTION_BATCH_SIZE:
+            self._flush()
+
+    def finish(self):
+        """Loads any remaining records and links the VariantEvidence objects
+        to their VariantAlternates.
+
+        Returns:
+            List of ids of the Variants of the loaded records, in order.
+        """
+        self._flush()
+
+        self.cursor.execute(
+                'INSERT INTO main_variantevidence_variantalternate_set '
+                        '(variantevidence_id, variantalternate_id) '
+                    'SELECT DISTINCT staging.variant_evidence_id, '
+                            'main_variantalternate.id '
+                        'FROM %s AS staging '
+                        'INNER JOIN main_variantalternate ON ('
+                            'main_variantalternate.variant_id = '
+                                    'staging.variant_id AND '
+                            'main_variantalternate.alt_value = '
+                                    'staging.alt_value)' % (
+                                            self.STAGING_TABLE_NAME,))
+        self.cursor.execute('DROP TABLE %s' % (self.STAGING_TABLE_NAME,))
+        transaction.commit_unless_managed()
+
+        return self.variant_ids
+
+    def _populate_sample_uid_to_id(self, record):
+        sample_uids = [sample.sample for sample in record.samples]
+        self.sample_uid_to_id = dict(ExperimentSample.objects.filter(
+                uid__in=sample_uids).values_list('uid', 'id'))
+        for sample_uid in sample_uids:
+            if not sample_uid in self.sample_uid_to_id:
+                raise ExperimentSample.DoesNotExist(
+                        'No ExperimentSample with uid %s.' % sample_uid)
+
+    def _flush(self):
+        """Loads the current batch of records.
+        """
+        if not self.batch:
+            return
+        records = self.batch
+        self.batch = []
+
+        # Parse the records and find the keys of their Variants, creating
+        # the Variants that don't exist yet.
+        parsed_records = []
+        key_to_new_variant = {}
+        existing_variant_id_to_type = {}
+        for record in records:
+            raw_data_dict = extract_raw_data_dict(record)
+            (type, chromosome_label, position, ref_value, alt_values) = (
+                    pop_required_fields(raw_data_dict))
+
+            chromosome_id = self.chromosome_label_to_id.get(chromosome_label)
+            if chromosome_id is None:
+                raise get_unknown_chromosome_exception(self.reference_genome,
+                        type, chromosome_label, position, ref_value,
+                        alt_values)
+
+            variant_key = (chromosome_id, position, ref_value)
+            if variant_key in self.variant_key_to_id:
+                if type:
+                    existing_variant_id_to_type[
+                            self.variant_key_to_id[variant_key]] = type
+            elif variant_key in key_to_new_variant:
+                if type:
+                    key_to_new_variant[variant_key].type = type
+            else:
+                key_to_new_variant[variant_key] = Variant(
+                        reference_genome=self.reference_genome,
+                        chromosome_id=chromosome_id,
+                        position=position,
+                        ref_value=ref_value,
+                        type=type)
+
+            parsed_records.append(
+                    (record, raw_data_dict, variant_key, alt_values))
+
+        new_variants = key_to_new_variant.values()
+        for variant, variant_id in zip(new_variants,
+                allocate_model_ids(Variant, len(new_variants))):
+            variant.id = variant_id
+            self.variant_key_to_id[
+                    (variant.chromosome_id, variant.position,
+                            variant.ref_value)] = variant_id
+        ensure_unique_uids(Variant, new_variants)
+        copy_model_instances(Variant, new_variants)
+
+        # We don't search by type above, but we do want to save the type.
+        type_to_variant_ids = {}
+        for variant_id, type in existing_variant_id_to_type.iteritems():
+            type_to_variant_ids.setdefault(type, []).append(variant_id)
+        for type, variant_ids in type_to_variant_ids.iteritems():
+            self.cursor.execute(
+                    'UPDATE main_variant SET type = %s WHERE id = ANY(%s)',
+                    (type, variant_ids))
+
+        # Existing VariantAlternates of the Variants in this batch, keyed by
+        # (variant id, normalized alt value), with their data.
+        alt_key_to_existing_alt = {}
+        for alt_id, variant_id, alt_value, data in (
+                VariantAlternate.objects.filter(
+                        variant_id__in=existing_variant_id_to_type.keys()
+                ).values_list('id', 'variant_id', 'alt_value', 'data')):
+            if not isinstance(data, dict):
+                data = json.loads(data) if data else {}
+            alt_key_to_existing_alt[(variant_id, alt_value)] = (alt_id, data)
+        updated_existing_alt_ids = set()
+
+        # Used as the variant of new VariantAlternates, which need the
+        # ReferenceGenome when writing long alts to disk.
+        variant_id_to_variant = dict(
+                [(variant.id, variant) for variant in new_variants])
+
+        alt_key_to_new_alt = {}
+        common_data_objs = []
+        for record, raw_data_dict, variant_key, alt_values in parsed_records:
+            variant_id = self.variant_key_to_id[variant_key]
+            self.variant_ids.append(variant_id)
+
+            # Whether or not this is an (structural variant) SV is determined
+            # in VariantAlternate data.
+            is_sv = False
+
+            raw_alt_keys = [k for k in raw_data_dict.keys()
+                    if k in self.alt_keys]
+            for alt_idx, alt_value in enumerate(alt_values):
+                alt_value = str(alt_value)
+
+                # Grab the alt data for this alt index.
+                alt_data = dict([(k, raw_data_dict[k][alt_idx])
+                        for k in raw_alt_keys])
+                if 'INFO_SVTYPE' in alt_data:
+                    is_sv = True
+
+                alt_key = (variant_id,
+                        get_normalized_alt_representation(alt_value))
+                if alt_key in alt_key_to_existing_alt:
+                    alt_key_to_existing_alt[alt_key][1].update(alt_data)
+                    updated_existing_alt_ids.add(
+                            alt_key_to_existing_alt[alt_key][0])
+                elif alt_key in alt_key_to_new_alt:
+                    alt_key_to_new_alt[alt_key].data.update(alt_data)
+                else:
+                    if not variant_id in variant_id_to_variant:
+                        variant_id_to_variant[variant_id] = Variant(
+                                id=variant_id,
+                                reference_genome=self.reference_genome)
+                    alt_key_to_new_alt[alt_key] = VariantAlternate(
+                            variant=variant_id_to_variant[variant_id],
+                            alt_value=alt_value,
+                            data=alt_data)
+
+            # Remove all per-alt keys from raw_data_dict before creating the
+            # VariantCallerCommonData.
+            for k in raw_alt_keys:
+                raw_data_dict.pop(k, None)
+
+            # Indicate whether this is SV type, making it queryable.
+            raw_data_dict['IS_SV'] = is_sv
+
+            common_data_objs.append(VariantCallerCommonData(
+                    alignment_group=self.alignment_group,
+                    variant_id=variant_id,
+                    source_dataset=self.vcf_dataset,
+                    data=raw_data_dict))
+
+        new_alts = alt_key_to_new_alt.values()
+        for alt, alt_id in zip(new_alts,
+                allocate_model_ids(VariantAlternate, len(new_alts))):
+            alt.id = alt_id
+        ensure_unique_uids(VariantAlternate, new_alts)
+        copy_model_instances(VariantAlternate, new_alts)
+
+        self.cursor.executemany(
+                'UPDATE main_variantalternate SET data = %s WHERE id = %s',
+                [(psycopg2_Json(existing_alt_data), existing_alt_id)
+                        for existing_alt_id, existing_alt_data in
+                                alt_key_to_existing_alt.itervalues()
+                        if existing_alt_id in updated_existing_alt_ids])
+
+        for common_data_obj, common_data_id in zip(common_data_objs,
+                allocate_model_ids(VariantCallerCommonData,
+                        len(common_data_objs))):
+            common_data_obj.id = common_data_id
+        copy_model_instances(VariantCallerCommonData, common_data_objs)
+
+        # Create a VariantEvidence object for each ExperimentSample, staging
+        # the links to the called VariantAlternates.
+        evidence_objs = []
+        evidence_variant_ids = []
+        for (record, _, _, _), common_data_obj in zip(parsed_records,
+                common_data_objs):
+            for sample in record.samples:
+                evidence_objs.append(VariantEvidence(
+                        experiment_sample_id=self.sample_uid_to_id[
+                                sample.sample],
+                        variant_caller_common_data_id=common_data_obj.id,
+                        data=extract_sample_data_dict(sample)))
+                evidence_variant_ids.append(common_data_obj.variant_id)
+        staged_links = []
+        for evidence_obj, variant_id, evidence_id in zip(evidence_objs,
+                evidence_variant_ids,
+                allocate_model_ids(VariantEvidence, len(evidence_objs))):
+            evidence_obj.id = evidence_id
+            if not 'GT_BASES' in evidence_obj.data:
+                continue
+            for alt_value in evidence_obj.get_called_alt_values():
+                staged_links.append((evidence_id, variant_id, alt_value))
+        ensure_unique_uids(VariantEvidence, evidence_objs)
+        copy_model_instances(VariantEvidence, evidence_objs)
+        copy_rows(self.STAGING_TABLE_NAME,
+                ['variant_evidence_id', 'variant_id', 'alt_value'],
+                staged_links)
+
+        transaction.commit_unless_managed()
+
+        self.num_loaded_records += len(records)
+        print 'vcf_parser: Loaded %d records' % self.num_loaded_records
+
+        # For large VCFs, the cached SQL object references can exhaust memory
+        # so we explicitly clear them here.
+        reset_queries()
+
+
 def extract_raw_data_dict(vcf_record):
     """Extract a dictionary of raw data from the Record.
 
@@ -178,6 +772,48 @@ def populate_common_data_info(data_dict, vcf_record):
         data_dict[effective_key] = value
 
 
+def pop_required_fields(raw_data_dict):
+    """Pops the fields that identify the Variant from the dictionary returned
+    by extract_raw_data_dict().
+
+    Returns:
+        Tuple (type, chromosome label, position, ref value, alt values).
+    """
+    type = str(raw_data_dict.pop('TYPE'))
+    chromosome_label = raw_data_dict.pop('CHROM')
+    position = int(raw_data_dict.pop('POS'))
+    ref_value = raw_data_dict.pop('REF')
+    alt_values = raw_data_dict.pop('ALT')
+
+    if ref_value == 'N':
+        ref_value = SV_REF_VALUE
+
+    # Convert long ref values to a string representation. No need to save
+    # the actual sequence anywhere because a user can look at the reference
+    # genome. We'll have to do this differently for alt_values where the user
+    # may want to be able to access the actual sequence.
+    if len(ref_value) > 10:
+        ref_value = 'LONG:{size}bp'.format(size=len(ref_value))
+
+    return (type, chromosome_label, position, ref_value, alt_values)
+
+
+def get_unknown_chromosome_exception(reference_genome, type,
+        chromosome_label, position, ref_value, alt_values):
+    """Returns the exception to raise when the CHROM of a record does not
+    match any Chromosome of the ReferenceGenome.
+    """
+    variant_string = ('TYPE: ' + str(type) + '   CHROM: ' + str(chromosome_label) +
+    '   POS: ' + str(position) + '   REF: ' + str(ref_value) +
+    '   ALT: ' + str(alt_values if len(alt_values)-1 else alt_values[0]))
+
+    return Exception(('The CHROM field of the following variant does not match any of '
+            'the chromosomes belonging to its reference genome:' + variant_string + '\n'
+            'Chromosomes belonging to reference genome ' + str(reference_genome.label) +
+            ' are: ' + str([str(chrom.seqrecord_id) for chrom in
+                    Chromosome.objects.filter(reference_genome=reference_genome)]).strip('[]')))
+
+
 def get_or_create_variant(reference_genome, vcf_record, vcf_dataset,
         alignment_group=None, query_cache=None):
     """Create a variant and its relations.
@@ -204,36 +840,15 @@ def get_or_create_variant(reference_genome, vcf_record, vcf_dataset,
     raw_data_dict = extract_raw_data_dict(vcf_record)
 
     # Extract the REQUIRED fields from the common data object.
-    type = str(raw_data_dict.pop('TYPE'))
-    chromosome_label = raw_data_dict.pop('CHROM')
-    position = int(raw_data_dict.pop('POS'))
-    ref_value = raw_data_dict.pop('REF')
-    alt_values = raw_data_dict.pop('ALT')
-
-    if ref_value == 'N':
-        ref_value = SV_REF_VALUE
-
-    # Convert long ref values to a string representation. No need to save
-    # the actual sequence anywhere because a user can look at the reference
-    # genome. We'll have to do this differently for alt_values where the user
-    # may want to be able to access the actual sequence.
-    if len(ref_value) > 10:
-        ref_value = 'LONG:{size}bp'.format(size=len(ref_value))
+    (type, chromosome_label, position, ref_value, alt_values) = (
+            pop_required_fields(raw_data_dict))
 
     # Make sure the chromosome cited in the VCF exists for
     # the reference genome variant is being added to
     if not chromosome_label in [chrom.seqrecord_id for chrom in
             Chromosome.objects.filter(reference_genome=reference_genome)]:
-
-        variant_string = ('TYPE: ' + str(type) + '   CHROM: ' + str(chromosome_label) +
-        '   POS: ' + str(position) + '   REF: ' + str(ref_value) +
-        '   ALT: ' + str(alt_values if len(alt_values)-1 else alt_values[0]))
-
-        raise Exception(('The CHROM field of the following variant does not match any of '
-                'the chromosomes belonging to its reference genome:' + variant_string + '\n'
-                'Chromosomes belonging to reference genome ' + str(reference_genome.label) +
-                ' are: ' + str([str(chrom.seqrecord_id) for chrom in
-                        Chromosome.objects.filter(reference_genome=reference_genome)]).strip('[]')))
+        raise get_unknown_chromosome_exception(reference_genome, type,
+                chromosome_label, position, ref_value, alt_values)
 
     # Try to find an existing Variant, or create it.
     variant, created = Variant.objects.get_or_create(